@@ -0,0 +1,388 @@
+"""Pluggable backends of the sage_data_client queries.
+
+Every query made by the download tool goes through query() of this module, which calls
+the current backend with the arguments of sage_data_client.query. Backends are,
+
+- sage_data_client.query: the live Sage data API (default)
+- RecordingBackend: queries another backend and saves its responses to a directory
+- ReplayBackend: serves queries from the responses saved by RecordingBackend
+- SyntheticBackend: generates grafana-agent metrics and scheduler events of plugin runs
+
+so that the pipeline can be benchmarked and tested without the live service.
+
+query_chunks() answers a query in chunks of bounded memory instead. Responses of the live
+Sage data API are parsed as they are streamed, and responses of the other backends are
+handed over in slices.
+"""
+import json
+import hashlib
+import os
+import threading
+from gzip import GzipFile
+from pathlib import Path
+from urllib.request import urlopen, Request
+
+import numpy as np
+import pandas as pd
+import sage_data_client
+
+from schema import compact_frame
+from instrument import trace
+
+
+_backend = sage_data_client.query
+
+
+def set_query_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_query_backend():
+    return _backend
+
+
+def query(start, end=None, filter=None, bucket=None, **kwargs) -> pd.DataFrame:
+    with trace("query") as stage:
+        df = _backend(start=start, end=end, filter=filter, bucket=bucket, **kwargs)
+        stage.rows_out = len(df)
+    return df
+
+
+SAGE_QUERY_ENDPOINT = "https://data.sagecontinuum.org/api/v1/query"
+# Responses are parsed and handed over in chunks taking about this many bytes in memory
+CHUNK_MEMORY_BUDGET = 64 * 2**20
+# Rows of the first chunk, before the size of a row is known
+CHUNK_INITIAL_ROWS = 10000
+CHUNK_MIN_ROWS = 1000
+
+
+def query_chunks(start, end=None, filter=None, bucket=None, memory_budget=CHUNK_MEMORY_BUDGET):
+    """Answers the query with data frames of compact dtypes, each taking about memory_budget bytes to build."""
+    if _backend is sage_data_client.query:
+        yield from stream_sage_query(start, end, filter, bucket, memory_budget)
+        return
+
+    df = _backend(start=start, end=end, filter=filter, bucket=bucket)
+    rows = CHUNK_INITIAL_ROWS
+    i = 0
+    while i < len(df):
+        chunk = df.iloc[i:i + rows].reset_index(drop=True)
+        i += len(chunk)
+        rows = chunk_rows(chunk, memory_budget)
+        yield compact_frame(chunk)
+
+
+def stream_sage_query(start, end=None, filter=None, bucket=None, memory_budget=CHUNK_MEMORY_BUDGET, endpoint=SAGE_QUERY_ENDPOINT):
+    """Queries the Sage data API as sage_data_client.query does, parsing the response as it arrives."""
+    q = {"start": resolve_time(start).strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+    if end is not None:
+        q["end"] = resolve_time(end).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    if filter is not None:
+        q["filter"] = filter
+    if bucket is not None:
+        q["bucket"] = bucket
+    req = Request(endpoint, json.dumps(q).encode(), headers={"Accept-Encoding": "gzip"})
+    with urlopen(req) as f:
+        if "gzip" in f.headers.get("Content-Encoding", ""):
+            f = GzipFile(fileobj=f, mode="rb")
+        rows = CHUNK_INITIAL_ROWS
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) >= rows:
+                chunk = parse_response_lines(lines)
+                lines = []
+                rows = chunk_rows(chunk, memory_budget)
+                yield compact_frame(chunk)
+        if len(lines) > 0:
+            yield compact_frame(parse_response_lines(lines))
+
+
+def parse_response_lines(lines) -> pd.DataFrame:
+    """Parses ndjson records of the Sage data API into the data frame sage_data_client.load gives."""
+    records = [json.loads(line) for line in lines]
+    timestamps = [r["timestamp"] for r in records]
+    if isinstance(timestamps[0], str):
+        timestamps = pd.to_datetime(timestamps, utc=True, format="ISO8601")
+    else:
+        timestamps = pd.to_datetime(timestamps, unit="ns", utc=True)
+    df = pd.DataFrame({
+        "timestamp": timestamps,
+        "name": [r["name"] for r in records],
+        "value": [r["value"] for r in records],
+    })
+    meta = pd.DataFrame([r["meta"] for r in records]).add_prefix("meta.")
+    return pd.concat([df, meta], axis=1)
+
+
+def chunk_rows(chunk: pd.DataFrame, memory_budget: int) -> int:
+    """Returns the number of rows of the next chunk from the memory taken by a row of the chunk."""
+    row_bytes = chunk.memory_usage(index=False, deep=True).sum() / max(len(chunk), 1)
+    return max(CHUNK_MIN_ROWS, int(memory_budget / max(row_bytes, 1)))
+
+
+def resolve_time(t) -> pd.Timestamp:
+    """Resolves an absolute or relative (e.g. -1h) time into a UTC timestamp."""
+    now = pd.Timestamp.now(tz="UTC")
+    if t is None or t == "":
+        return now
+    if isinstance(t, str) and t[0] in ["-", "+"]:
+        return now + pd.to_timedelta(t)
+    t = pd.Timestamp(t)
+    return t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+
+
+def match_filter(df: pd.DataFrame, filter) -> pd.DataFrame:
+    """Selects the records matching the query filter.
+
+    Keys of the filter are matched against the name column or the meta columns. Values
+    are regular expressions in which "*" stands for any string, e.g. "sys.scheduler.*"
+    or "container_memory_rss|container_memory_working_set_bytes".
+    """
+    if filter is None or len(df) == 0:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for key, pattern in filter.items():
+        column = "name" if key == "name" else f'meta.{key}'
+        if column not in df.columns:
+            return df.iloc[0:0]
+        pattern = pattern.replace(".*", "*").replace("*", ".*")
+        mask &= df[column].astype(str).str.fullmatch(pattern).values
+    return df[mask]
+
+
+def empty_response() -> pd.DataFrame:
+    return pd.DataFrame({
+        "timestamp": pd.to_datetime([], utc=True),
+        "name": pd.Series([], dtype=str),
+        "value": [],
+    })
+
+
+def uniform(seed: int, stream: int, counters: np.ndarray, k: int) -> np.ndarray:
+    """Returns uniform values in [0, 1) that depend only on the seed, stream, counters and k (splitmix64)."""
+    with np.errstate(over="ignore"):
+        x = counters.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= np.uint64((seed * 1000003 + stream) * 8 + k) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+INDEX_FILENAME = "index.jsonl"
+
+
+class RecordingBackend:
+    """Saves the responses of the backend to Parquet files in path along with the queries."""
+    def __init__(self, path: Path, backend=sage_data_client.query):
+        self.path = Path(path)
+        self.backend = backend
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def __call__(self, start, end=None, filter=None, bucket=None, **kwargs) -> pd.DataFrame:
+        df = self.backend(start=start, end=end, filter=filter, bucket=bucket, **kwargs)
+        record = {
+            "bucket": bucket,
+            "filter": filter,
+            "start": resolve_time(start).isoformat(),
+            "end": resolve_time(end).isoformat(),
+            "rows": len(df),
+        }
+        string = json.dumps(record, sort_keys=True)
+        record["file"] = f'{hashlib.md5(string.encode()).hexdigest()}.parquet'
+        if len(df) > 0:
+            df.to_parquet(self.path.joinpath(record["file"]), index=False, engine="pyarrow")
+        with self.lock:
+            with open(self.path.joinpath(INDEX_FILENAME), "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return df
+
+
+class ReplayBackend:
+    """Serves queries from the responses recorded in path.
+
+    A query is answered with the recorded records of the same bucket that fall in its
+    time range and match its filter, regardless of how the records were queried.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.records = []
+        with open(self.path.joinpath(INDEX_FILENAME), "r") as f:
+            for line in f:
+                record = json.loads(line)
+                record["start"] = resolve_time(record["start"])
+                record["end"] = resolve_time(record["end"])
+                self.records.append(record)
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def load(self, record) -> pd.DataFrame:
+        with self.lock:
+            if record["file"] not in self.frames:
+                self.frames[record["file"]] = pd.read_parquet(self.path.joinpath(record["file"]), engine="pyarrow")
+            return self.frames[record["file"]]
+
+    def __call__(self, start, end=None, filter=None, bucket=None, **kwargs) -> pd.DataFrame:
+        start, end = resolve_time(start), resolve_time(end)
+        dfs = []
+        for record in self.records:
+            if record["bucket"] != bucket or record["rows"] == 0:
+                continue
+            if record["start"] >= end or record["end"] <= start:
+                continue
+            df = self.load(record)
+            df = df[(df["timestamp"] >= start) & (df["timestamp"] < end)]
+            dfs.append(match_filter(df, filter))
+        if len(dfs) == 0:
+            return empty_response()
+        df = pd.concat(dfs, ignore_index=True)
+        # Overlapping recordings hold the same records more than once
+        meta_columns = [c for c in df.columns if c.startswith("meta.")]
+        df = df.drop_duplicates(subset=["timestamp", "name"] + meta_columns, ignore_index=True)
+        if len(df) == 0:
+            return empty_response()
+        return df.sort_values(by="timestamp", kind="stable", ignore_index=True)
+
+
+class SyntheticBackend:
+    """Generates realistic grafana-agent metrics and scheduler events of plugin runs.
+
+    Each plugin is launched every run_interval with a plugin-specific phase and runs for
+    a random duration of up to max_duration, so runs of different plugins overlap. The
+    records are a deterministic function of the time so any time range can be queried.
+    Volume is controlled by the number of plugins and sample_interval of the metrics.
+    """
+    EPOCH = pd.Timestamp("2024-01-01T00:00:00Z")
+
+    def __init__(self, plugins=10, run_interval="5min", max_duration="4min", sample_interval="10s", failure_rate=0.05, seed=0):
+        self.plugins = [f'synthetic-plugin-{i}' for i in range(plugins)]
+        self.run_interval = pd.to_timedelta(run_interval)
+        self.max_duration = pd.to_timedelta(max_duration)
+        self.sample_interval = pd.to_timedelta(sample_interval)
+        self.failure_rate = failure_rate
+        self.seed = seed
+
+    def node_of(self, vsn: str) -> str:
+        return f'0000{hashlib.md5(vsn.encode()).hexdigest()[:12]}'
+
+    def host_of(self, vsn: str, plugin_index: int) -> str:
+        # One in four plugins runs on the Raspberry Pi of the node
+        device = "ws-rpi" if plugin_index % 4 == 3 else "ws-nxcore"
+        return f'{self.node_of(vsn)}.{device}'
+
+    def runs(self, vsn: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """Returns the runs of all plugins that are active at some point in [start, end)."""
+        first = int(np.floor((start - self.max_duration - self.EPOCH) / self.run_interval))
+        last = int(np.ceil((end - self.EPOCH) / self.run_interval))
+        cycles = np.arange(first, last + 1)
+        runs = []
+        for i, plugin in enumerate(self.plugins):
+            draws = np.stack([uniform(self.seed, i, cycles, k) for k in range(4)], axis=1)
+            phase = self.run_interval * (i / len(self.plugins))
+            launched = self.EPOCH + pd.to_timedelta(cycles * self.run_interval.value, unit="ns") + phase + pd.to_timedelta(draws[:, 0] * 10, unit="s")
+            duration = pd.to_timedelta(10 + draws[:, 1] * (self.max_duration.total_seconds() - 10), unit="s")
+            runs.append(pd.DataFrame({
+                "plugin_index": i,
+                "plugin_name": plugin,
+                "k3s_pod_instance": [f'{plugin}-{c}' for c in cycles],
+                "launched": launched,
+                "ended": launched + duration,
+                "failed": draws[:, 2] < self.failure_rate,
+                "cpu_rate": 0.05 + draws[:, 3] * (1.5 if i % 2 == 0 else 0.3),
+                "gpu": i % 2 == 0,
+            }))
+        runs = pd.concat(runs, ignore_index=True)
+        return runs[(runs["launched"] < end) & (runs["ended"] >= start)]
+
+    def scheduler_events(self, vsn: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        runs = self.runs(vsn, start, end)
+        timestamps, names, values = [], [], []
+        for run in runs.itertuples(index=False):
+            event = {
+                "plugin_name": run.plugin_name,
+                "plugin_task": run.plugin_name,
+                "plugin_image": f'registry.sagecontinuum.org/synthetic/{run.plugin_name}:0.1.0',
+                "plugin_selector": json.dumps({"resource.gpu": "true"}) if run.gpu else "",
+                "k3s_pod_name": run.k3s_pod_instance,
+                "k3s_pod_instance": run.k3s_pod_instance,
+            }
+            if start <= run.launched < end:
+                timestamps.append(run.launched)
+                names.append("sys.scheduler.status.plugin.launched")
+                values.append(json.dumps(event))
+            if start <= run.ended < end:
+                event["k3s_pod_node_name"] = self.host_of(vsn, run.plugin_index)
+                if run.failed:
+                    event["reason"] = "Error"
+                    event["error_log"] = "Traceback (most recent call last)"
+                timestamps.append(run.ended)
+                names.append("sys.scheduler.status.plugin.failed" if run.failed else "sys.scheduler.status.plugin.complete")
+                values.append(json.dumps(event))
+        if len(timestamps) == 0:
+            return empty_response()
+        df = pd.DataFrame({"timestamp": pd.to_datetime(timestamps, utc=True), "name": names, "value": values})
+        df["meta.node"] = self.node_of(vsn)
+        df["meta.vsn"] = vsn
+        return df.sort_values(by="timestamp", kind="stable", ignore_index=True)
+
+    def performance_data(self, vsn: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        grid_start = self.EPOCH + np.ceil((start - self.EPOCH) / self.sample_interval) * self.sample_interval
+        grid = pd.date_range(grid_start, end, freq=self.sample_interval, inclusive="left")
+        dfs = []
+        hosts = sorted(set(self.host_of(vsn, i) for i in range(len(self.plugins))))
+        seconds = (grid - self.EPOCH).total_seconds().values
+        for host in hosts:
+            if "rpi" in host:
+                continue
+            for sensor, idle, swing in [("vdd_in", 5000., 4000.), ("vdd_cpu_gpu_cv", 1000., 3000.)]:
+                dfs.append(pd.DataFrame({
+                    "timestamp": grid,
+                    "name": "tegra_wattage_current_milliwatts",
+                    "value": idle + swing * (0.5 + 0.5 * np.sin(seconds / 97.)),
+                    "meta.host": host,
+                    "meta.sensor": sensor,
+                }))
+
+        # Container metrics are sampled on the grid while the runs are active
+        runs = self.runs(vsn, start, end).reset_index(drop=True)
+        lo = grid.searchsorted(runs["launched"])
+        counts = np.maximum(grid.searchsorted(runs["ended"]) - lo, 0)
+        run_index = np.repeat(np.arange(len(runs)), counts)
+        grid_index = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        elapsed = (grid.asi8[grid_index] - runs["launched"].values.astype("datetime64[ns]").astype(np.int64)[run_index]) / 1e9
+        working_set = 5e7 + 2e8 * (1 - np.exp(-elapsed / 30.))
+        hosts_of_runs = np.array([self.host_of(vsn, i) for i in runs["plugin_index"]], dtype=object)
+        for name, value in [
+            ("container_cpu_usage_seconds_total", runs["cpu_rate"].values[run_index] * elapsed),
+            ("container_memory_rss", working_set * 0.8),
+            ("container_memory_working_set_bytes", working_set),
+        ]:
+            dfs.append(pd.DataFrame({
+                "timestamp": grid[grid_index],
+                "name": name,
+                "value": value,
+                "meta.host": hosts_of_runs[run_index],
+                "meta.container": runs["plugin_name"].values[run_index],
+                "meta.pod": runs["k3s_pod_instance"].values[run_index],
+            }))
+        if len(dfs) == 0:
+            return empty_response()
+        df = pd.concat(dfs, ignore_index=True)
+        df["meta.node"] = self.node_of(vsn)
+        df["meta.vsn"] = vsn
+        return df
+
+    def __call__(self, start, end=None, filter=None, bucket=None, **kwargs) -> pd.DataFrame:
+        start, end = resolve_time(start), resolve_time(end)
+        vsn = filter.get("vsn", "W000") if filter is not None else "W000"
+        if bucket == "grafana-agent":
+            df = self.performance_data(vsn, start, end)
+        else:
+            df = self.scheduler_events(vsn, start, end)
+        df = match_filter(df, filter)
+        if len(df) == 0:
+            return empty_response()
+        return df.reset_index(drop=True)
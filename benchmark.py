@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+
+import io
+import json
+import time
+import logging
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from backend import SyntheticBackend, set_query_backend
+from jobstore import JobStore
+from schema import compact_frame, format_csv, bytes_per_row, to_utc_datetime
+from timeseries import TimeSeries
+from instrument import read_memory_status, reset_peak_memory
+from utils import (parse_events, fill_completion_failure, generate_job_records, calculate_cpu_utilization_from_cpuseconds,
+    generate_metrics_from_instance, generate_batch_metrics, get_run_window, get_power_series, attribute_energy, MessageBuffer,
+    sync_job_records, download_bulk_data, download_scheduler_event, DOWNLOAD_TYPE_JOB, JOB_SYNC_OVERLAP)
+
+
+PIPELINE_ROWS = [1000, 10000, 100000, 1000000]
+PIPELINE_PLUGINS = 50
+PIPELINE_INSTANCES = 100
+# Completions and failures of the last minutes are held back in the first sync of sync-overlap
+SYNC_LATE_DELAY = pd.to_timedelta(5, unit="m")
+
+
+def parse_events_iterrows(df):
+    """The row-by-row parse_events that decodes each event and re-parses them all as one JSON document."""
+    v = []
+    for _, row in df.iterrows():
+        r = json.loads(row.value)
+        r["timestamp"] = row.timestamp.isoformat()
+        r["node"] = row["meta.node"]
+        r["vsn"] = row["meta.vsn"]
+        r["event"] = row["name"]
+        v.append(r)
+    return pd.read_json(io.StringIO(json.dumps(v)))
+
+
+def make_scheduler_events(rows: int, plugins=20, vsn="W000", seed=0) -> pd.DataFrame:
+    """Generates launched events followed by complete or failed events of plugin runs."""
+    rng = np.random.default_rng(seed)
+    runs = rows // 2
+    launched_at = pd.Timestamp("2024-01-01T00:00:00Z") + pd.to_timedelta(np.sort(rng.integers(0, runs * 60, runs)), unit="s")
+    ended_at = launched_at + pd.to_timedelta(rng.integers(10, 600, runs), unit="s")
+    failed = rng.random(runs) < 0.1
+    values, names, timestamps = [], [], []
+    for i in range(runs):
+        plugin_name = f'plugin-{i % plugins}'
+        event = {
+            "plugin_name": plugin_name,
+            "plugin_task": plugin_name,
+            "plugin_image": f'registry.sagecontinuum.org/test/{plugin_name}:0.1.0',
+            "plugin_selector": json.dumps({"resource.gpu": "true"}) if i % 3 == 0 else "",
+            "k3s_pod_name": f'{plugin_name}-{i}',
+            "k3s_pod_instance": f'{plugin_name}-{i}',
+        }
+        values.append(json.dumps(event))
+        names.append("sys.scheduler.status.plugin.launched")
+        timestamps.append(launched_at[i])
+        event["k3s_pod_node_name"] = "000048b02d000000.ws-nxcore"
+        if failed[i]:
+            event["reason"] = "Error"
+            event["error_log"] = "Traceback (most recent call last)"
+            names.append("sys.scheduler.status.plugin.failed")
+        else:
+            names.append("sys.scheduler.status.plugin.complete")
+        values.append(json.dumps(event))
+        timestamps.append(ended_at[i])
+    df = pd.DataFrame({"timestamp": timestamps, "name": names, "value": values})
+    df["meta.node"] = "000048b02d000000"
+    df["meta.vsn"] = vsn
+    return df.sort_values(by="timestamp", ignore_index=True)
+
+
+def attribute_energy_per_instance(power_df, runs, column="vdd_in"):
+    """The energy of each run integrated from its own slice of the power, above the minimum of the slice."""
+    energy = []
+    for _, run in runs.iterrows():
+        df = power_df[(power_df["timestamp"] >= run.timestamp) & (power_df["timestamp"] <= run.completed_at)]
+        power = df[column] - df[column].min()
+        seconds = (df["timestamp"] - df["timestamp"].min()).dt.total_seconds()
+        energy.append(np.trapezoid(power, seconds) / 1000.)
+    return energy
+
+
+def measure(func, *args, repeat=3):
+    """Returns the best wall time in seconds out of repeat runs."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_stage(func, *args, repeat=1, memory=True) -> dict:
+    """Returns the best wall time in seconds out of repeat runs, the peak memory of the first
+    run above what was resident before, and the result of the function.
+
+    Peak memory is taken from the peak resident memory of the process on Linux. Elsewhere it
+    is traced by tracemalloc in a separate run, as tracing slows down the stage and takes
+    a lot of memory of its own for stages making many Python objects.
+    """
+    peak_bytes = None
+    rss = read_memory_status() if memory and reset_peak_memory() else None
+    started = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - started
+    if rss is not None:
+        peak_bytes = read_memory_status()["VmHWM"] - rss["VmRSS"]
+    if repeat > 1:
+        seconds = min(seconds, measure(func, *args, repeat=repeat - 1))
+    if memory and rss is None:
+        tracemalloc.start()
+        func(*args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak_bytes, "result": result}
+
+
+def head_by_timestamp(df: pd.DataFrame, rows: int) -> pd.DataFrame:
+    return df.sort_values(by="timestamp", kind="stable", ignore_index=True).head(rows)
+
+
+def make_pipeline_data(backend: SyntheticBackend, rows: int, vsn="W000"):
+    """Generates rows scheduler events and rows grafana-agent metrics of a node as download.py gets them.
+
+    The time span of each is estimated from an hour of data, and the records are cut at the
+    rows-th one in time. Returns the events, the metrics and the job records of the metrics.
+    """
+    start = SyntheticBackend.EPOCH
+    hour = pd.to_timedelta(1, unit="h")
+    spans = {}
+    for name, generate in [("events", backend.scheduler_events), ("metrics", backend.performance_data)]:
+        rate = len(generate(vsn, start, start + hour)) / hour.total_seconds()
+        # The span is padded as records are not spread evenly in time
+        span = pd.to_timedelta(max(1.2 * rows / rate, 600), unit="s").ceil("min")
+        spans[name] = head_by_timestamp(generate(vsn, start, start + span), rows)
+    events = compact_frame(spans["events"])
+    perf_df = compact_frame(spans["metrics"])
+    end = perf_df["timestamp"].max()
+    runs = generate_job_records(compact_frame(backend.scheduler_events(vsn, start, end)))
+    runs = runs[runs["end_state"] == "completed"]
+    runs = runs[to_utc_datetime(runs["completed_at"]) <= end].sort_values(by="timestamp", kind="stable", ignore_index=True)
+    return events, perf_df, runs
+
+
+def generate_cpu_utilization(runs: pd.DataFrame, windows: list) -> list:
+    """Computes the CPU utilization of each run from the performance data of its window as generate_metrics_from_instance does."""
+    out = []
+    for run, df in zip(runs.itertuples(index=False), windows):
+        df = df[(df["meta.container"] == run.plugin_name) & (df["name"] == "container_cpu_usage_seconds_total")]
+        if len(df) > 0:
+            out.append(calculate_cpu_utilization_from_cpuseconds(df.copy(), pd.to_datetime(run.timestamp)))
+    return out
+
+
+def generate_instance_metrics(runs: pd.DataFrame, windows: list) -> list:
+    return [generate_metrics_from_instance(MessageBuffer(), runs.iloc[i], windows[i]) for i in range(len(runs))]
+
+
+def get_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare_results(results: pd.DataFrame, baseline: pd.DataFrame) -> pd.DataFrame:
+    """Joins the results to those of a baseline on stage and rows with the speedup and memory ratio."""
+    df = results.merge(baseline, on=["stage", "rows"], suffixes=("", "_baseline"))
+    df["speedup"] = df["seconds_baseline"] / df["seconds"]
+    df["memory_ratio"] = df["peak_bytes"] / df["peak_bytes_baseline"]
+    return df[["stage", "rows", "seconds_baseline", "seconds", "speedup", "peak_bytes_baseline", "peak_bytes", "memory_ratio"]]
+
+
+class LateEventsBackend:
+    """Serves the queries of a backend, holding back the completions and failures newer than delay before arrived as if they had not arrived yet."""
+    def __init__(self, backend, delay=SYNC_LATE_DELAY):
+        self.backend = backend
+        self.delay = delay
+        self.arrived = None
+
+    def __call__(self, start, end=None, filter=None, bucket=None, **kwargs) -> pd.DataFrame:
+        df = self.backend(start, end, filter, bucket, **kwargs)
+        if self.arrived is None or len(df) == 0:
+            return df
+        late = df["name"].str.match(r"sys\.scheduler\.status\.plugin\.(complete|failed)") & (to_utc_datetime(df["timestamp"]) >= self.arrived - self.delay)
+        return df[~late].reset_index(drop=True)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name="memory")
+@click.option("-H", "--hours", type=int, default=24, help="Hours of synthetic data to measure. Default is 24.")
+def bench_memory(hours):
+    """Reports the bytes per row of the performance data and instance metrics before and after compacting."""
+    backend = SyntheticBackend()
+    start = SyntheticBackend.EPOCH
+    end = start + pd.to_timedelta(hours, unit="h")
+    # Frames as sage_data_client gives them: labels held as Python strings
+    perf_df = backend.performance_data("W000", start, end)
+    compact_perf_df = compact_frame(perf_df.copy())
+
+    runs = generate_job_records(backend.scheduler_events("W000", start, end))
+    runs = runs[runs["end_state"] == "completed"]
+    metrics = generate_batch_metrics(runs, compact_perf_df)
+    # Instance metrics as they were held before: ISO timestamp strings and float64 metrics
+    legacy_metrics = format_csv(metrics).astype({c: float for c in ["cpu", "mem", "sys_power", "cpugpu_power"]})
+    legacy_metrics = legacy_metrics.astype({c: object for c in ["plugin_instance", "device"]})
+
+    results = [
+        {"frame": "performance data", "rows": len(perf_df), "before_bytes_per_row": bytes_per_row(perf_df), "after_bytes_per_row": bytes_per_row(compact_perf_df)},
+        {"frame": "instance metrics", "rows": len(metrics), "before_bytes_per_row": bytes_per_row(legacy_metrics), "after_bytes_per_row": bytes_per_row(metrics)},
+    ]
+    for r in results:
+        r["reduction"] = r["before_bytes_per_row"] / r["after_bytes_per_row"]
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+
+@cli.command(name="energy")
+@click.option("-H", "--hours", multiple=True, type=int, default=[6, 24], help="Hours of synthetic data sampled every second. Can be given multiple times.")
+@click.option("-r", "--repeat", type=int, default=3, help="Number of repeats per measurement. The best is reported.")
+def bench_energy(hours, repeat):
+    """Compares attributing energy to runs one at a time and all at once with attribute_energy."""
+    backend = SyntheticBackend(sample_interval="1s")
+    results = []
+    for h in hours:
+        start = SyntheticBackend.EPOCH
+        end = start + pd.to_timedelta(h, unit="h")
+        power_df = get_power_series(backend.performance_data("W000", start, end), host="nxcore")
+        runs = generate_job_records(backend.scheduler_events("W000", start, end))
+        runs = runs[runs["end_state"] == "completed"]
+        runs = runs.assign(timestamp=pd.to_datetime(runs["timestamp"], utc=True, format="ISO8601"), completed_at=pd.to_datetime(runs["completed_at"], utc=True, format="ISO8601"))
+        before = measure(attribute_energy_per_instance, power_df, runs, repeat=repeat)
+        after = measure(attribute_energy, power_df, runs, repeat=repeat)
+        results.append({
+            "samples": len(power_df),
+            "runs": len(runs),
+            "before_runs_per_sec": len(runs) / before,
+            "after_runs_per_sec": len(runs) / after,
+            "speedup": before / after,
+        })
+        logging.info(f'{len(runs)} runs over {len(power_df)} samples: {before:.2f}s before, {after:.2f}s after')
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+
+@cli.command(name="slice")
+@click.option("-d", "--days", type=int, default=30, help="Days of stats sampled every second. Default is 30.")
+@click.option("-k", "--intervals", multiple=True, type=int, default=[100, 1000], help="Number of time ranges sliced. Can be given multiple times.")
+def bench_slice(days, intervals):
+    """Compares slicing a stats table by time ranges with boolean masks and with TimeSeries."""
+    rng = np.random.default_rng(0)
+    timestamps = pd.date_range(SyntheticBackend.EPOCH, periods=days * 86400, freq="s")
+    stats = pd.DataFrame({"timestamp": timestamps, "rpi_power": rng.normal(3.5, 0.5, len(timestamps))})
+    series = TimeSeries(stats)
+    results = []
+    for k in intervals:
+        starts = SyntheticBackend.EPOCH + pd.to_timedelta(np.sort(rng.integers(0, days * 86400, k)), unit="s")
+        ends = starts + pd.to_timedelta(rng.integers(10, 600, k), unit="s")
+        before = measure(lambda: [stats[(stats["timestamp"] >= s) & (stats["timestamp"] <= e)] for s, e in zip(starts, ends)], repeat=1)
+        after = measure(lambda: series.slices(starts, ends), repeat=1)
+        results.append({
+            "rows": len(stats),
+            "intervals": k,
+            "before_intervals_per_sec": k / before,
+            "after_intervals_per_sec": k / after,
+            "speedup": before / after,
+        })
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+
+@cli.command(name="parse-events")
+@click.option("-n", "--rows", multiple=True, type=int, default=[1000, 10000, 100000], help="Number of scheduler events to parse. Can be given multiple times.")
+@click.option("-r", "--repeat", type=int, default=3, help="Number of repeats per measurement. The best is reported.")
+def bench_parse_events(rows, repeat):
+    results = []
+    for n in rows:
+        df = make_scheduler_events(n)
+        before = measure(parse_events_iterrows, df, repeat=repeat)
+        after = measure(parse_events, df, repeat=repeat)
+        results.append({
+            "rows": len(df),
+            "before_rows_per_sec": len(df) / before,
+            "after_rows_per_sec": len(df) / after,
+            "speedup": before / after,
+        })
+        logging.info(f'{len(df)} rows: {len(df) / before:.0f} rows/s before, {len(df) / after:.0f} rows/s after')
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+
+@cli.command(name="pipeline")
+@click.option("-n", "--rows", multiple=True, type=int, default=PIPELINE_ROWS, help=f'Number of scheduler events and of grafana-agent metrics, e.g. up to 10000000. Can be given multiple times. Default is {PIPELINE_ROWS}.')
+@click.option("-p", "--plugins", type=int, default=PIPELINE_PLUGINS, help=f'Number of plugins running on the node. Default is {PIPELINE_PLUGINS}.')
+@click.option("-i", "--instances", type=int, default=PIPELINE_INSTANCES, help=f'Number of instances processed one at a time by the per-instance stages. Default is {PIPELINE_INSTANCES}.')
+@click.option("-r", "--repeat", type=int, default=1, help="Number of repeats per measurement. The best is reported.")
+@click.option("--no-memory", is_flag=True, help="Do not measure the peak memory of the stages.")
+@click.option("-o", "--output", type=Path, default=None, help="Path to save the results in JSON. Default is pipeline-<commit>.json.")
+@click.option("-b", "--baseline", type=Path, default=None, help="Results saved earlier, e.g. at another commit, to compare with.")
+def bench_pipeline(rows, plugins, instances, repeat, no_memory, output, baseline):
+    """Measures the time and peak memory of each stage of the ingestion pipeline on synthetic data of growing size."""
+    backend = SyntheticBackend(plugins=plugins)
+    commit = get_commit()
+    results = []
+    for n in sorted(rows):
+        events, perf_df, runs = make_pipeline_data(backend, n)
+        logging.info(f'{n} rows: {len(events)} events and {len(perf_df)} metrics of {len(runs)} completed runs generated')
+        parsed = parse_events(events)
+        # Per-instance stages process evenly spaced runs with the slices of their windows
+        sampled = runs.iloc[np.unique(np.linspace(0, len(runs) - 1, min(instances, len(runs))).astype(int))] if len(runs) > 0 else runs
+        series = TimeSeries(perf_df)
+        windows = [series.slice(*get_run_window(run), inclusive="left") for _, run in sampled.iterrows()]
+        stages = [
+            ("parse_events", parse_events, [events], len(events)),
+            ("fill_completion_failure", fill_completion_failure, [parsed], len(parsed)),
+            ("generate_job_records", lambda df: generate_job_records(df.copy()), [events], len(events)),
+            ("calculate_cpu_utilization_from_cpuseconds", generate_cpu_utilization, [sampled, windows], sum(len(w) for w in windows)),
+            ("generate_metrics_from_instance", generate_instance_metrics, [sampled, windows], sum(len(w) for w in windows)),
+            ("generate_batch_metrics", generate_batch_metrics, [runs, perf_df], len(perf_df)),
+        ]
+        for stage, func, args, rows_in in stages:
+            m = measure_stage(func, *args, repeat=repeat, memory=not no_memory)
+            out = m["result"]
+            results.append({
+                "stage": stage,
+                "rows": n,
+                "rows_in": rows_in,
+                "rows_out": sum(len(df) for df in out) if isinstance(out, list) else len(out),
+                "instances": len(sampled) if isinstance(out, list) else None,
+                "seconds": m["seconds"],
+                "rows_per_sec": rows_in / m["seconds"] if m["seconds"] > 0 else float("inf"),
+                "peak_bytes": m["peak_bytes"],
+            })
+            logging.info(f'{n} rows: {stage} took {m["seconds"]:.3f}s' + ("" if no_memory else f' and {m["peak_bytes"] / 1e6:.1f} MB'))
+
+    if output is None:
+        output = Path(f'pipeline-{commit}.json')
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "created": pd.Timestamp.now(tz="UTC").isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "plugins": plugins,
+            "repeat": repeat,
+            "memory": None if no_memory else "rss" if read_memory_status() is not None and reset_peak_memory() else "tracemalloc",
+            "results": results,
+        }, f, indent=2)
+    logging.info(f'Saved the results to {output}')
+
+    df = pd.DataFrame(results)
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            d = json.load(f)
+        logging.info(f'Comparing with {baseline} of commit {d["commit"]}')
+        df = compare_results(df, pd.DataFrame(d["results"]))
+    print(df.to_string(index=False, float_format=lambda x: f'{x:.3f}'))
+
+
+@cli.command(name="sync-overlap")
+@click.option("-H", "--hours", type=int, default=2, help="Hours of scheduler events fetched by the first sync. Default is 2.")
+def check_sync_overlap(hours):
+    """Checks that a second job --sync, with and without --bulk, fetches the completions that arrived late within the overlap with the first."""
+    backend = LateEventsBackend(SyntheticBackend())
+    set_query_backend(backend)
+    results = []
+    for bulk in [False, True]:
+        with tempfile.TemporaryDirectory() as root:
+            def download(vsn, start, end, refresh=False):
+                if bulk:
+                    return download_bulk_data(DOWNLOAD_TYPE_JOB, download_scheduler_event, vsn, start, end, refresh_from=start if refresh else None, root=Path(root))
+                return download_scheduler_event(vsn, start, end)
+
+            store = JobStore("W000", Path(root))
+            now = pd.Timestamp.now(tz="UTC")
+            backend.arrived = now
+            first = sync_job_records(store, download, now - pd.to_timedelta(hours, unit="h"), now)
+            backend.arrived = None
+            second = sync_job_records(store, download, now, pd.Timestamp.now(tz="UTC"))
+        unknown = set(first.loc[first["end_state"] == "unknown", "k3s_pod_instance"])
+        caught = second[second["k3s_pod_instance"].isin(unknown) & (second["end_state"] != "unknown")]
+        results.append({"bulk": bulk, "records": len(second), "unknown_after_first": len(unknown), "ended_in_second": len(caught), "states": second.set_index("k3s_pod_instance")["end_state"]})
+    df = pd.DataFrame(results)
+    print(df.drop(columns=["states"]).to_string(index=False))
+    plain, bulk = df["states"]
+    if not plain.sort_index().equals(bulk.sort_index()):
+        raise Exception("The end states of the runs synced with --bulk differ from those synced without it.")
+    if df["ended_in_second"].min() == 0:
+        raise Exception(f'No completion held back within the overlap of {JOB_SYNC_OVERLAP} was fetched by the second sync.')
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
+
+    cli()
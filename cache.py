@@ -0,0 +1,446 @@
+"""Columnar on-disk cache of the data downloaded from Waggle cloud.
+
+Downloaded data are stored in Parquet files partitioned by VSN, download type, and date,
+
+    ~/.waggle/<vsn>/<download_type>/<key>/date=<YYYY-MM-DD>/<start>_<end>.parquet
+
+where the key identifies the bucket and the metric filter of the query. A manifest.json
+next to the partitions records the time range covered by each file so that a query for
+any sub-range reads only the files overlapping with it. Data downloaded in chunks are
+stored in a directory of one file per chunk in place of the file. The manifest also remembers the
+length of the download windows that suited the volume of the data, so that later
+downloads of the same data split their ranges the same way.
+
+Records may arrive late, so an entry ending within CACHE_SETTLE_MARGIN of the time it is
+written, e.g. the last window of a download up to now, is recorded as provisional. Its
+data are read like the others but its range counts as missing, so that it is downloaded
+again and replaced by the next download covering it.
+
+Files are written to a temporary path and renamed once complete, and the manifest records
+the size and SHA-256 checksum of each entry along with when it was last read. Entries
+whose files are missing or of another size, e.g. after an interrupted run, are dropped
+when the manifest is loaded so that they are downloaded again. CacheManager goes through
+the caches of all VSNs to inspect, verify, and evict entries by age or, least recently
+used first, down to a size budget.
+"""
+import io
+import json
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+CACHE_ROOT = Path.home().joinpath(".waggle")
+MANIFEST_FILENAME = "manifest.json"
+# Records of the last minutes may still arrive, so ranges ending within this of now are not final
+CACHE_SETTLE_MARGIN = pd.to_timedelta(10, unit='m')
+
+
+def make_cache_key(bucket, name_filter: str) -> str:
+    string = f'{bucket},{name_filter}'
+    return hashlib.md5(string.encode()).hexdigest()[:12]
+
+
+def to_utc(t) -> pd.Timestamp:
+    t = pd.Timestamp(t)
+    return t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+
+
+def now() -> pd.Timestamp:
+    return pd.Timestamp.now(tz="UTC")
+
+
+def write_parquet(df: pd.DataFrame, path: Path, hasher=None) -> int:
+    """Writes the frame to path atomically. Returns the number of bytes written, which are also fed to hasher if given."""
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False, engine="pyarrow")
+    data = buffer.getvalue()
+    if hasher is not None:
+        hasher.update(data)
+    tmp_path = Path(path).with_name(Path(path).name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def entry_files(path: Path) -> list:
+    """Returns the files of an entry in the order their checksum is computed."""
+    return sorted(path.glob("part-*.parquet")) if path.is_dir() else [path]
+
+
+def checksum_files(files: list) -> str:
+    hasher = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def subtract_ranges(start, end, ranges):
+    """Returns the parts of [start, end) not covered by the sorted, non-overlapping ranges."""
+    gaps = []
+    for s, e in ranges:
+        if e <= start or s >= end:
+            continue
+        if s > start:
+            gaps.append((start, s))
+        start = max(start, e)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class PartitionedCache:
+    def __init__(self, vsn: str, download_type: str, bucket=None, name_filter="", root: Path = CACHE_ROOT):
+        self.vsn = vsn
+        self.download_type = download_type
+        self.bucket = bucket
+        self.name_filter = name_filter
+        self.key = make_cache_key(bucket, name_filter)
+        self.path = Path(root).joinpath(vsn, download_type, self.key)
+        self.manifest_path = self.path.joinpath(MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.entries = []
+        self.window = None
+        self.load_manifest()
+
+    def load_manifest(self):
+        if not self.manifest_path.exists():
+            return
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        entries, dropped = [], []
+        for entry in manifest["entries"]:
+            entry["start"] = to_utc(entry["start"])
+            entry["end"] = to_utc(entry["end"])
+            if not self.is_intact(entry):
+                dropped.append(entry)
+                continue
+            entries.append(entry)
+        self.entries = sorted(entries, key=lambda x: x["start"])
+        if manifest.get("window") is not None:
+            self.window = pd.to_timedelta(manifest["window"], unit="s")
+        if len(dropped) > 0:
+            logging.warning(f'{self.path}: Dropping {len(dropped)} entries whose files are missing or incomplete. They will be downloaded again.')
+            self.save_manifest()
+            for entry in dropped:
+                self.remove_entry_files(entry["path"])
+
+    def is_intact(self, entry) -> bool:
+        """Checks that the files of the entry exist with the recorded size. Entries recorded before sizes were are trusted."""
+        if entry["path"] is None:
+            return True
+        path = self.path.joinpath(entry["path"])
+        if not path.exists():
+            return False
+        if entry.get("bytes") is None:
+            return True
+        return sum(f.stat().st_size for f in entry_files(path)) == entry["bytes"]
+
+    def save_manifest(self):
+        manifest = {
+            "vsn": self.vsn,
+            "download_type": self.download_type,
+            "bucket": self.bucket,
+            "filter": self.name_filter,
+            "window": None if self.window is None else self.window.total_seconds(),
+            "entries": [{**e, "start": e["start"].isoformat(), "end": e["end"].isoformat()} for e in self.entries],
+        }
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def covered(self):
+        """Returns the ranges cached for good, leaving out the provisional ones."""
+        return [(e["start"], e["end"]) for e in self.entries if not e.get("provisional")]
+
+    def missing(self, start, end) -> list:
+        """Returns the sub-ranges of [start, end) that have not been cached."""
+        with self.lock:
+            return subtract_ranges(to_utc(start), to_utc(end), self.covered())
+
+    def new_entry(self, start, end) -> dict:
+        t = now()
+        return {"start": start, "end": end, "path": None, "rows": 0, "bytes": 0, "checksum": None, "created": t.isoformat(), "accessed": t.isoformat(),
+            "provisional": bool(end > t - CACHE_SETTLE_MARGIN)}
+
+    def add_entry(self, entry):
+        """Records the entry in the manifest in place of the provisional entries overlapping with it."""
+        with self.lock:
+            stale = [e for e in self.entries if e.get("provisional") and e["start"] < entry["end"] and e["end"] > entry["start"]]
+            self.entries = [e for e in self.entries if not any(e is x for x in stale)] + [entry]
+            self.entries.sort(key=lambda x: x["start"])
+            self.save_manifest()
+            # Files are removed only after the manifest stops referring to them
+            for e in stale:
+                if e["path"] != entry["path"]:
+                    self.remove_entry_files(e["path"])
+
+    def write_partition(self, start, end, df: pd.DataFrame) -> dict:
+        entry = self.new_entry(start, end)
+        entry["rows"] = len(df)
+        if len(df) > 0:
+            partition = self.path.joinpath(f'date={start.strftime("%Y-%m-%d")}')
+            os.makedirs(partition, exist_ok=True)
+            filepath = partition.joinpath(f'{start.strftime("%Y%m%dT%H%M%S%f")}_{end.strftime("%Y%m%dT%H%M%S%f")}.parquet')
+            hasher = hashlib.sha256()
+            entry["bytes"] = write_parquet(df, filepath, hasher)
+            entry["checksum"] = hasher.hexdigest()
+            entry["path"] = str(filepath.relative_to(self.path))
+        return entry
+
+    def invalidate(self, start) -> int:
+        """Removes the entries holding data from start on, so that they are downloaded again. Returns the number of entries removed."""
+        start = to_utc(start)
+        with self.lock:
+            stale = [e for e in self.entries if e["end"] > start]
+            self.entries = [e for e in self.entries if e["end"] <= start]
+            self.save_manifest()
+            for e in stale:
+                self.remove_entry_files(e["path"])
+        return len(stale)
+
+    def write(self, start, end, df: pd.DataFrame):
+        """Stores the data downloaded for [start, end) and records the range in the manifest."""
+        entry = self.write_partition(to_utc(start), to_utc(end), df)
+        self.add_entry(entry)
+        return entry["path"]
+
+    def write_chunks(self, start, end, chunks):
+        """Stores the chunks of data downloaded for [start, end) as they arrive, one file per chunk.
+
+        The files are kept in a directory recorded as one entry in the manifest once all the
+        chunks are stored. Returns the path of the directory and the number of records.
+        """
+        start, end = to_utc(start), to_utc(end)
+        dirpath = self.path.joinpath(f'date={start.strftime("%Y-%m-%d")}', f'{start.strftime("%Y%m%dT%H%M%S%f")}_{end.strftime("%Y%m%dT%H%M%S%f")}')
+        # The chunks are written in a temporary directory renamed once all of them are written
+        tmp_path = dirpath.with_name(dirpath.name + ".tmp")
+        for path in [dirpath, tmp_path]:
+            if path.exists():
+                shutil.rmtree(path)
+        os.makedirs(tmp_path)
+        entry = self.new_entry(start, end)
+        hasher = hashlib.sha256()
+        parts = 0
+        try:
+            for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                entry["bytes"] += write_parquet(chunk, tmp_path.joinpath(f'part-{parts:05d}.parquet'), hasher)
+                entry["rows"] += len(chunk)
+                parts += 1
+        except BaseException:
+            shutil.rmtree(tmp_path)
+            raise
+        if entry["rows"] > 0:
+            os.replace(tmp_path, dirpath)
+            entry["path"] = str(dirpath.relative_to(self.path))
+            entry["checksum"] = hasher.hexdigest()
+        else:
+            shutil.rmtree(tmp_path)
+        self.add_entry(entry)
+        return entry["path"], entry["rows"]
+
+    def read_entry(self, entry, filters=None) -> pd.DataFrame:
+        path = self.path.joinpath(entry["path"])
+        # Chunks of an entry may have different meta columns so they are read one by one
+        files = sorted(path.glob("part-*.parquet")) if path.is_dir() else [path]
+        dfs = [pq.read_table(f, memory_map=True, filters=filters).to_pandas() for f in files]
+        return dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+
+    def remove_entry_files(self, path):
+        if path is None:
+            return
+        path = self.path.joinpath(path)
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            os.remove(path)
+        # The date partition is removed along with its last entry
+        partition = path.parent
+        if partition != self.path and partition.is_dir() and not any(partition.iterdir()):
+            partition.rmdir()
+
+    def remove_entries(self, entries: list) -> int:
+        """Removes the entries from the manifest and their files. Returns the number of bytes freed."""
+        paths = set(e["path"] for e in entries)
+        with self.lock:
+            removed = [e for e in self.entries if e["path"] in paths]
+            self.entries = [e for e in self.entries if e["path"] not in paths]
+            self.save_manifest()
+            for e in removed:
+                self.remove_entry_files(e["path"])
+        return sum(e.get("bytes") or 0 for e in removed)
+
+    def verify(self) -> list:
+        """Returns the entries whose files do not match their recorded checksum. Entries without a checksum are not checked."""
+        with self.lock:
+            entries = list(self.entries)
+        corrupted = []
+        for e in entries:
+            if e["path"] is None or e.get("checksum") is None:
+                continue
+            path = self.path.joinpath(e["path"])
+            if not path.exists() or checksum_files(entry_files(path)) != e["checksum"]:
+                corrupted.append(e)
+        return corrupted
+
+    def size(self) -> int:
+        return sum(e.get("bytes") or 0 for e in self.entries)
+
+    def remember_window(self, window: pd.Timedelta):
+        with self.lock:
+            self.window = window
+            self.save_manifest()
+
+    def merge(self, max_rows: int) -> int:
+        """Merges runs of adjacent entries into one file as long as the merged one has no more than max_rows records.
+
+        Entries are merged only within the day of their date partition, and provisional ones
+        are not merged. Returns the number of entries removed by merging.
+        """
+        with self.lock:
+            groups = []
+            for e in self.entries:
+                last = groups[-1] if len(groups) > 0 else None
+                day = None if last is None else last[0]["start"].floor("D")
+                if (last is not None and last[-1]["end"] == e["start"] and sum(x["rows"] for x in last) + e["rows"] <= max_rows
+                        and e["end"] <= day + pd.Timedelta(days=1) and not e.get("provisional") and not last[-1].get("provisional")):
+                    last.append(e)
+                else:
+                    groups.append([e])
+            if all(len(group) == 1 for group in groups):
+                return 0
+
+            entries, removed = [], []
+            for group in groups:
+                if len(group) == 1:
+                    entries.append(group[0])
+                    continue
+                dfs = [self.read_entry(e) for e in group if e["path"] is not None]
+                df = pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+                entries.append(self.write_partition(group[0]["start"], group[-1]["end"], df))
+                removed += [e["path"] for e in group if e["path"] is not None]
+            self.entries = entries
+            self.save_manifest()
+            # Files are removed only after the manifest stops referring to them
+            kept = set(e["path"] for e in entries)
+            for path in removed:
+                if path not in kept:
+                    self.remove_entry_files(path)
+            return sum(len(group) - 1 for group in groups)
+
+    def read(self, start, end) -> pd.DataFrame:
+        """Reads the cached data in [start, end) from the partitions overlapping with the range."""
+        dfs = list(self.iter_read(start, end))
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def iter_read(self, start, end):
+        """Yields the cached data in [start, end) one entry at a time in time order."""
+        start, end = to_utc(start), to_utc(end)
+        with self.lock:
+            entries = [e for e in self.entries if e["start"] < end and e["end"] > start and e["path"] is not None]
+            if len(entries) > 0:
+                accessed = now().isoformat()
+                for e in entries:
+                    e["accessed"] = accessed
+                self.save_manifest()
+        for e in entries:
+            filters = None
+            if e["start"] < start or e["end"] > end:
+                filters = [("timestamp", ">=", start), ("timestamp", "<", end)]
+            yield self.read_entry(e, filters)
+
+
+class CacheManager:
+    """Maintains the caches of all VSNs and download types under the root."""
+    def __init__(self, root: Path = CACHE_ROOT):
+        self.root = Path(root)
+
+    def caches(self, vsns=None) -> list:
+        caches = []
+        for manifest_path in sorted(self.root.glob(f'*/*/*/{MANIFEST_FILENAME}')):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            if vsns is not None and manifest["vsn"].upper() not in vsns:
+                continue
+            caches.append(PartitionedCache(manifest["vsn"], manifest["download_type"], manifest["bucket"], manifest["filter"], self.root))
+        return caches
+
+    def entries(self, vsns=None) -> pd.DataFrame:
+        """Returns the entries of the caches with their cache, size, and when they were created and last read."""
+        rows = []
+        for cache in self.caches(vsns):
+            for e in cache.entries:
+                rows.append({
+                    "vsn": cache.vsn,
+                    "download_type": cache.download_type,
+                    "key": cache.key,
+                    "start": e["start"],
+                    "end": e["end"],
+                    "rows": e["rows"],
+                    "bytes": e.get("bytes") or 0,
+                    "created": to_utc(e["created"]) if e.get("created") else pd.NaT,
+                    "accessed": to_utc(e["accessed"]) if e.get("accessed") else pd.NaT,
+                    "path": e["path"],
+                    "cache": cache,
+                })
+        return pd.DataFrame(rows, columns=["vsn", "download_type", "key", "start", "end", "rows", "bytes", "created", "accessed", "path", "cache"])
+
+    def inspect(self, vsns=None) -> pd.DataFrame:
+        """Returns a summary of the caches."""
+        entries = self.entries(vsns)
+        if len(entries) == 0:
+            return pd.DataFrame(columns=["vsn", "download_type", "key", "entries", "rows", "mb", "start", "end", "accessed"])
+        summary = entries.groupby(["vsn", "download_type", "key"], sort=True).agg(
+            entries=("rows", "size"),
+            rows=("rows", "sum"),
+            mb=("bytes", lambda x: x.sum() / 2**20),
+            start=("start", "min"),
+            end=("end", "max"),
+            accessed=("accessed", "max"))
+        return summary.reset_index()
+
+    def verify(self, vsns=None, repair=False) -> pd.DataFrame:
+        """Returns the entries not matching their checksum, removing them if repair is given."""
+        rows = []
+        for cache in self.caches(vsns):
+            corrupted = cache.verify()
+            rows += [{"vsn": cache.vsn, "download_type": cache.download_type, "start": e["start"], "end": e["end"], "path": str(cache.path.joinpath(e["path"]))} for e in corrupted]
+            if repair and len(corrupted) > 0:
+                cache.remove_entries(corrupted)
+        return pd.DataFrame(rows, columns=["vsn", "download_type", "start", "end", "path"])
+
+    def prune(self, max_bytes=None, max_age=None, vsns=None, dry_run=False) -> pd.DataFrame:
+        """Evicts the entries not read for longer than max_age, and then the least recently read ones until the caches take no more than max_bytes.
+
+        Returns the evicted entries.
+        """
+        entries = self.entries(vsns).sort_values(by="accessed", kind="stable", na_position="first", ignore_index=True)
+        evict = pd.Series(False, index=entries.index)
+        if max_age is not None:
+            evict |= entries["accessed"].isna() | (entries["accessed"] < now() - pd.to_timedelta(max_age))
+        if max_bytes is not None:
+            # Sizes of the entries kept, summed from the most recently read one
+            kept = entries["bytes"].where(~evict, 0)
+            evict |= kept[::-1].cumsum()[::-1] > max_bytes
+        evicted = entries[evict & entries["path"].notna()]
+        if not dry_run:
+            for _, group in evicted.groupby(["vsn", "download_type", "key"], sort=False):
+                cache = group["cache"].iloc[0]
+                freed = cache.remove_entries(group.to_dict("records"))
+                logging.info(f'{cache.vsn}: Evicted {len(group)} {cache.download_type} entries of {freed / 2**20:.1f} MB from {cache.path}.')
+        return evicted.drop(columns=["cache"])
@@ -4,77 +4,315 @@ import logging
 import argparse
 
 from utils import *
+from sink import SINKS
+from cache import CacheManager, to_utc
+from jobstore import JobStore
+from sketch import ResourceProfile
+from backend import set_query_backend, get_query_backend, RecordingBackend, ReplayBackend, SyntheticBackend
+from instrument import trace
+from governor import MemoryGovernor
 
 @click.group()
-def cli():
-    pass
+@click.option("--record", type=Path, default=None, help="Save the responses of the queries to the directory so that they can be replayed later.")
+@click.option("--replay", type=Path, default=None, help="Serve the queries from the responses saved in the directory by --record instead of querying Sage.")
+@click.option("--synthetic", is_flag=True, default=False, help="Serve the queries with synthetic data instead of querying Sage.")
+@click.option("--trace", "trace_path", type=Path, default=None, help="Trace the wall time, rows in and out, and peak memory of the stages per VSN, plugin and instance, and save the trace to the path in JSON, or in CSV if the path ends with .csv. The stages taking the most time are printed at the end.")
+@click.pass_context
+def cli(ctx, record, replay, synthetic, trace_path):
+    if synthetic:
+        backend = SyntheticBackend()
+    elif replay is not None:
+        backend = ReplayBackend(replay)
+    else:
+        backend = get_query_backend()
+    if record is not None:
+        backend = RecordingBackend(record, backend)
+    set_query_backend(backend)
+    if trace_path is not None:
+        tracer = start_trace()
+        ctx.call_on_close(lambda: finish_trace(tracer, trace_path))
 
 @cli.command()
-@click.option("-v", "--vsn", required=True, type=str, help="VSN of the node.")
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node. Can be given multiple times to download from multiple nodes.")
+@click.option("--vsn-file", type=Path, default=None, help="Path to a file listing VSNs of the nodes, one per line.")
 @click.option("-s", "--start", required=True, help="Start time of the query in UTC, e.g. 1h, 10d, 2024-01-01T00:00:00Z")
 @click.option("-e", "--end", default="", help="End time of the query in UTC, e.g. 1h, 10d, 2024-01-02T00:00:00Z")
 @click.option("-o", "--output", type=Path, default=Path("jobs.csv"), help="Path to save the downloaded data. Default is jobs.csv")
+@click.option("-d", "--data-dir", type=Path, default=None, help="Save the output of each node to <data-dir>/<VSN>/ under the file name of --output. Default is data when multiple nodes are given.")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=4, help="Maximum number of nodes processed at the same time. Default is 4.")
 @click.option("-b", "--bulk", is_flag=True, default=False, help="Enable downloading data in splits. This helps lowering server-side loads when downloading with a large time window such as months. The default time window in the split is day.")
-def job(vsn, start, end, output, bulk):
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=1, help="Number of splits downloaded in parallel when --bulk is enabled. Default is 1.")
+@click.option("--window", default="1D", help="Length of the splits when --bulk is enabled, e.g. 6h, 1D, 7D. The length learned from the volume of earlier downloads of the node is used instead if any. Default is 1D.")
+@click.option("--max-rows", type=click.IntRange(min=1), default=DOWNLOAD_MAX_ROWS, help=f'Maximum number of records in a split when --bulk is enabled. Larger splits are halved. Default is {DOWNLOAD_MAX_ROWS}.')
+@click.option("--memory-budget", type=click.FloatRange(min=0, min_open=True), default=None, help="Download the splits in chunks, storing each to the cache as it arrives, and build the job records from the cache one split at a time, so that no more than about this many MB of events are held in memory when --bulk is enabled. Default is no limit.")
+@click.option("--rate-limit", type=click.FloatRange(min=0, min_open=True), default=None, help="Maximum number of queries per second sent to the Sage server when --bulk is enabled. The limit is shared by all nodes. Default is no limit.")
+@click.option("--sync", is_flag=True, default=False, help="Keep the job records of the VSN in a local store and fetch only the events newer than the last sync. --start is used only for the first sync.")
+@click.option("--cache-max-size", type=click.FloatRange(min=0), default=None, help="Evict the least recently used data from the cache in ~/.waggle after downloading until it takes no more than this many MB. Default is no limit.")
+def job(vsns, vsn_file, start, end, output, data_dir, concurrency, bulk, workers, window, max_rows, memory_budget, rate_limit, sync, cache_max_size):
+    vsns = read_vsns(vsns, vsn_file)
+    if len(vsns) == 0:
+        raise click.UsageError("Give at least one VSN with --vsn or --vsn-file.")
     start_t, err = parse_time(start)
     end_t, err = parse_time(end)
     logging.info(f'Query ranges from {start_t} to {end_t}.')
-    if bulk:
-        logging.info("Bulk download enabled.")
-        df = download_bulk_data(
-            DOWNLOAD_TYPE_JOB,
-            download_scheduler_event,
-            vsn,
-            start_t,
-            end_t)
-    else:
-        df = download_scheduler_event(vsn, start_t, end_t)
 
-    logging.info(f'{len(df)} records found.')
-    if len(df) == 0:
-        logging.info(f'Query {vsn} {start_t} {end_t} returned 0 records.')
+    def download(vsn, start_t, end_t, refresh=False, load=True):
+        if bulk:
+            logging.info("Bulk download enabled.")
+            return download_bulk_data(
+                DOWNLOAD_TYPE_JOB,
+                download_scheduler_event,
+                vsn,
+                start_t,
+                end_t,
+                window=window,
+                workers=workers,
+                rate_limit=rate_limit,
+                max_rows=max_rows,
+                memory_budget=None if memory_budget is None else int(memory_budget * 2**20),
+                load=load,
+                refresh_from=start_t if refresh else None)
+        return download_scheduler_event(vsn, start_t, end_t)
+
+    def download_jobs(vsn, output):
+        if sync:
+            out_df = sync_job_records(JobStore(vsn), download, start_t, end_t)
+            if len(out_df) == 0:
+                logging.info(f'No job records of {vsn} found.')
+                return 0
+            with trace("write_csv", rows_in=len(out_df)):
+                out_df.to_csv(output, index=False)
+            logging.info(f'Created {output} with {len(out_df)} records. Done.')
+            return len(out_df)
+
+        if bulk and memory_budget is not None:
+            # The events are parsed from the cache one split at a time instead of all at once
+            cache = download(vsn, start_t, end_t, load=False)
+            logging.info(f'{vsn}: Parsing the records in the cache.')
+            out_df = generate_job_records_from_cache(cache, start_t, end_t)
+            if len(out_df) == 0:
+                logging.info(f'Query {vsn} {start_t} {end_t} returned 0 records.')
+                return 0
+        else:
+            df = download(vsn, start_t, end_t)
+
+            logging.info(f'{vsn}: {len(df)} records found.')
+            if len(df) == 0:
+                logging.info(f'Query {vsn} {start_t} {end_t} returned 0 records.')
+                return 0
+
+            logging.info(f'{vsn}: Parsing the records.')
+            out_df = generate_job_records(df)
+        with trace("write_csv", rows_in=len(out_df)):
+            out_df.to_csv(output, index=False)
+        logging.info(f'Created {output}. Done.')
+        return len(out_df)
+
+    if len(vsns) == 1 and data_dir is None:
+        download_jobs(vsns[0], output)
+        prune_cache(cache_max_size)
         return 0
 
-    logging.info(f'Parsing the records.')
-    out_df = generate_job_records(df)
-    out_df.to_csv(output, index=False)
-    logging.info(f'Created {output}. Done.')
+    data_dir = Path("data") if data_dir is None else data_dir
+    def download_node_jobs(vsn):
+        os.makedirs(data_dir.joinpath(vsn), exist_ok=True)
+        return download_jobs(vsn, data_dir.joinpath(vsn, output.name))
+
+    summary = run_fleet(vsns, download_node_jobs, concurrency)
+    report_fleet(summary)
+    prune_cache(cache_max_size)
+    if (summary["status"] == "failed").any():
+        exit(1)
 
 
 @cli.command()
-@click.option("-i", "--input", required=True, type=Path, default=Path("jobs.csv"), help="Path to the job list in CSV. Default is ./jobs.csv")
-@click.option("-r", "--resume", is_flag=True, default=False, help="Skip downloading if exists locally. It is useful when resuming downloading from where it left off.")
+@click.option("-i", "--input", type=Path, default=Path("jobs.csv"), help="Path to the job list in CSV. Default is ./jobs.csv")
+@click.option("-r", "--resume", is_flag=True, default=False, help="Skip downloading instances already written to the outputs, as recorded in the journal in the output directory. It is useful when resuming downloading from where it left off.")
 @click.option("-o", "--output-dir", type=Path, default=Path("./"), help="Path to save the downloaded data. Default is the current directory.")
-def perf(input, resume, output_dir):
-    logging.info(f'Reading job data from {input}.')
-    df = pd.read_csv(input)
-
-    logging.info(f'Output directory is {output_dir}.')
-
-    logging.info("We consider only successfully completed runs, not the ones that are failed or unknown")
-    completed_runs = df[df["end_state"] == "completed"]
-    logging.info(f'{len(completed_runs)} completed runs found.')
-    logging.info(f'Completed runs by plugin name are {completed_runs.groupby("plugin_task").size()}')
-
-    # logging.info("Sorting the runs by plugin_name")
-    # completed_runs = completed_runs.sort_values(by="plugin_name")
-
-    for plugin_name, runs in completed_runs.groupby("plugin_name"):
-        logging.info(f'Downloading metrics for {plugin_name}')
-        plugin_df = pd.DataFrame()
-        plugin_output_path = output_dir.joinpath(f'{plugin_name}.csv')
-        if plugin_output_path.exists() and resume:
-            logging.info(f'{plugin_output_path} already exists. --resume is enabled. Skipping.')
-            continue
-
-        total_iteration = len(runs)
-        t = tqdm(range(total_iteration))
-        for i in t:
-            run = runs.iloc[i]
-            run_df = generate_metrics_from_instance(t, run)
-            plugin_df = pd.concat([plugin_df, run_df])
-        plugin_df.to_csv(plugin_output_path, index=False)
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node whose job list is <data-dir>/<VSN>/ under the file name of --input. The outputs are saved in <data-dir>/<VSN>/ instead of --output-dir. Can be given multiple times.")
+@click.option("--vsn-file", type=Path, default=None, help="Path to a file listing VSNs of the nodes, one per line.")
+@click.option("-d", "--data-dir", type=Path, default=Path("data"), help="Directory holding the job lists and outputs of the nodes given by --vsn or --vsn-file. Default is data.")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=4, help="Maximum number of nodes processed at the same time. Default is 4.")
+@click.option("-f", "--format", "output_format", type=click.Choice(list(SINKS.keys())), default="csv", help="Format of the output files. Default is csv.")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1, help="Number of processes generating the metrics of instances in parallel. Default is 1.")
+@click.option("--batch", is_flag=True, default=False, help="Generate the metrics of all instances a day at a time per VSN in one pass, instead of one instance at a time. --jobs is ignored.")
+@click.option("--fetch-strategy", type=click.Choice(PERF_FETCH_STRATEGIES), default="auto", help="Query the metrics of the plugins' containers only (narrow) or of all containers on the node (wide). auto picks narrow when few plugins run at the same time. Default is auto.")
+@click.option("--max-memory", type=click.FloatRange(min=1), default=None, help="Memory budget in MB of the run, worker processes included. Close to the budget, performance data held for later runs are spilled to disk, queries are made shorter, narrow and in chunks, fewer instances are kept in flight, and no new node is started.")
+def perf(input, resume, output_dir, vsns, vsn_file, data_dir, concurrency, output_format, jobs, batch, fetch_strategy, max_memory):
+    governor = MemoryGovernor(int(max_memory * 2**20)) if max_memory is not None else None
+
+    def generate(input, output_dir):
+        logging.info(f'Reading job data from {input}.')
+        df = pd.read_csv(input)
+
+        logging.info(f'Output directory is {output_dir}.')
+
+        logging.info("We consider only successfully completed runs, not the ones that are failed or unknown")
+        completed_runs = df[df["end_state"] == "completed"]
+        logging.info(f'{len(completed_runs)} completed runs found.')
+        logging.info(f'Completed runs by plugin name are {completed_runs.groupby("plugin_task").size()}')
+
+        # logging.info("Sorting the runs by plugin_name")
+        # completed_runs = completed_runs.sort_values(by="plugin_name")
+
+        return generate_perf_outputs(completed_runs, output_dir, output_format, resume, jobs, batch, fetch_strategy, governor)
+
+    vsns = read_vsns(vsns, vsn_file)
+    if len(vsns) == 0:
+        generate(input, output_dir)
+        if governor is not None:
+            logging.info(governor.report())
+        return 0
+
+    summary = run_fleet(vsns, lambda vsn: generate(data_dir.joinpath(vsn, input.name), data_dir.joinpath(vsn)), concurrency, governor)
+    report_fleet(summary)
+    if governor is not None:
+        logging.info(governor.report())
+    if (summary["status"] == "failed").any():
+        exit(1)
+
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, type=Path)
+@click.option("-m", "--merge", "profiles", multiple=True, type=Path, help="Path to a profile saved by --save to merge, e.g. of another VSN or time range. Can be given multiple times.")
+@click.option("-s", "--save", type=Path, default=None, help="Save the profile to the path in JSON so that it can be merged later with --merge.")
+@click.option("-o", "--output", type=Path, default=None, help="Save the profile table to the path in CSV.")
+def profile(paths, profiles, save, output):
+    """Summarizes the resource usage of plugins from the perf outputs in PATHS, files or directories."""
+    if len(paths) == 0 and len(profiles) == 0:
+        raise click.UsageError("Give at least one perf output or a profile with --merge.")
+    resource_profile = ResourceProfile()
+    for p in profiles:
+        logging.info(f'Merging the profile {p}.')
+        resource_profile.merge(ResourceProfile.load(p))
+
+    outputs = find_perf_outputs(paths)
+    logging.info(f'{len(outputs)} perf outputs found.')
+    for path in outputs:
+        rows = profile_perf_output(resource_profile, path)
+        logging.info(f'Profiled {rows} records from {path}.')
+
+    print(report_profile(resource_profile))
+    if save is not None:
+        resource_profile.save(save)
+        logging.info(f'Saved the profile to {save}.')
+    if output is not None:
+        resource_profile.table().to_csv(output, index=False)
+        logging.info(f'Created {output}.')
+
+
+def prune_cache(max_size):
+    """Evicts the least recently used data from the cache down to max_size MB, if given."""
+    if max_size is None:
+        return
+    evicted = CacheManager().prune(max_bytes=int(max_size * 2**20))
+    logging.info(f'Evicted {len(evicted)} entries of {evicted["bytes"].sum() / 2**20:.1f} MB from the cache to keep it within {max_size} MB.')
+
+
+@cli.group(name="cache")
+def cache_group():
+    """Inspects and maintains the cache of downloaded data in ~/.waggle."""
+    pass
+
+
+@cache_group.command(name="inspect")
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node to inspect. Can be given multiple times. Default is all nodes in the cache.")
+@click.option("--vsn-file", type=Path, default=None, help="Path to a file listing VSNs of the nodes, one per line.")
+def cache_inspect(vsns, vsn_file):
+    vsns = read_vsns(vsns, vsn_file)
+    summary = CacheManager().inspect(vsns if len(vsns) > 0 else None)
+    if len(summary) == 0:
+        print("The cache is empty.")
+        return
+    print(summary.to_string(index=False, float_format=lambda x: f"{x:.1f}"))
+    print(f'{summary["entries"].sum()} entries of {summary["mb"].sum():.1f} MB in total.')
+
+
+@cache_group.command(name="verify")
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node to verify. Can be given multiple times. Default is all nodes in the cache.")
+@click.option("--vsn-file", type=Path, default=None, help="Path to a file listing VSNs of the nodes, one per line.")
+@click.option("--repair", is_flag=True, default=False, help="Remove the entries not matching their checksum so that they are downloaded again.")
+def cache_verify(vsns, vsn_file, repair):
+    vsns = read_vsns(vsns, vsn_file)
+    corrupted = CacheManager().verify(vsns if len(vsns) > 0 else None, repair)
+    if len(corrupted) == 0:
+        logging.info("All entries match their checksum.")
+        return
+    print(corrupted.to_string(index=False))
+    if repair:
+        logging.info(f'Removed {len(corrupted)} entries not matching their checksum.')
+    else:
+        logging.info(f'{len(corrupted)} entries do not match their checksum. Run with --repair to remove them.')
+        exit(1)
+
+
+@cache_group.command(name="prune")
+@click.option("--max-size", type=click.FloatRange(min=0), default=None, help="Evict the least recently used entries until the cache takes no more than this many MB.")
+@click.option("--max-age", default=None, help="Evict the entries not read for longer than this, e.g. 12h, 30d.")
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node to prune. Can be given multiple times. Default is all nodes in the cache.")
+@click.option("--dry-run", is_flag=True, default=False, help="Only list the entries that would be evicted.")
+def cache_prune(max_size, max_age, vsns, dry_run):
+    if max_size is None and max_age is None:
+        raise click.UsageError("Give --max-size or --max-age.")
+    vsns = read_vsns(vsns)
+    evicted = CacheManager().prune(
+        max_bytes=None if max_size is None else int(max_size * 2**20),
+        max_age=max_age,
+        vsns=vsns if len(vsns) > 0 else None,
+        dry_run=dry_run)
+    if dry_run and len(evicted) > 0:
+        print(evicted[["vsn", "download_type", "start", "end", "rows", "bytes", "accessed"]].to_string(index=False))
+    logging.info(f'{"Would evict" if dry_run else "Evicted"} {len(evicted)} entries of {evicted["bytes"].sum() / 2**20:.1f} MB.')
+
+
+@cache_group.command(name="warm")
+@click.option("-v", "--vsn", "vsns", multiple=True, type=str, help="VSN of the node. Can be given multiple times.")
+@click.option("--vsn-file", type=Path, default=None, help="Path to a file listing VSNs of the nodes, one per line.")
+@click.option("-s", "--start", required=True, help="Start time of the query in UTC, e.g. 1h, 10d, 2024-01-01T00:00:00Z")
+@click.option("-e", "--end", default="", help="End time of the query in UTC, e.g. 1h, 10d, 2024-01-02T00:00:00Z")
+@click.option("-t", "--type", "download_types", multiple=True, type=click.Choice([DOWNLOAD_TYPE_JOB]), default=[DOWNLOAD_TYPE_JOB], help="Data to download. Only the scheduler events read by job --bulk are cached, as perf queries the performance data directly. Default is job.")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=4, help="Maximum number of nodes processed at the same time. Default is 4.")
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=1, help="Number of splits downloaded in parallel per node. Default is 1.")
+@click.option("--window", default="1D", help="Length of the splits, e.g. 6h, 1D, 7D. The length learned from the volume of earlier downloads of the node is used instead if any. Default is 1D.")
+@click.option("--max-rows", type=click.IntRange(min=1), default=DOWNLOAD_MAX_ROWS, help=f'Maximum number of records in a split. Larger splits are halved. Default is {DOWNLOAD_MAX_ROWS}.')
+@click.option("--memory-budget", type=click.FloatRange(min=0, min_open=True), default=None, help="Download the splits in chunks so that no more than about this many MB are held in memory. Default is no limit.")
+@click.option("--rate-limit", type=click.FloatRange(min=0, min_open=True), default=None, help="Maximum number of queries per second sent to the Sage server. Default is no limit.")
+@click.option("--cache-max-size", type=click.FloatRange(min=0), default=None, help="Evict the least recently used data from the cache after downloading until it takes no more than this many MB. Default is no limit.")
+def cache_warm(vsns, vsn_file, start, end, download_types, concurrency, workers, window, max_rows, memory_budget, rate_limit, cache_max_size):
+    """Downloads the data of the nodes in the time range into the cache without writing any output."""
+    vsns = read_vsns(vsns, vsn_file)
+    if len(vsns) == 0:
+        raise click.UsageError("Give at least one VSN with --vsn or --vsn-file.")
+    start_t, err = parse_time(start)
+    end_t, err = parse_time(end)
+    download_funcs = {
+        DOWNLOAD_TYPE_JOB: download_scheduler_event,
+    }
+
+    def warm(vsn):
+        records = 0
+        for download_type in download_types:
+            cache = download_bulk_data(
+                download_type,
+                download_funcs[download_type],
+                vsn,
+                start_t,
+                end_t,
+                window=window,
+                workers=workers,
+                rate_limit=rate_limit,
+                max_rows=max_rows,
+                memory_budget=None if memory_budget is None else int(memory_budget * 2**20),
+                load=False)
+            records += sum(e["rows"] for e in cache.entries if e["start"] < to_utc(end_t) and e["end"] > to_utc(start_t))
+        return records
 
+    summary = run_fleet(vsns, warm, concurrency)
+    report_fleet(summary)
+    prune_cache(cache_max_size)
+    if (summary["status"] == "failed").any():
+        exit(1)
 
 if __name__ == "__main__":
     logging.basicConfig(
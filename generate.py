@@ -8,78 +8,8 @@ from pathlib import Path
 from tqdm import tqdm
 
 from utils import *
-
-
-def generate_metrics_from_instance(t: tqdm, run: pd.Series):
-    instance = run.k3s_pod_instance
-    device = convert_nodename_to_devicename(run.k3s_pod_node_name)
-    gpu_required = is_gpu_requested(run)
-    plugin_name = run.plugin_name
-    vsn = run.vsn
-    started = pd.to_datetime(run.timestamp)
-    completed = pd.to_datetime(run.completed_at)
-    extended_started = pd.to_datetime(run.timestamp) - pd.to_timedelta(1, unit='m')
-    extended_completed = pd.to_datetime(run.completed_at) + pd.to_timedelta(1, unit='m')
-    extended_started = extended_started.isoformat()
-    extended_completed = extended_completed.isoformat()
-
-    t.write(f'{instance}: Fetching data from cloud ranging from {extended_started} to {extended_completed}')
-    perf_df = get_vsn_performance_data(vsn, extended_started, extended_completed)
-    if len(perf_df) < 1:
-        t.write(f'No record found for {instance}')
-        return pd.DataFrame()
-
-    container_perf_df = perf_df[perf_df["meta.container"]==plugin_name]
-    container_cpu_perf_df = container_perf_df[container_perf_df["name"]=="container_cpu_usage_seconds_total"]
-    t.write(f'{instance}: {len(container_cpu_perf_df)} CPU records found')
-    if len(container_cpu_perf_df) < 1:
-        cpu = pd.DataFrame([], columns=["timestamp", "cpu"])
-        cpu["timestamp"] = pd.to_datetime(cpu["timestamp"], utc=True)
-    else:
-        cpu = calculate_cpu_utilization_from_cpuseconds(container_cpu_perf_df.copy(), started)[["timestamp", "cpu"]]
-        cpu = cpu.sort_values(by="timestamp")
-
-    container_mem_rss_perf_df = container_perf_df[container_perf_df["name"]=="container_memory_rss"]
-    container_mem_workingset_perf_df = container_perf_df[container_perf_df["name"]=="container_memory_working_set_bytes"]
-    t.write(f'{instance}: {len(container_mem_workingset_perf_df)} Memory workingset records found')
-    if len(container_mem_workingset_perf_df) < 1:
-        mem = pd.DataFrame([], columns=["timestamp", "mem"])
-        mem["timestamp"] = pd.to_datetime(mem["timestamp"], utc=True)
-    else:
-        container_mem_workingset_perf_df["mem"] = container_mem_workingset_perf_df["value"].values + container_mem_rss_perf_df["value"].values
-        mem = container_mem_workingset_perf_df[["timestamp", "mem"]]
-    try:
-        mem = mem.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(cpu[["timestamp", "cpu"]], mem[["timestamp", "mem"]], on="timestamp")
-    except ValueError as ex:
-        t.write(f'{instance}: ERROR="{ex}" DATA={cpu}')
-        return pd.DataFrame()
-
-    if "meta.sensor" not in perf_df.columns:
-        t.write(f'{instance}: meta.sensor field not found. Unable to retrive power measurements')
-        pow = pd.DataFrame([], columns=["timestamp", "sys_power", "cpugpu_power"])
-        pow["timestamp"] = pd.to_datetime(pow["timestamp"], utc=True)
-        merged_instance = pd.merge_asof(merged_instance, pow, on="timestamp")
-    else:
-        tegra_total_power = perf_df[(perf_df["name"] == "tegra_wattage_current_milliwatts") & (perf_df["meta.sensor"] == "vdd_in")]
-        t.write(f'{instance}: {len(tegra_total_power)} tegra power metric records found')
-        tegra_total_power = tegra_total_power.rename({"value": "sys_power"}, axis="columns")
-        tegra_total_power = tegra_total_power.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(merged_instance, tegra_total_power[["timestamp", "sys_power"]], on="timestamp")
-
-        tegra_cpugpu_power = perf_df[(perf_df["name"] == "tegra_wattage_current_milliwatts") & (perf_df["meta.sensor"] == "vdd_cpu_gpu_cv")]
-        t.write(f'{instance}: {len(tegra_total_power)} tegra cpugpu power metric records found')
-        tegra_cpugpu_power = tegra_cpugpu_power.rename({"value": "cpugpu_power"}, axis="columns")
-        tegra_cpugpu_power = tegra_cpugpu_power.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(merged_instance, tegra_cpugpu_power[["timestamp", "cpugpu_power"]], on="timestamp")
-
-    # Merging all metrics
-    merged_instance["plugin_instance"] = instance
-    merged_instance["device"] = device
-    merged_instance["gpu_requested"] = gpu_required
-    merged_instance['timestamp'] = merged_instance['timestamp'].map(lambda x: x.isoformat())
-    t.write(f'{instance}: Generated {len(merged_instance)} records. Done.')
-    return merged_instance
+from sink import SINKS
+from governor import MemoryGovernor
 
 
 def main(args):
@@ -102,22 +32,15 @@ def main(args):
     # run = completed_runs[completed_runs["k3s_pod_instance"] == "avian-diversity-monitoring-RU9ugV"]
     # df = generate_metrics_from_instance(t, run)
     # df.to_csv("test.csv", index=False)
-    for plugin_name, runs in completed_runs.groupby("plugin_name"):
-        logging.info(f'Generating metrics for {plugin_name}')
-        plugin_df = pd.DataFrame()
-        plugin_output_path = output_dir.joinpath(f'{plugin_name}.csv')
-        if plugin_output_path.exists() and args.resume:
-            logging.info(f'{plugin_output_path} already exists. --resume is enabled. Skipping.')
-            continue
-
-        total_iteration = len(runs)
-        t = tqdm(range(total_iteration))
-        # for _, run in runs.iterrows():
-        for i in t:
-            run = runs.iloc[i]
-            run_df = generate_metrics_from_instance(t, run)
-            plugin_df = pd.concat([plugin_df, run_df])
-        plugin_df.to_csv(plugin_output_path, index=False)
+    tracer = start_trace() if args.trace is not None else None
+    governor = MemoryGovernor(int(args.max_memory * 2**20)) if args.max_memory is not None else None
+    try:
+        generate_perf_outputs(completed_runs, output_dir, args.format, args.resume, args.jobs, args.batch, args.fetch_strategy, governor)
+    finally:
+        if tracer is not None:
+            finish_trace(tracer, args.trace)
+    if governor is not None:
+        logging.info(governor.report())
     return 0
 
 
@@ -134,7 +57,31 @@ if __name__ == "__main__":
     parser.add_argument(
         "--resume", dest="resume",
         action="store_true",
-        help="Skip if plugin data already exists")
+        help="Skip instances already written to the plugin outputs")
+    parser.add_argument(
+        "--format", dest="format",
+        action="store", default="csv", choices=list(SINKS.keys()),
+        help="Format of the output files")
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs",
+        action="store", type=int, default=1,
+        help="Number of processes generating metrics in parallel")
+    parser.add_argument(
+        "--batch", dest="batch",
+        action="store_true",
+        help="Generate metrics of all instances a day at a time in one pass")
+    parser.add_argument(
+        "--fetch-strategy", dest="fetch_strategy",
+        action="store", default="auto", choices=PERF_FETCH_STRATEGIES,
+        help="Query the metrics of the plugins' containers only (narrow) or of all containers (wide)")
+    parser.add_argument(
+        "--trace", dest="trace",
+        action="store", type=Path, default=None,
+        help="Trace the time, rows and peak memory of the stages and save the trace to the path in JSON, or CSV if it ends with .csv")
+    parser.add_argument(
+        "--max-memory", dest="max_memory",
+        action="store", type=float, default=None,
+        help="Memory budget in MB. Close to it, data are spilled to disk, queried shorter and in chunks, and fewer instances are kept in flight")
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -0,0 +1,104 @@
+"""Keeps long ingestion runs within a memory budget.
+
+A MemoryGovernor tracks the resident memory of the process and of its worker processes,
+and tells the pipeline to adapt once the memory goes over a share of the budget
+(MEMORY_SOFT_LIMIT), so that the run finishes within the budget instead of being killed.
+Under pressure,
+
+- PerformanceQueryPlanner spills the performance data held for later runs to Parquet
+  files and reads them back when they are needed
+- queries not made yet are planned again with spans of half the length, down to
+  PERF_QUERY_MIN_SPAN, and only for the containers of the plugins. Spans that would
+  not fit in the memory left are fetched in chunks compacted as they arrive
+- fewer instances are kept in flight in the worker processes, down to one
+- run_fleet starts no new VSN until the memory goes down or the others are done
+
+Resident memory is read from /proc, so the governor does nothing where it is not available.
+"""
+import logging
+import multiprocessing
+import threading
+from contextlib import contextmanager
+
+from instrument import read_memory_status
+
+
+# Share of the budget over which the pipeline adapts
+MEMORY_SOFT_LIMIT = 0.8
+# Seconds a VSN waits for the memory to go down before checking again
+MEMORY_ADMIT_INTERVAL = 1.
+
+
+class MemoryGovernor:
+    def __init__(self, max_bytes: int, soft_limit=MEMORY_SOFT_LIMIT):
+        self.max_bytes = max_bytes
+        self.soft_limit = soft_limit
+        self.enabled = read_memory_status() is not None
+        if not self.enabled:
+            logging.warning("Resident memory cannot be read on this system. The memory budget is not enforced.")
+        self.condition = threading.Condition()
+        self.active = 0
+        self.peak = 0
+        self.pending_limit = None
+        self.adaptations = {"spilled": 0, "shrunk": 0, "chunked": 0, "throttled": 0, "held": 0}
+
+    def rss(self) -> int:
+        """Returns the resident bytes of this process and its worker processes."""
+        if not self.enabled:
+            return 0
+        rss = read_memory_status()["VmRSS"]
+        for child in multiprocessing.active_children():
+            status = read_memory_status(child.pid)
+            if status is not None:
+                rss += status["VmRSS"]
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def headroom(self) -> int:
+        """Returns the bytes left under the soft limit."""
+        return int(self.max_bytes * self.soft_limit) - self.rss()
+
+    def under_pressure(self) -> bool:
+        return self.enabled and self.rss() > self.max_bytes * self.soft_limit
+
+    def adapt(self, adaptation: str, message: str):
+        with self.condition:
+            self.adaptations[adaptation] += 1
+        logging.info(f'Memory at {self.rss() / 2**20:.0f} of {self.max_bytes / 2**20:.0f} MB. {message}')
+
+    def allowed_pending(self, max_pending: int) -> int:
+        """Returns the number of instances to keep in flight in the worker processes."""
+        if not self.enabled:
+            return max_pending
+        rss = self.rss()
+        if rss > self.max_bytes:
+            allowed = 1
+        elif rss > self.max_bytes * self.soft_limit:
+            allowed = max(1, max_pending // 2)
+        else:
+            allowed = max_pending
+        if allowed < max_pending and allowed != self.pending_limit:
+            self.adapt("throttled", f'Keeping {allowed} of {max_pending} instances in flight.')
+        self.pending_limit = allowed
+        return allowed
+
+    @contextmanager
+    def admit(self, name: str):
+        """Holds a new VSN back while the memory is under pressure and other VSNs are running."""
+        with self.condition:
+            if self.active > 0 and self.under_pressure():
+                self.adaptations["held"] += 1
+                logging.info(f'{name}: Waiting for the memory to go down before starting.')
+                while self.active > 0 and self.under_pressure():
+                    self.condition.wait(MEMORY_ADMIT_INTERVAL)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def report(self) -> str:
+        adaptations = ", ".join(f'{k} {v}' for k, v in self.adaptations.items())
+        return f'Peak memory was {self.peak / 2**20:.0f} MB of the budget of {self.max_bytes / 2**20:.0f} MB. Adaptations: {adaptations}.'
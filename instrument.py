@@ -0,0 +1,237 @@
+"""Opt-in tracing of the stages of the download tool.
+
+Stages are marked in the code with
+
+    with trace("parse_events", rows_in=len(df)) as stage:
+        out = parse_events(df)
+        stage.rows_out = len(out)
+
+and labelled by the VSN, plugin and instance being processed with trace_labels. Nothing is
+recorded unless a Tracer is set with set_tracer, e.g. by --trace, so that the marks cost
+next to nothing otherwise.
+
+A Tracer records the wall time, rows in and out, and peak memory of each stage along with
+its labels and the stage it is nested in. Peak memory is the rise of the peak resident
+memory of the process during the stage on Linux, or of the memory allocated by Python
+traced by tracemalloc elsewhere. It is measured for the whole process, so stages running
+at the same time in other threads, e.g. of other VSNs, count in each other's peak.
+"""
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+
+TRACE_LABELS = ["vsn", "plugin", "instance"]
+TRACE_COLUMNS = ["stage", "parent"] + TRACE_LABELS + ["started", "seconds", "self_seconds", "rows_in", "rows_out", "peak_bytes"]
+TRACE_SUMMARY_TOP = 15
+
+
+def read_memory_status(pid="self") -> dict:
+    """Returns the resident and peak resident bytes of the process, or None where /proc is not available."""
+    try:
+        with open(f'/proc/{pid}/status', "r") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return {k: int(status[k].split()[0]) * 1024 for k in ["VmRSS", "VmHWM"]}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_memory() -> bool:
+    """Resets the peak resident memory of this process to its current one. Returns False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Stage:
+    def __init__(self, name: str, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.child_seconds = 0.
+
+
+class NullStage:
+    """Stands for a stage when nothing is traced. Whatever is set on it is ignored."""
+    rows_in = None
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class NullTracer:
+    def stage(self, name: str, rows_in=None):
+        return NULL_STAGE
+
+    @contextmanager
+    def labels(self, **labels):
+        yield
+
+
+class Tracer:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Stages open in any thread, whose peak is raised whenever the peak of the process is reset
+        self.open = set()
+        self.use_rss = read_memory_status() is not None and reset_peak_memory()
+        if not self.use_rss and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def memory(self):
+        """Returns the current and peak memory of the process since the last reset."""
+        if self.use_rss:
+            status = read_memory_status()
+            return status["VmRSS"], status["VmHWM"]
+        return tracemalloc.get_traced_memory()
+
+    def reset_peak(self):
+        if self.use_rss:
+            reset_peak_memory()
+        else:
+            tracemalloc.reset_peak()
+
+    def stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+            self.local.labels = {}
+        return self.local.stack
+
+    @contextmanager
+    def labels(self, **labels):
+        self.stack()
+        previous = self.local.labels
+        self.local.labels = previous | {k: v for k, v in labels.items() if v is not None}
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    @contextmanager
+    def stage(self, name: str, rows_in=None):
+        stack = self.stack()
+        stage = Stage(name, rows_in)
+        with self.lock:
+            current, peak = self.memory()
+            for s in self.open:
+                s.peak = max(s.peak, peak)
+            self.reset_peak()
+            stage.base = stage.peak = current
+            self.open.add(stage)
+        parent = stack[-1] if len(stack) > 0 else None
+        stack.append(stage)
+        started = time.time()
+        t = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - t
+            stack.pop()
+            with self.lock:
+                _, peak = self.memory()
+                for s in self.open:
+                    s.peak = max(s.peak, peak)
+                self.open.discard(stage)
+                if parent is not None:
+                    parent.child_seconds += seconds
+                self.records.append({
+                    "stage": name,
+                    "parent": None if parent is None else parent.name,
+                    **{k: self.local.labels.get(k) for k in TRACE_LABELS},
+                    "started": started,
+                    "seconds": seconds,
+                    "self_seconds": seconds - stage.child_seconds,
+                    "rows_in": stage.rows_in,
+                    "rows_out": stage.rows_out,
+                    "peak_bytes": stage.peak - stage.base,
+                })
+
+    def extend(self, records: list):
+        """Adds the records of stages traced elsewhere, e.g. in a worker process."""
+        with self.lock:
+            self.records += records
+
+    def frame(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.records, columns=TRACE_COLUMNS)
+        df["started"] = pd.to_datetime(df["started"], unit="s", utc=True)
+        return df.astype({"rows_in": "Int64", "rows_out": "Int64"})
+
+    def save(self, path: Path):
+        """Saves the records to CSV if the path ends with .csv, and to JSON otherwise."""
+        df = self.frame()
+        if Path(path).suffix == ".csv":
+            df.to_csv(path, index=False)
+            return
+        df["started"] = df["started"].map(lambda t: t.isoformat())
+        with open(path, "w") as f:
+            json.dump([{k: (None if pd.isna(v) else v) for k, v in r.items()} for r in df.astype(object).to_dict(orient="records")], f, indent=1)
+
+    def summary(self, top=TRACE_SUMMARY_TOP) -> pd.DataFrame:
+        """Returns the stages with the most cumulative time, time spent outside their nested stages, rows and peak memory."""
+        df = self.frame()
+        if len(df) == 0:
+            return df
+        summary = df.groupby("stage").agg(
+            calls=("seconds", "size"),
+            seconds=("seconds", "sum"),
+            self_seconds=("self_seconds", "sum"),
+            rows_in=("rows_in", lambda s: s.sum(min_count=1)),
+            rows_out=("rows_out", lambda s: s.sum(min_count=1)),
+            peak_mb=("peak_bytes", "max"))
+        summary["peak_mb"] /= 2**20
+        summary["mean_ms"] = summary["seconds"] / summary["calls"] * 1000.
+        return summary.sort_values(by="seconds", ascending=False).head(top).reset_index()
+
+    def summary_by(self, label: str, top=TRACE_SUMMARY_TOP) -> pd.DataFrame:
+        """Returns the values of a label, e.g. plugin, taking the most time in their stages."""
+        df = self.frame().dropna(subset=[label])
+        summary = df.groupby(label).agg(stages=("stage", "size"), seconds=("self_seconds", "sum"), peak_mb=("peak_bytes", "max"))
+        summary["peak_mb"] /= 2**20
+        return summary.sort_values(by="seconds", ascending=False).head(top).reset_index()
+
+    def report(self, top=TRACE_SUMMARY_TOP) -> str:
+        summary = self.summary(top)
+        if len(summary) == 0:
+            return "No stages traced."
+        lines = [f'Top {len(summary)} stages by cumulative time:', summary.to_string(index=False, float_format=lambda x: f"{x:.3f}")]
+        for label in ["plugin", "vsn"]:
+            by_label = self.summary_by(label, top)
+            if len(by_label) > 1:
+                lines += [f'Top {len(by_label)} {label}s by time:', by_label.to_string(index=False, float_format=lambda x: f"{x:.3f}")]
+        return "\n".join(lines)
+
+
+_tracer = NullTracer()
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def trace(stage: str, rows_in=None):
+    return _tracer.stage(stage, rows_in)
+
+
+def trace_labels(**labels):
+    return _tracer.labels(**labels)
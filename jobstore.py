@@ -0,0 +1,54 @@
+"""Persistent store of the job records of a VSN kept up to date by job --sync.
+
+The records are kept in the cache root along with the high-water mark, the timestamp of
+the latest scheduler event seen,
+
+    ~/.waggle/<VSN>/jobs/jobs.csv
+    ~/.waggle/<VSN>/jobs/sync.json
+
+Both files are replaced atomically, the records first, so that an interrupted sync only
+makes the next one fetch the same events again.
+"""
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from cache import CACHE_ROOT, to_utc
+
+
+JOBS_FILENAME = "jobs.csv"
+SYNC_FILENAME = "sync.json"
+
+
+class JobStore:
+    def __init__(self, vsn: str, root: Path = CACHE_ROOT):
+        self.vsn = vsn.upper()
+        self.path = Path(root).joinpath(self.vsn, "jobs")
+        self.jobs_path = self.path.joinpath(JOBS_FILENAME)
+        self.sync_path = self.path.joinpath(SYNC_FILENAME)
+        os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def high_water_mark(self):
+        """Returns the timestamp of the latest event seen, or None if never synced."""
+        if not self.sync_path.exists():
+            return None
+        with open(self.sync_path, "r") as f:
+            return to_utc(json.load(f)["high_water_mark"])
+
+    def load(self) -> pd.DataFrame:
+        if not self.jobs_path.exists():
+            return pd.DataFrame()
+        return pd.read_csv(self.jobs_path)
+
+    def save(self, df: pd.DataFrame, high_water_mark):
+        tmp_path = self.jobs_path.with_suffix(".tmp")
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.jobs_path)
+
+        tmp_path = self.sync_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"vsn": self.vsn, "high_water_mark": to_utc(high_water_mark).isoformat()}, f, indent=2)
+        os.replace(tmp_path, self.sync_path)
@@ -0,0 +1,69 @@
+"""Checkpoint journal of the plugin instances written to the perf outputs.
+
+The journal is an append-only file of JSON lines kept next to the outputs. A line is
+appended once the rows of an instance are flushed to its plugin output, recording the
+number of rows and the position of the output after the write. On resume, instances in
+the journal are not fetched again and the outputs are truncated to the last recorded
+position so that rows of an instance interrupted while being written are discarded.
+"""
+import json
+import os
+from pathlib import Path
+
+
+JOURNAL_FILENAME = "perf.journal"
+
+
+class Journal:
+    def __init__(self, path: Path, resume: bool = False):
+        self.path = Path(path)
+        self.instances = {}
+        self.positions = {}
+        if resume and self.path.exists():
+            self.load()
+        else:
+            # Starting over invalidates everything recorded so far
+            open(self.path, "w").close()
+        self.file = open(self.path, "a")
+
+    def load(self):
+        """Reads the records, and truncates the journal after the last complete one so that new records start on a line of their own."""
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A record cut off by an interruption
+                    continue
+                if not line.endswith(b"\n"):
+                    continue
+                end = f.tell()
+                self.instances.setdefault(record["plugin_name"], {})[record["k3s_pod_instance"]] = record["rows"]
+                self.positions[record["plugin_name"]] = record["position"]
+        if end < self.path.stat().st_size:
+            os.truncate(self.path, end)
+
+    def finished(self, plugin_name: str) -> set:
+        return set(self.instances.get(plugin_name, {}).keys())
+
+    def position(self, plugin_name: str):
+        """Returns the position of the plugin output after its last recorded instance."""
+        return self.positions.get(plugin_name)
+
+    def record(self, plugin_name: str, instance: str, rows: int, position: int):
+        record = {"plugin_name": plugin_name, "k3s_pod_instance": instance, "rows": rows, "position": position}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.instances.setdefault(plugin_name, {})[instance] = rows
+        self.positions[plugin_name] = position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
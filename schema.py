@@ -0,0 +1,128 @@
+"""Compact dtypes of the frames flowing through the download tool.
+
+Performance data are held as they are ingested with,
+
+- timestamp: datetime64[ns, UTC]
+- name and meta.* labels: categorical
+- value: float64, as cumulative counters such as container_cpu_usage_seconds_total
+  lose too much precision in float32 for their differences to be meaningful
+
+and the metrics of plugin instances with,
+
+- timestamp: datetime64[ns, UTC]
+- cpu, mem, sys_power, cpugpu_power: float32
+- plugin_instance and device: categorical
+- gpu_requested: bool
+
+Timestamps are formatted into ISO 8601 strings only when written to CSV.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+from instrument import trace
+
+
+INSTANCE_DTYPES = {
+    "cpu": "float32",
+    "mem": "float32",
+    "sys_power": "float32",
+    "cpugpu_power": "float32",
+    "plugin_instance": "category",
+    "device": "category",
+    "gpu_requested": "bool",
+}
+
+# Schema of the Parquet outputs so that the files written for every instance agree
+INSTANCE_ARROW_SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("ns", tz="UTC")),
+    ("cpu", pa.float32()),
+    ("mem", pa.float32()),
+    ("sys_power", pa.float32()),
+    ("cpugpu_power", pa.float32()),
+    ("plugin_instance", pa.dictionary(pa.int32(), pa.string())),
+    ("device", pa.dictionary(pa.int32(), pa.string())),
+    ("gpu_requested", pa.bool_()),
+])
+
+
+def to_utc_datetime(s) -> pd.Series:
+    """Converts datetimes or ISO 8601 strings, which may differ in precision, into UTC datetimes."""
+    if pd.api.types.is_object_dtype(getattr(s, "dtype", None)) or pd.api.types.is_string_dtype(getattr(s, "dtype", None)):
+        s = pd.to_datetime(s, utc=True, format="ISO8601")
+    else:
+        s = pd.to_datetime(s, utc=True)
+    return s.dt.as_unit("ns") if isinstance(s, pd.Series) else s
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts a query response to the compact dtypes of performance data.
+
+    Meta columns with no values are dropped as they are in the responses of the Sage data
+    API. Values are converted to numbers only if they all are, e.g. not for scheduler events.
+    """
+    with trace("compact_frame", rows_in=len(df)) as stage:
+        df = _compact_frame(df)
+        stage.rows_out = len(df)
+    return df
+
+
+def _compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.drop(columns=[c for c in df.columns if c.startswith("meta.") and df[c].isna().all()])
+    if "timestamp" in df.columns and not isinstance(df["timestamp"].dtype, pd.DatetimeTZDtype):
+        df["timestamp"] = to_utc_datetime(df["timestamp"])
+    for column in df.columns:
+        if (column == "name" or column.startswith("meta.")) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    if "value" in df.columns and df["value"].dtype == object:
+        try:
+            df["value"] = pd.to_numeric(df["value"])
+        except (ValueError, TypeError):
+            pass
+    return df
+
+
+def concat_frames(dfs) -> pd.DataFrame:
+    """Concatenates frames of compact dtypes, e.g. chunks of a query, keeping their labels categorical."""
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    for column in set.intersection(*[set(df.columns) for df in dfs]):
+        if all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in dfs):
+            categories = union_categoricals([df[column] for df in dfs]).categories
+            dfs = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in dfs]
+    return compact_frame(pd.concat(dfs, ignore_index=True))
+
+
+def compact_instance_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts the metrics of plugin instances to their compact dtypes."""
+    df["timestamp"] = to_utc_datetime(df["timestamp"])
+    return df.astype({c: t for c, t in INSTANCE_DTYPES.items() if c in df.columns})
+
+
+def format_timestamps(s: pd.Series) -> pd.Series:
+    """Formats timestamps as Timestamp.isoformat() does in UTC, e.g. 2024-01-02T00:00:24.669041906+00:00."""
+    s = to_utc_datetime(s)
+    values = s.values.astype("datetime64[ns]")
+    full = np.datetime_as_string(values, unit="ns")
+    # Fractional seconds are given in nanoseconds, microseconds, or not at all
+    fraction = values.astype(np.int64) % 1000000000
+    formatted = np.where(
+        fraction % 1000 != 0, full,
+        np.where(fraction != 0, full.astype("U26"), full.astype("U19")))
+    formatted = np.char.add(formatted, "+00:00")
+    return pd.Series(np.where(s.isna().values, "NaT", formatted), index=s.index, dtype=object)
+
+
+def format_csv(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns the frame with its timestamp columns formatted for CSV."""
+    columns = [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])]
+    if len(columns) == 0:
+        return df
+    with trace("format_timestamps", rows_in=len(df)):
+        return df.assign(**{c: format_timestamps(df[c]) for c in columns})
+
+
+def bytes_per_row(df: pd.DataFrame) -> float:
+    return df.memory_usage(index=False, deep=True).sum() / max(len(df), 1)
@@ -1,10 +1,22 @@
+import io
 import json
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from sage_data_client import query
 
 pd.set_option('mode.chained_assignment',None)
 
+# Function answering the queries of get_data and get_node_performance_data. It can be
+# replaced by any function taking the arguments of sage_data_client.query, e.g. the
+# replay or synthetic backends in backend.py at the top of the repository.
+query_backend = query
+
+
+def set_query_backend(backend):
+    global query_backend
+    query_backend = backend
+
 
 def get_data(vsn, start='-1h', end=''):
     filter={
@@ -13,13 +25,13 @@ def get_data(vsn, start='-1h', end=''):
     }
 
     if end != "":
-        return query(
+        return query_backend(
         start=start,
         end=end,
         filter=filter,
         )
     else:
-        return query(
+        return query_backend(
         start=start,
         filter=filter,
         )
@@ -32,14 +44,14 @@ def get_node_performance_data(vsn, metric, start='-1h', end=''):
     }
 
     if end != "":
-        return query(
+        return query_backend(
             bucket="grafana-agent",
             start=start,
             end=end,
             filter=filter,
         )
     else:
-        return query(
+        return query_backend(
             bucket="grafana-agent",
             start=start,
             filter=filter,
@@ -47,15 +59,19 @@ def get_node_performance_data(vsn, metric, start='-1h', end=''):
 
 
 def parse_events(df):
-    v = []
-    for _, row in df.iterrows():
-        r = json.loads(row.value)
-        r["timestamp"] = row.timestamp.isoformat()
-        r["node"] = row["meta.node"]
-        r["vsn"] = row["meta.vsn"]
-        r["event"] = row["name"]
-        v.append(r)
-    return pd.read_json(json.dumps(v))
+    if len(df) == 0:
+        return pd.DataFrame()
+    # All event payloads are decoded at once as JSON lines
+    out = pd.read_json(io.StringIO("\n".join(df["value"])), lines=True)
+    # Keep the column order of the row-by-row parsing: fields of the first event,
+    # the event metadata, then the fields only found in later events
+    first_columns = list(json.loads(df["value"].iloc[0]).keys())
+    out["timestamp"] = pd.to_datetime(df["timestamp"].reset_index(drop=True), utc=True)
+    out["node"] = df["meta.node"].values
+    out["vsn"] = df["meta.vsn"].values
+    out["event"] = df["name"].values
+    columns = first_columns + ["timestamp", "node", "vsn", "event"]
+    return out[columns + [c for c in out.columns if c not in columns]]
 
 
 def fill_completion_failure(df):
@@ -63,24 +79,49 @@ def fill_completion_failure(df):
     launched = df[df.event.str.contains("launched")]
     completed = df[df.event.str.contains("complete")]
     failed = df[df.event.str.contains("failed")]
-    # launched.loc[launched["k3s_pod_name"] == completed["k3s_pod_name"]]
-    for index, p in launched.iterrows():
-        found = completed[completed.k3s_pod_instance == p.k3s_pod_instance]
-        if len(found) > 0:
-            launched.loc[index, "completed_at"] = found.iloc[0].timestamp
-            launched.loc[index, "execution_time"] = (found.iloc[0].timestamp - p.timestamp).total_seconds()
-            launched.loc[index, "k3s_pod_node_name"] = found.iloc[0].k3s_pod_node_name
-            launched.loc[index, "end_state"] = "completed"
-        else:
-            found = failed[failed.k3s_pod_instance == p.k3s_pod_instance]
-            if len(found) > 0:
-                launched.loc[index, "failed_at"] = found.iloc[0].timestamp
-                launched.loc[index, "execution_time"] = (found.iloc[0].timestamp - p.timestamp).total_seconds()
-                launched.loc[index, "reason"] = found.iloc[0].reason
-                if "error_log" in found.iloc[0]:
-                    launched.loc[index, "error_log"] = found.iloc[0]["error_log"]
-                launched.loc[index, "k3s_pod_node_name"] = found.iloc[0].k3s_pod_node_name
-                launched.loc[index, "end_state"] = "failed"
-            else:
-                launched.loc[index, "end_state"] = "unknown"
+    if len(launched) == 0:
+        return launched
+    # Each launch is matched to the first completion of its instance, or the first failure if never completed
+    completed = completed.dropna(subset=["k3s_pod_instance"]).drop_duplicates(subset="k3s_pod_instance").set_index("k3s_pod_instance")
+    failed = failed.dropna(subset=["k3s_pod_instance"]).drop_duplicates(subset="k3s_pod_instance").set_index("k3s_pod_instance")
+    instance = launched["k3s_pod_instance"]
+    is_completed = instance.isin(completed.index)
+    is_failed = ~is_completed & instance.isin(failed.index)
+
+    def found(frame, column, mask):
+        if column not in frame.columns:
+            return pd.Series(np.nan, index=launched.index)
+        return instance.map(frame[column]).where(mask)
+
+    def overwrite(column, mask, value):
+        if column in launched.columns:
+            return value.where(mask, launched[column])
+        return value.where(mask)
+
+    values = {}
+    values["completed_at"] = found(completed, "timestamp", is_completed)
+    values["failed_at"] = found(failed, "timestamp", is_failed)
+    ended_at = values["completed_at"].where(is_completed, values["failed_at"])
+    values["execution_time"] = (ended_at - launched["timestamp"]).dt.total_seconds()
+    values["reason"] = overwrite("reason", is_failed, found(failed, "reason", is_failed))
+    if "error_log" in failed.columns:
+        values["error_log"] = overwrite("error_log", is_failed, found(failed, "error_log", is_failed))
+    values["k3s_pod_node_name"] = overwrite(
+        "k3s_pod_node_name",
+        is_completed | is_failed,
+        found(completed, "k3s_pod_node_name", is_completed).where(is_completed, found(failed, "k3s_pod_node_name", is_failed)))
+    values["end_state"] = pd.Series(
+        np.select([is_completed, is_failed], ["completed", "failed"], "unknown"),
+        index=launched.index)
+
+    # Columns are added in the order the end states first appear in the launches
+    state_columns = {
+        "completed": ["completed_at", "execution_time", "k3s_pod_node_name", "end_state"],
+        "failed": ["failed_at", "execution_time", "reason", "error_log", "k3s_pod_node_name", "end_state"],
+        "unknown": ["end_state"],
+    }
+    for state in values["end_state"].unique():
+        for column in state_columns[state]:
+            if column in values:
+                launched[column] = values[column]
     return launched
@@ -0,0 +1,148 @@
+"""Append-only writers of the per-plugin outputs.
+
+Rows of each plugin instance are written as soon as they are generated so that only one
+instance is held in memory at a time. While being written, the output is kept at
+<path>.part and is readable as is, e.g. after an interrupted run. It is moved to <path>
+when the sink is closed.
+
+A sink can be reopened at a position recorded earlier, e.g. in the perf journal, to
+continue an interrupted or already completed output. Anything written after the position
+is discarded.
+
+Timestamps are written to CSV as ISO 8601 strings and to Parquet as timestamps.
+"""
+import csv
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from schema import INSTANCE_ARROW_SCHEMA, format_csv
+from instrument import trace
+
+
+class CSVSink:
+    extension = ".csv"
+
+    def __init__(self, path: Path, position=None):
+        self.path = Path(path)
+        self.partial_path = self.path.with_name(self.path.name + ".part")
+        self.columns = None
+        self.rows = 0
+        if position is None:
+            self.file = open(self.partial_path, "w")
+        else:
+            self.reopen(position)
+
+    def reopen(self, position: int):
+        if not self.partial_path.exists() and self.path.exists():
+            os.replace(self.path, self.partial_path)
+        if position > 0 and (not self.partial_path.exists() or self.partial_path.stat().st_size < position):
+            raise Exception(f'{self.partial_path} is shorter than the recorded position {position}. Remove the journal to start over.')
+        self.file = open(self.partial_path, "a")
+        self.file.truncate(position)
+        # Truncating does not move the offset reported by tell
+        self.file.seek(position)
+        if position > 0:
+            with open(self.partial_path, "r", newline="") as f:
+                self.columns = next(csv.reader(f))
+
+    @property
+    def position(self) -> int:
+        return self.file.tell()
+
+    def write(self, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+        header = self.columns is None
+        if header:
+            self.columns = list(df.columns)
+        df = format_csv(df.reindex(columns=self.columns))
+        with trace("write_csv", rows_in=len(df)):
+            df.to_csv(self.file, header=header, index=False)
+            self.file.flush()
+        self.rows += len(df)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An interrupted output is left at the partial path
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class ParquetSink:
+    """Writes a Parquet dataset directory holding one file per write in the schema of instance metrics."""
+    extension = ".parquet"
+
+    def __init__(self, path: Path, position=None, schema=INSTANCE_ARROW_SCHEMA):
+        self.path = Path(path)
+        self.schema = schema
+        self.partial_path = self.path.with_name(self.path.name + ".part")
+        self.parts = 0
+        self.rows = 0
+        if position is None:
+            if self.partial_path.exists():
+                shutil.rmtree(self.partial_path)
+            os.makedirs(self.partial_path)
+        else:
+            self.reopen(position)
+
+    def reopen(self, position: int):
+        if not self.partial_path.exists() and self.path.exists():
+            os.replace(self.path, self.partial_path)
+        os.makedirs(self.partial_path, exist_ok=True)
+        for part in self.partial_path.glob("part-*.parquet"):
+            if int(part.stem.split("-")[1]) >= position:
+                os.remove(part)
+        self.parts = position
+
+    @property
+    def position(self) -> int:
+        return self.parts
+
+    def write(self, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+        # Files are written in the same schema, even if a column has no values at all
+        with trace("write_parquet", rows_in=len(df)):
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            pq.write_table(table, self.partial_path.joinpath(f'part-{self.parts:05d}.parquet'))
+        self.parts += 1
+        self.rows += len(df)
+
+    def close(self):
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+SINKS = {
+    "csv": CSVSink,
+    "parquet": ParquetSink,
+}
+
+
+def get_output_path(output_dir: Path, name: str, output_format: str) -> Path:
+    return Path(output_dir).joinpath(f'{name}{SINKS[output_format].extension}')
+
+
+def open_sink(output_dir: Path, name: str, output_format: str = "csv", position=None):
+    return SINKS[output_format](get_output_path(output_dir, name, output_format), position)
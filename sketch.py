@@ -0,0 +1,207 @@
+"""Mergeable summaries of the resource usage of plugins computed in one pass over the perf outputs.
+
+A QuantileSketch keeps the counts of values in logarithmic buckets, so that any quantile
+is estimated within a relative error of alpha (1% by default), along with the running
+moments of the values. Two sketches of the same alpha are merged by adding their bucket
+counts and combining their moments, giving the same result as sketching all values at once.
+
+A ResourceProfile holds the sketches of cpu, mem, sys_power, cpugpu_power and execution
+time of plugins per device and gpu_requested. Profiles are saved to JSON so that those of
+different VSNs or time ranges can be merged later without reading the outputs again.
+"""
+import json
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+SKETCH_ALPHA = 0.01
+# Values closer to zero than this are counted as zero
+SKETCH_MIN_VALUE = 1e-9
+PROFILE_METRICS = ["cpu", "mem", "sys_power", "cpugpu_power", "execution_time"]
+PROFILE_QUANTILES = [0.5, 0.9, 0.99]
+PROFILE_KEYS = ["plugin_name", "device", "gpu_requested"]
+
+
+class QuantileSketch:
+    def __init__(self, alpha: float = SKETCH_ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _add_buckets(self, store: dict, values: np.ndarray):
+        indices, counts = np.unique(np.ceil(np.log(values) / math.log(self.gamma)).astype(np.int64), return_counts=True)
+        for i, c in zip(indices.tolist(), counts.tolist()):
+            store[i] = store.get(i, 0) + c
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self._add_buckets(self.positive, values[values > SKETCH_MIN_VALUE])
+        self._add_buckets(self.negative, -values[values < -SKETCH_MIN_VALUE])
+        self.zero += int((np.abs(values) <= SKETCH_MIN_VALUE).sum())
+        self._merge_moments(len(values), values.mean(), ((values - values.mean()) ** 2).sum(), values.min(), values.max())
+
+    def _merge_moments(self, count, mean, m2, min_value, max_value):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(min_value))
+        self.max = max(self.max, float(max_value))
+
+    def merge(self, other: "QuantileSketch"):
+        if other.alpha != self.alpha:
+            raise Exception(f'Cannot merge sketches of different accuracy {self.alpha} and {other.alpha}')
+        if other.count == 0:
+            return self
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for i, c in other_store.items():
+                store[i] = store.get(i, 0) + c
+        self.zero += other.zero
+        self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else math.nan
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return math.nan
+        # Buckets in ascending order of their values
+        buckets = [(-self._value(i), c) for i, c in sorted(self.negative.items(), reverse=True)]
+        buckets += [(0., self.zero)]
+        buckets += [(self._value(i), c) for i, c in sorted(self.positive.items())]
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, c in buckets:
+            seen += c
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def _value(self, i: int) -> float:
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "alpha": self.alpha,
+            "positive": {str(i): c for i, c in self.positive.items()},
+            "negative": {str(i): c for i, c in self.negative.items()},
+            "zero": self.zero,
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "QuantileSketch":
+        sketch = cls(d["alpha"])
+        sketch.positive = {int(i): c for i, c in d["positive"].items()}
+        sketch.negative = {int(i): c for i, c in d["negative"].items()}
+        sketch.zero = d["zero"]
+        sketch.count = d["count"]
+        sketch.mean = d["mean"]
+        sketch.m2 = d["m2"]
+        if sketch.count > 0:
+            sketch.min = d["min"]
+            sketch.max = d["max"]
+        return sketch
+
+
+class ResourceProfile:
+    def __init__(self, alpha: float = SKETCH_ALPHA):
+        self.alpha = alpha
+        # (plugin_name, device, gpu_requested) -> {"instances": int, metric: QuantileSketch}
+        self.groups = {}
+        self.sources = []
+
+    def group(self, plugin_name: str, device: str, gpu_requested: bool) -> dict:
+        key = (plugin_name, str(device), bool(gpu_requested))
+        if key not in self.groups:
+            self.groups[key] = {"instances": 0} | {m: QuantileSketch(self.alpha) for m in PROFILE_METRICS}
+        return self.groups[key]
+
+    def update(self, plugin_name: str, df: pd.DataFrame):
+        """Adds the samples of a chunk of the plugin output."""
+        for (device, gpu_requested), group_df in df.groupby(["device", "gpu_requested"], observed=True, sort=False):
+            group = self.group(plugin_name, device, gpu_requested)
+            for metric in ["cpu", "mem", "sys_power", "cpugpu_power"]:
+                if metric in group_df.columns:
+                    group[metric].update(group_df[metric].to_numpy(dtype=np.float64, na_value=np.nan))
+
+    def update_instances(self, plugin_name: str, instances: pd.DataFrame):
+        """Adds the execution time in seconds of the instances given with device, gpu_requested and execution_time."""
+        for (device, gpu_requested), group_df in instances.groupby(["device", "gpu_requested"], observed=True, sort=False):
+            group = self.group(plugin_name, device, gpu_requested)
+            group["instances"] += len(group_df)
+            group["execution_time"].update(group_df["execution_time"].to_numpy(dtype=np.float64))
+
+    def merge(self, other: "ResourceProfile"):
+        for key, other_group in other.groups.items():
+            group = self.group(*key)
+            group["instances"] += other_group["instances"]
+            for metric in PROFILE_METRICS:
+                group[metric].merge(other_group[metric])
+        self.sources += other.sources
+        return self
+
+    def table(self, quantiles=PROFILE_QUANTILES) -> pd.DataFrame:
+        rows = []
+        for (plugin_name, device, gpu_requested), group in sorted(self.groups.items()):
+            row = {
+                "plugin_name": plugin_name,
+                "device": device,
+                "gpu_requested": gpu_requested,
+                "instances": group["instances"],
+                "samples": group["cpu"].count,
+            }
+            for metric in PROFILE_METRICS:
+                row[f'{metric}_mean'] = group[metric].mean if group[metric].count > 0 else math.nan
+                for q in quantiles:
+                    row[f'{metric}_p{round(q * 100)}'] = group[metric].quantile(q)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def save(self, path: Path):
+        d = {
+            "alpha": self.alpha,
+            "sources": self.sources,
+            "groups": [
+                {"plugin_name": k[0], "device": k[1], "gpu_requested": k[2], "instances": g["instances"]}
+                | {m: g[m].to_dict() for m in PROFILE_METRICS}
+                for k, g in self.groups.items()],
+        }
+        tmp_path = Path(path).with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(d, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ResourceProfile":
+        with open(path, "r") as f:
+            d = json.load(f)
+        profile = cls(d["alpha"])
+        profile.sources = d["sources"]
+        for g in d["groups"]:
+            group = profile.group(g["plugin_name"], g["device"], g["gpu_requested"])
+            group["instances"] = g["instances"]
+            for m in PROFILE_METRICS:
+                group[m] = QuantileSketch.from_dict(g[m])
+        return profile
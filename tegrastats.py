@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+"""Streaming parser of tegrastats logs.
+
+Each line of a log, e.g.
+
+    03-26-2025 13:33:37 RAM 996/6854MB (lfb 641x4MB) SWAP 0/3427MB (cached 0MB) CPU [90%@1419,25%@1416,off,off]
+    EMC_FREQ 0%@1600 GR3D_FREQ 0%@[114] VIC_FREQ 601 APE 150 AUX@40.5C CPU@41C GPU@40C
+    VDD_IN 2939mW/2939mW VDD_CPU_GPU_CV 489mW/489mW VDD_SOC 774mW/774mW
+
+is parsed into a row of
+
+- timestamp: datetime64[ns, UTC], converted from the local time of the node given by --timezone
+- ram_used, ram_total, swap_used, swap_total: float32 in MB
+- cpu<N>_load in percentage and cpu<N>_freq in MHz per core: float32, NaN when the core is off
+- gr3d_load in percentage and gr3d_freq in MHz: float32
+- temp_<sensor>: float32 in Celsius, NaN when the sensor is not available
+- <rail>_power and <rail>_power_avg: float32 in milliwatts, e.g. vdd_in_power
+
+Lines are read in chunks, gzipped logs included, so that only one chunk is held in memory
+at a time, and each chunk is written to Parquet as it is parsed. Rails, sensors and cores
+found in the first chunk fix the columns of the output.
+"""
+import gzip
+import io
+import itertools
+import logging
+import re
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+TEGRASTATS_CHUNK_LINES = 100000
+TEGRASTATS_TIMESTAMP_FORMAT = "%m-%d-%Y %H:%M:%S"
+
+TIMESTAMP_RE = re.compile(r"^(\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2})")
+RAM_RE = re.compile(r"RAM (\d+)/(\d+)MB")
+SWAP_RE = re.compile(r"SWAP (\d+)/(\d+)MB")
+CPU_RE = re.compile(r"CPU \[([^\]\n]*)\]")
+CORE_RE = re.compile(r"(\d+)%(?:@(\d+))?|off")
+GR3D_RE = re.compile(r"GR3D_FREQ (\d+)%(?:@\[?(\d+))?")
+TEMPERATURE_RE = re.compile(r" (\w+)@(-?[\d.]+)C")
+POWER_RE = re.compile(r" ([A-Z][A-Z0-9_]*) ([\d.]+)(m?W)?/([\d.]+)(m?W)?(?= |$)")
+# Temperature reported by tegrastats for sensors that are not available
+TEMPERATURE_UNAVAILABLE = -256.
+
+
+def find_fields(line: str) -> list:
+    """Returns the fields of a line as (start, end, column, scale) in the order they appear.
+
+    line[start:end] is the value of the column and scale converts it to the unit of the
+    column. The frequency of a core that is off has no value and its start is None.
+    """
+    line = line.rstrip("\n")
+    # Fields are collected along with their positions to be put in the order they appear
+    fields = []
+    m = TIMESTAMP_RE.match(line)
+    if m is not None:
+        fields.append((m.start(1), (m.start(1), m.end(1), "timestamp", None)))
+    for pattern, names in [(RAM_RE, ["ram_used", "ram_total"]), (SWAP_RE, ["swap_used", "swap_total"]), (GR3D_RE, ["gr3d_load", "gr3d_freq"])]:
+        m = pattern.search(line)
+        if m is not None:
+            fields += [(m.start(i + 1), (m.start(i + 1), m.end(i + 1), name, 1.)) for i, name in enumerate(names) if m.group(i + 1) is not None]
+    m = CPU_RE.search(line)
+    if m is not None:
+        for core, c in enumerate(CORE_RE.finditer(line, m.start(1), m.end(1))):
+            if c.group(1) is None:
+                fields.append((c.start(), (c.start(), c.end(), f'cpu{core}_load', 1.)))
+                fields.append((c.end(), (None, None, f'cpu{core}_freq', 1.)))
+            else:
+                fields.append((c.start(1), (c.start(1), c.end(1), f'cpu{core}_load', 1.)))
+                fields.append((c.end(), (c.start(2), c.end(2), f'cpu{core}_freq', 1.) if c.group(2) is not None else (None, None, f'cpu{core}_freq', 1.)))
+    for m in TEMPERATURE_RE.finditer(line):
+        fields.append((m.start(2), (m.start(2), m.end(2), f'temp_{m.group(1).lower()}', 1.)))
+    for m in POWER_RE.finditer(line):
+        # Older releases report rails in milliwatts without unit
+        fields.append((m.start(2), (m.start(2), m.end(2), f'{m.group(1).lower()}_power', 1000. if m.group(3) == "W" else 1.)))
+        fields.append((m.start(4), (m.start(4), m.end(4), f'{m.group(1).lower()}_power_avg', 1000. if m.group(5) == "W" else 1.)))
+    return [f for _, f in sorted(fields, key=lambda f: f[0])]
+
+
+def compile_layout(line: str):
+    """Compiles the layout of a line into a pattern that matches the lines of the same layout.
+
+    Returns the pattern and the fields of its groups. Lines of a log mostly share their
+    layout, so matching them with a single pattern extracts all their values at once.
+    Numbers that are not fields, e.g. EMC_FREQ, are allowed to differ.
+    """
+    line = line.rstrip("\n")
+    fields = [f for f in find_fields(line) if f[0] is not None]
+    parts = []
+    position = 0
+    for start, end, column, _ in fields:
+        parts.append(re.sub(r"\d+", r"\\d+", re.escape(line[position:start])))
+        value = line[start:end]
+        parts.append(r"(\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2})" if column == "timestamp" else r"(off)" if value == "off" else r"(-?\d+(?:\.\d+)?)")
+        position = end
+    parts.append(re.sub(r"\d+", r"\\d+", re.escape(line[position:])))
+    return re.compile("".join(parts) + r"\n?$"), fields
+
+
+def parse_lines(lines: list, timezone="UTC") -> pd.DataFrame:
+    """Parses tegrastats lines into a frame of one row per line."""
+    n = len(lines)
+    timestamps = np.full(n, None, dtype=object)
+    columns = {}
+
+    def set_values(column, rows, values):
+        if column not in columns:
+            columns[column] = np.full(n, np.nan, dtype=np.float32)
+        columns[column][rows] = values
+
+    # Lines of the same layout as the first one are parsed all at once
+    for _, _, column, _ in find_fields(lines[0]):
+        if column != "timestamp":
+            set_values(column, [], [])
+    layout, layout_fields = compile_layout(lines[0])
+    matches = [layout.match(line) for line in lines]
+    rows = np.array([i for i, m in enumerate(matches) if m is not None], dtype=np.int64)
+    if len(rows) > 0:
+        # The values are converted by the CSV parser of pandas, much faster than one by one
+        names = [column for _, _, column, _ in layout_fields]
+        values = pd.read_csv(
+            io.StringIO("".join(",".join(matches[i].groups()) + "\n" for i in rows)),
+            header=None,
+            names=names,
+            dtype={column: (object if column == "timestamp" else np.float32) for column in names},
+            na_values=["off"],
+            keep_default_na=False)
+        for _, _, column, scale in layout_fields:
+            if column == "timestamp":
+                timestamps[rows] = values[column].values
+            else:
+                set_values(column, rows, values[column].values * np.float32(scale))
+
+    # and the others field by field
+    for i, m in enumerate(matches):
+        if m is not None:
+            continue
+        for start, end, column, scale in find_fields(lines[i]):
+            value = None if start is None else lines[i][start:end]
+            if column == "timestamp":
+                timestamps[i] = value
+            else:
+                set_values(column, i, np.nan if value is None or value == "off" else float(value) * scale)
+
+    for column, values in columns.items():
+        if column.startswith("temp_"):
+            values[values <= TEMPERATURE_UNAVAILABLE] = np.nan
+    timestamp = pd.to_datetime(pd.Series(timestamps, dtype=object), format=TEGRASTATS_TIMESTAMP_FORMAT)
+    return pd.DataFrame({"timestamp": timestamp.dt.tz_localize(timezone).dt.tz_convert("UTC").dt.as_unit("ns")} | columns)
+
+
+def open_log(path: Path):
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def read_tegrastats(path: Path, chunk_lines=TEGRASTATS_CHUNK_LINES, timezone="UTC"):
+    """Yields the parsed lines of a tegrastats log, gzipped or not, in chunks of up to chunk_lines."""
+    with open_log(path) as f:
+        while True:
+            lines = [line for line in itertools.islice(f, chunk_lines) if line.strip() != ""]
+            if len(lines) == 0:
+                break
+            yield parse_lines(lines, timezone)
+
+
+def convert_tegrastats(path: Path, output: Path, chunk_lines=TEGRASTATS_CHUNK_LINES, timezone="UTC") -> dict:
+    """Parses a tegrastats log into a Parquet file chunk by chunk. Returns the number of lines, elapsed time and lines per second."""
+    started = time.monotonic()
+    lines = 0
+    writer = None
+    tmp_path = Path(output).with_name(Path(output).name + ".part")
+    try:
+        for df in read_tegrastats(path, chunk_lines, timezone):
+            if writer is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                writer = pq.ParquetWriter(tmp_path, schema)
+            elif list(df.columns) != schema.names:
+                dropped = set(df.columns) - set(schema.names)
+                if len(dropped) > 0:
+                    logging.warning(f'Dropping columns {sorted(dropped)} not found in the first chunk of {path}')
+                df = df.reindex(columns=schema.names).astype({c: np.float32 for c in schema.names if c != "timestamp"})
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            lines += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise Exception(f'No lines found in {path}')
+    tmp_path.replace(output)
+    elapsed = time.monotonic() - started
+    return {"lines": lines, "elapsed": elapsed, "lines_per_sec": lines / elapsed if elapsed > 0 else float("inf")}
+
+
+@click.command()
+@click.argument("input", type=Path)
+@click.option("-o", "--output", type=Path, default=None, help="Path to save the parsed log in Parquet. Default is the input with .parquet in place of .txt or .txt.gz.")
+@click.option("-z", "--timezone", default="UTC", help="Timezone of the timestamps in the log, e.g. America/Chicago. Default is UTC.")
+@click.option("--chunk-lines", type=click.IntRange(min=1), default=TEGRASTATS_CHUNK_LINES, help=f'Number of lines parsed at a time. Default is {TEGRASTATS_CHUNK_LINES}.')
+def main(input, output, timezone, chunk_lines):
+    if output is None:
+        name = input.name.removesuffix(".gz").removesuffix(".txt")
+        output = input.with_name(f'{name}.parquet')
+    logging.info(f'Parsing {input}.')
+    stats = convert_tegrastats(input, output, chunk_lines, timezone)
+    logging.info(f'Created {output} with {stats["lines"]} lines in {stats["elapsed"]:.1f} seconds ({stats["lines_per_sec"]:.0f} lines/s).')
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
+
+    main()
@@ -0,0 +1,117 @@
+"""Local stats tables sliced by time, e.g. rpistats collected every second on the nodes.
+
+A TimeSeries keeps a frame sorted by its timestamps so that the rows of a time range are
+found by binary search in O(log N) and returned as a slice of the frame rather than a
+copy. Many ranges, e.g. the runs of plugins, are looked up at once with bounds or taken
+into one frame with take. join_intervals does the same for plain arrays of timestamps.
+
+A TimeSeriesStore holds the time series of several sources by name,
+
+    store = TimeSeriesStore()
+    store.add("rpistats", read_stats("data/rpistats.csv", unit="s"))
+    store.slice("rpistats", start - pd.Timedelta(2, unit="s"), end)
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from schema import to_utc_datetime
+
+
+INCLUSIVE = ["both", "left", "right", "neither"]
+
+
+def read_stats(path: Path, timestamp_column="timestamp", unit=None) -> pd.DataFrame:
+    """Reads a stats table in CSV or Parquet. If unit is given, e.g. s, timestamps are read as epoch times in the unit."""
+    path = Path(path)
+    df = pd.read_parquet(path) if path.suffix == ".parquet" else pd.read_csv(path)
+    if unit is not None:
+        df[timestamp_column] = pd.to_datetime(df[timestamp_column], unit=unit, utc=True)
+    return df
+
+
+def to_nanoseconds(t) -> np.ndarray:
+    if np.ndim(t) == 0:
+        t = [t]
+    return pd.DatetimeIndex(to_utc_datetime(pd.Series(t))).as_unit("ns").asi8
+
+
+def expand_bounds(lo: np.ndarray, hi: np.ndarray):
+    """Returns the pairs of range and row positions of the rows from lo to past hi of each range."""
+    counts = np.clip(hi - lo, 0, None)
+    interval_index = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return interval_index, np.repeat(lo, counts) + offsets
+
+
+def join_intervals(starts, ends, timestamps):
+    """Returns the pairs of interval and sample indices of the samples falling in [start, end) of the intervals.
+
+    timestamps must be sorted. Samples in overlapping intervals are paired with each of them.
+    The pairs are ordered by interval and then by sample.
+    """
+    return expand_bounds(np.searchsorted(timestamps, starts, side="left"), np.searchsorted(timestamps, ends, side="left"))
+
+
+class TimeSeries:
+    def __init__(self, df: pd.DataFrame, timestamp_column="timestamp"):
+        df = df.assign(**{timestamp_column: to_utc_datetime(df[timestamp_column])})
+        if not df[timestamp_column].is_monotonic_increasing:
+            df = df.sort_values(by=timestamp_column, kind="stable")
+        self.df = df.reset_index(drop=True)
+        self.timestamp_column = timestamp_column
+        self.timestamps = pd.DatetimeIndex(self.df[timestamp_column]).asi8
+
+    def __len__(self):
+        return len(self.df)
+
+    def bounds(self, starts, ends, inclusive="both"):
+        """Returns the positions of the first row and past the last row of each time range."""
+        if inclusive not in INCLUSIVE:
+            raise Exception(f'The inclusive {inclusive} should be in {INCLUSIVE}')
+        lo = np.searchsorted(self.timestamps, to_nanoseconds(starts), side="left" if inclusive in ["both", "left"] else "right")
+        hi = np.searchsorted(self.timestamps, to_nanoseconds(ends), side="right" if inclusive in ["both", "right"] else "left")
+        return lo, np.maximum(hi, lo)
+
+    def slice(self, start, end, inclusive="both") -> pd.DataFrame:
+        """Returns the rows from start to end as a slice of the frame. Do not modify it."""
+        lo, hi = self.bounds(start, end, inclusive)
+        return self.df.iloc[lo[0]:hi[0]]
+
+    def slices(self, starts, ends, inclusive="both") -> list:
+        lo, hi = self.bounds(starts, ends, inclusive)
+        return [self.df.iloc[l:h] for l, h in zip(lo, hi)]
+
+    def take(self, starts, ends, inclusive="both") -> pd.DataFrame:
+        """Returns the rows of all the time ranges in one frame, with the position of their range in an interval column.
+
+        Rows in overlapping ranges are taken for each of them.
+        """
+        interval, positions = expand_bounds(*self.bounds(starts, ends, inclusive))
+        out = self.df.iloc[positions].reset_index(drop=True)
+        out.insert(0, "interval", interval)
+        return out
+
+
+class TimeSeriesStore:
+    def __init__(self):
+        self.series = {}
+
+    def add(self, name: str, df: pd.DataFrame, timestamp_column="timestamp") -> TimeSeries:
+        self.series[name] = TimeSeries(df, timestamp_column)
+        return self.series[name]
+
+    def __getitem__(self, name: str) -> TimeSeries:
+        if name not in self.series:
+            raise Exception(f'No time series named {name}. Known are {list(self.series.keys())}')
+        return self.series[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.series
+
+    def slice(self, name: str, start, end, inclusive="both") -> pd.DataFrame:
+        return self[name].slice(start, end, inclusive)
+
+    def take(self, name: str, starts, ends, inclusive="both") -> pd.DataFrame:
+        return self[name].take(starts, ends, inclusive)
@@ -1,120 +1,429 @@
+import io
+import itertools
 import json
 import datetime
 from pathlib import Path
 import os
-import hashlib
+import shutil
+import tempfile
 import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import click
 import pandas as pd
 import matplotlib.pyplot as plt
-from sage_data_client import query
 import numpy as np
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+from backend import query, query_chunks, CHUNK_MEMORY_BUDGET
+from cache import PartitionedCache, CACHE_ROOT, to_utc
+from journal import Journal, JOURNAL_FILENAME
+from sink import open_sink, get_output_path
+from schema import compact_frame, compact_instance_frame, concat_frames, format_timestamps, to_utc_datetime
+from timeseries import join_intervals
+from instrument import Tracer, NullTracer, get_tracer, set_tracer, trace, trace_labels
+from governor import MemoryGovernor
+
 
 pd.set_option('mode.chained_assignment',None)
 
 
-def download_performance_data(vsn, start, end=""):
+PERF_BUCKET = "grafana-agent"
+CONTAINER_METRICS = "container_cpu_usage_seconds_total|container_memory_rss|container_memory_working_set_bytes"
+TEGRA_METRICS = "tegra_wattage_current_milliwatts"
+PERF_METRICS = f'{CONTAINER_METRICS}|{TEGRA_METRICS}'
+JOB_BUCKET = None
+JOB_EVENTS = "sys.scheduler.status.plugin.launched|sys.scheduler.status.plugin.complete|sys.scheduler.status.plugin.failed"
+
+
+def download_performance_data(vsn, start, end="", containers=None, memory_budget=None):
+    """Downloads the performance data of the node.
+
+    If memory_budget is given, returns an iterator of chunks taking about memory_budget
+    bytes each instead of a single data frame.
+    """
+    if containers is not None:
+        return download_container_performance_data(vsn, start, end, containers, memory_budget)
+
     filter={
         "vsn": vsn.upper(),
-        "name": "container_cpu_usage_seconds_total|container_memory_rss|container_memory_working_set_bytes|tegra_wattage_current_milliwatts"
+        "name": PERF_METRICS
     }
 
+    if memory_budget is not None:
+        return query_chunks(
+            start=start,
+            end=None if end == "" else end,
+            filter=filter,
+            bucket=PERF_BUCKET,
+            memory_budget=memory_budget)
+
     if end == "":
-        return query(
+        return compact_frame(query(
             start=start,
             filter=filter,
-            bucket="grafana-agent")
+            bucket=PERF_BUCKET))
     else:
-        return query(
+        return compact_frame(query(
             start=start,
             end=end,
             filter=filter,
-            bucket="grafana-agent")
+            bucket=PERF_BUCKET))
+
+
+def download_container_performance_data(vsn, start, end, containers, memory_budget=None):
+    """Downloads the container metrics of the given containers only, along with the power metrics of the node."""
+    container_filter = {
+        "vsn": vsn.upper(),
+        "name": CONTAINER_METRICS,
+        "container": "|".join(sorted(containers)),
+    }
+    tegra_filter = {
+        "vsn": vsn.upper(),
+        "name": TEGRA_METRICS,
+    }
+    end = None if end == "" else end
+    if memory_budget is not None:
+        return itertools.chain.from_iterable(
+            query_chunks(start=start, end=end, filter=f, bucket=PERF_BUCKET, memory_budget=memory_budget) for f in [container_filter, tegra_filter])
+    dfs = [query(start=start, end=end, filter=f, bucket=PERF_BUCKET) for f in [container_filter, tegra_filter]]
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    df = compact_frame(pd.concat(dfs, ignore_index=True))
+    if "meta.container" not in df.columns:
+        df["meta.container"] = pd.Categorical([None] * len(df))
+    return df.sort_values(by="timestamp", kind="stable", ignore_index=True)
 
 
-def download_scheduler_event(vsn, start, end=""):
+def download_scheduler_event(vsn, start, end="", memory_budget=None):
     filter={
         "vsn": vsn.upper(),
-        "name": "sys.scheduler.status.plugin.launched|sys.scheduler.status.plugin.complete|sys.scheduler.status.plugin.failed"
+        "name": JOB_EVENTS
     }
 
+    if memory_budget is not None:
+        return query_chunks(
+            start=start,
+            end=None if end == "" else end,
+            filter=filter,
+            memory_budget=memory_budget)
+
     if end == "":
-        return query(
+        return compact_frame(query(
             start=start,
-            filter=filter)
+            filter=filter))
     else:
-        return query(
+        return compact_frame(query(
             start=start,
             end=end,
-            filter=filter)
+            filter=filter))
+
+SAGE_HOST = "data.sagecontinuum.org"
 
 DOWNLOAD_TYPE_JOB = "job"
 DOWNLOAD_TYPE_PERF = "perf"
+# Bucket and metric filter of each download type. They are part of the cache key
+DOWNLOAD_QUERIES = {
+    DOWNLOAD_TYPE_JOB: (JOB_BUCKET, JOB_EVENTS),
+    DOWNLOAD_TYPE_PERF: (PERF_BUCKET, PERF_METRICS),
+}
+
+# Performance data of a run is queried with its window padded on both sides
+PERF_QUERY_PADDING = pd.to_timedelta(1, unit='m')
+# Run windows apart less than the gap are fetched in a single query
+PERF_QUERY_MERGE_GAP = pd.to_timedelta(1, unit='m')
+# A merged query never spans longer than this to keep server-side loads low
+PERF_QUERY_MAX_SPAN = pd.to_timedelta(6, unit='h')
+# Spans are shortened down to this under memory pressure
+PERF_QUERY_MIN_SPAN = pd.to_timedelta(10, unit='m')
+# The response of a query takes about this many times the memory of its compact records while being parsed
+PERF_FETCH_OVERHEAD = 5
+# Queries fetched in chunks under memory pressure take at least this many bytes per chunk
+PERF_FETCH_MIN_CHUNK = 4 * 2**20
+# Performance data held for later runs are spilled to this directory next to the outputs
+PERF_SPILL_DIRNAME = "perf.spill"
+# Under memory pressure, the runs of a day are fetched in batch in no more than this many queries
+PERF_BATCH_MAX_PARTS = 24
+
+# Performance data are fetched either for the containers of the plugins of interest (narrow),
+# or for all containers on the node (wide). The auto strategy fetches narrow as long as
+# windows of no more than PERF_QUERY_NARROW_MAX_PLUGINS plugins overlap in a query
+PERF_FETCH_STRATEGIES = ["auto", "narrow", "wide"]
+PERF_QUERY_NARROW_MAX_PLUGINS = 4
+
+# A bulk download window with more records than this is stored in halves
+DOWNLOAD_MAX_ROWS = 500000
+# Windows failing to download are bisected down to this length
+DOWNLOAD_MIN_WINDOW = pd.to_timedelta(1, unit='m')
+# Windows of sparse data grow up to this length
+DOWNLOAD_MAX_WINDOW = pd.to_timedelta(31, unit='D')
+
+class RateLimiter:
+    """Spaces out calls so that no more than rate calls are made per second."""
+    def __init__(self, rate: float):
+        self.interval = 1. / rate
+        self.lock = threading.Lock()
+        self.next_call = 0.
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# Rate limiters are shared by all downloads hitting the same host
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(host: str, rate: float) -> RateLimiter:
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None or limiter.interval != 1. / rate:
+            limiter = _rate_limiters[host] = RateLimiter(rate)
+        return limiter
+
 
 def download_bulk_data(download_type, download_func, vsn,
     start, end="",
-    window='D', verbose=True):
-    path = Path.home().joinpath(f'.waggle/{vsn}/{download_type}')
-    os.makedirs(path, exist_ok=True)
-    df = pd.DataFrame()
+    window='D', verbose=True,
+    workers=1, rate_limit=None,
+    max_rows=DOWNLOAD_MAX_ROWS,
+    memory_budget=None, load=True,
+    refresh_from=None, root=CACHE_ROOT):
+    """Downloads data in windows, serving the already cached parts from the local cache.
+
+    The range is split into windows of length window, or of the length remembered in the
+    cache by earlier downloads of the same data. A window failing to download is bisected
+    and retried down to DOWNLOAD_MIN_WINDOW, and a window with more than max_rows records
+    is stored in halves. Afterwards, adjacent sparse windows are merged in the cache, and
+    the window length holding max_rows / 2 records at the densest rate seen is remembered.
+
+    If refresh_from is given, the data cached from refresh_from on are downloaded again,
+    e.g. to fetch records that arrived late. The cache is kept under root.
+
+    Uncached parts are downloaded by up to workers threads in parallel. If rate_limit
+    is given, no more than rate_limit queries per second are sent to the Sage server.
+
+    If memory_budget is given, download_func is called with a share of it per worker and
+    the chunks it returns are stored in the cache as they arrive, so that no more than
+    about memory_budget bytes of the downloads are held in memory. The data are returned
+    in time order, or the cache holding them is returned if load is False, e.g. to read
+    them one entry at a time with generate_job_records_from_cache.
+    """
+    bucket, name_filter = DOWNLOAD_QUERIES[download_type]
+    cache = PartitionedCache(vsn, download_type, bucket, name_filter, root)
+    if refresh_from is not None:
+        refreshed = cache.invalidate(refresh_from)
+        if refreshed > 0:
+            logging.info(f'{vsn}: Downloading {refreshed} cached windows from {to_utc(refresh_from).isoformat()} again.')
+    limiter = get_rate_limiter(SAGE_HOST, rate_limit) if rate_limit else None
 
     # if end == "":
     #     end = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    ranges = pd.date_range(start=start, end=end, freq="D")
+    if cache.window is not None:
+        logging.info(f'{vsn}: Using the window of {cache.window} remembered in the cache.')
+        window = cache.window
+    ranges = pd.date_range(start=start, end=end, freq=window)
     if end > ranges[-1]:
         ranges = ranges.append(pd.DatetimeIndex([end]))
-    start_t = None
-    t = tqdm(ranges)
-    for date in t:
-        if start_t is None:
-            start_t = date.isoformat()
-            continue
-        
-        end_t = date.isoformat()
-        string = f'{vsn},{start_t},{end_t}'
-        md5checksum = hashlib.md5(string.encode())
-        filename = f'{md5checksum.hexdigest()}.csv'
-        cache_path = path.joinpath(filename)
-        t.write(f'{vsn}: Querying {start_t} - {end_t}')
-        if cache_path.exists():
-            t.write(f'{vsn}: Cache found {cache_path}. Reading the file instead of downloading.')
-            _df = pd.read_csv(cache_path)
-        else:
-            t.write(f'{vsn}: Downloading {start_t} - {end_t}')
-            _df = download_func(vsn, start_t, end_t)
-            _df.to_csv(cache_path, index=False)
-            t.write(f'{vsn}: Saving to {cache_path}')
-        df = pd.concat([df, _df])
-        start_t = end_t
+    t = tqdm(total=len(ranges) - 1)
+    densities = []
+
+    def store_window(start_t, end_t, _df):
+        if len(_df) > max_rows and end_t - start_t >= 2 * DOWNLOAD_MIN_WINDOW:
+            middle = start_t + (end_t - start_t) / 2
+            t.write(f'{vsn}: {len(_df)} records exceed {max_rows} records. Storing {start_t.isoformat()} - {end_t.isoformat()} in halves.')
+            timestamps = pd.to_datetime(_df["timestamp"], utc=True)
+            store_window(start_t, middle, _df[timestamps < middle])
+            store_window(middle, end_t, _df[timestamps >= middle])
+            return
+        with trace("cache_write", rows_in=len(_df)):
+            path = cache.write(start_t, end_t, _df)
+        densities.append(len(_df) / (end_t - start_t).total_seconds())
+        t.write(f'{vsn}: Saving {len(_df)} records to {path}')
+
+    def download_window(start_t, end_t):
+        if limiter is not None:
+            limiter.wait()
+        t.write(f'{vsn}: Downloading {start_t.isoformat()} - {end_t.isoformat()}')
+        try:
+            if memory_budget is not None:
+                with trace("download_chunks") as stage:
+                    chunks = download_func(vsn, start_t.isoformat(), end_t.isoformat(), memory_budget=memory_budget // workers)
+                    path, rows = cache.write_chunks(start_t, end_t, chunks)
+                    stage.rows_out = rows
+                densities.append(rows / (end_t - start_t).total_seconds())
+                t.write(f'{vsn}: Saving {rows} records to {path}')
+                return
+            with trace("download") as stage:
+                _df = download_func(vsn, start_t.isoformat(), end_t.isoformat())
+                stage.rows_out = len(_df)
+        except Exception as ex:
+            if end_t - start_t < 2 * DOWNLOAD_MIN_WINDOW:
+                raise
+            middle = start_t + (end_t - start_t) / 2
+            t.write(f'{vsn}: Downloading {start_t.isoformat()} - {end_t.isoformat()} failed: {ex}. Splitting the window into halves.')
+            download_window(start_t, middle)
+            download_window(middle, end_t)
+            return
+        store_window(start_t, end_t, _df)
+
+    def download_window_of_vsn(start_t, end_t):
+        # Stages in the worker threads are labelled with the VSN as well
+        with trace_labels(vsn=vsn):
+            download_window(start_t, end_t)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for start_t, end_t in zip(ranges[:-1], ranges[1:]):
+            t.write(f'{vsn}: Querying {start_t.isoformat()} - {end_t.isoformat()}')
+            missing = cache.missing(start_t, end_t)
+            if len(missing) == 0:
+                t.write(f'{vsn}: Cache found in {cache.path}. Reading the cache instead of downloading.')
+            futures.append([executor.submit(download_window_of_vsn, s, e) for s, e in missing])
+        for window_futures in futures:
+            for f in window_futures:
+                f.result()
+            t.update()
+    t.close()
+
+    if len(densities) > 0:
+        density = max(densities)
+        learned = DOWNLOAD_MAX_WINDOW if density == 0 else pd.to_timedelta(max_rows / 2 / density, unit="s")
+        learned = min(max(learned, DOWNLOAD_MIN_WINDOW), DOWNLOAD_MAX_WINDOW).floor("min")
+        cache.remember_window(learned)
+        merged = cache.merge(max_rows // 2)
+        logging.info(f'{vsn}: {merged} sparse windows merged in the cache. Later downloads use windows of {learned}.')
+    if not load:
+        return cache
+    with trace("cache_read") as stage:
+        df = cache.read(ranges[0], ranges[-1])
+        stage.rows_out = len(df)
     return df
 
 def generate_job_records(df):
     # Just to ensure the timestamp is in the right format, not string
     df["timestamp"] = pd.to_datetime(df["timestamp"])
-    
-    out_df = fill_completion_failure(parse_events(df))
-    out_df["timestamp"] = out_df["timestamp"].map(lambda x: x.isoformat())
-    if "completed_at" in out_df.columns:
-        out_df["completed_at"] = out_df["completed_at"].map(lambda x: x.isoformat())
-    if "failed_at" in out_df.columns:
-        out_df["failed_at"] = out_df["failed_at"].map(lambda x: x.isoformat())
+
+    with trace("parse_events", rows_in=len(df)) as stage:
+        out_df = parse_events(df)
+        stage.rows_out = len(out_df)
+    with trace("fill_completion_failure", rows_in=len(out_df)) as stage:
+        out_df = fill_completion_failure(out_df)
+        stage.rows_out = len(out_df)
+    with trace("format_job_records", rows_in=len(out_df)):
+        out_df = format_job_records(out_df)
     return out_df.sort_values(by="plugin_name")
 
 
+def format_job_records(out_df):
+    for column in ["timestamp", "completed_at", "failed_at"]:
+        if column in out_df.columns:
+            out_df[column] = format_timestamps(out_df[column])
+    return out_df
+
+
+# Columns fill_completion_failure derives from the completion or failure of a launch
+JOB_END_STATE_COLUMNS = ["completed_at", "failed_at", "execution_time", "end_state"]
+# Events are fetched again from this long before the high-water mark to catch late ones
+JOB_SYNC_OVERLAP = pd.to_timedelta(10, unit='m')
+
+def merge_job_records(records: pd.DataFrame, events: pd.DataFrame) -> pd.DataFrame:
+    """Merges newly fetched scheduler events into the job records made from earlier events.
+
+    Completed and failed records are final. Records of unknown end state are matched again
+    with the completions and failures in the events. Launches found in the records already
+    are not added again.
+    """
+    events["timestamp"] = to_utc_datetime(events["timestamp"])
+    parsed = parse_events(events)
+    if len(records) == 0:
+        return format_job_records(fill_completion_failure(parsed)).sort_values(by=["plugin_name", "timestamp"], kind="stable")
+
+    final = records[records["end_state"] != "unknown"]
+    pending = records[records["end_state"] == "unknown"]
+    pending = pending.drop(columns=[c for c in JOB_END_STATE_COLUMNS if c in pending.columns])
+    pending["timestamp"] = to_utc_datetime(pending["timestamp"])
+    parsed = parsed[~parsed["k3s_pod_instance"].isin(final["k3s_pod_instance"])]
+    combined = pd.concat([pending, parsed], ignore_index=True)
+    is_launched = combined["event"].str.contains("launched")
+    combined = combined[~(is_launched & combined.duplicated(subset=["k3s_pod_instance", "event"]))]
+
+    resolved = fill_completion_failure(combined)
+    if len(resolved) > 0:
+        resolved = format_job_records(resolved)
+    out_df = pd.concat([final, resolved], ignore_index=True)
+    return out_df.sort_values(by=["plugin_name", "timestamp"], kind="stable")
+
+
+def generate_job_records_from_cache(cache: PartitionedCache, start, end) -> pd.DataFrame:
+    """Generates the job records of the scheduler events cached in [start, end).
+
+    The events are read and merged into the records one cache entry at a time, so that
+    only the events of one entry are held in memory along with the records.
+    """
+    records = pd.DataFrame()
+    for events in cache.iter_read(start, end):
+        if len(events) == 0:
+            continue
+        with trace("merge_job_records", rows_in=len(events)) as stage:
+            records = merge_job_records(records, events)
+            stage.rows_out = len(records)
+    return records
+
+
+def sync_job_records(store, download_func, start, end, overlap=JOB_SYNC_OVERLAP) -> pd.DataFrame:
+    """Fetches the scheduler events newer than the high-water mark of the JobStore and merges them in.
+
+    start is used only when the store has never been synced. download_func takes vsn,
+    start, end, and refresh, which is True when the range overlaps with the last sync so
+    that cached events in it must be downloaded again to catch those arriving late.
+    Returns all the job records in the store.
+    """
+    high_water_mark = store.high_water_mark
+    if high_water_mark is not None:
+        start = high_water_mark - overlap
+        logging.info(f'{store.vsn}: High-water mark is {high_water_mark.isoformat()}. Fetching events from {start.isoformat()}.')
+    records = store.load()
+    events = download_func(store.vsn, start, end, high_water_mark is not None)
+    if len(events) == 0:
+        logging.info(f'{store.vsn}: No new events found.')
+        return records
+
+    out_df = merge_job_records(records, events)
+    new_high_water_mark = events["timestamp"].max()
+    if high_water_mark is not None:
+        new_high_water_mark = max(new_high_water_mark, high_water_mark)
+    store.save(out_df, new_high_water_mark)
+    logging.info(f'{store.vsn}: {len(events)} events merged. {len(out_df) - len(records)} new records. {(out_df["end_state"] == "unknown").sum()} records remain unknown.')
+    return out_df
+
+
 
 def parse_events(df):
-    v = []
-    for _, row in df.iterrows():
-        r = json.loads(row.value)
-        r["timestamp"] = row.timestamp.isoformat()
-        r["node"] = row["meta.node"]
-        r["vsn"] = row["meta.vsn"]
-        r["event"] = row["name"]
-        v.append(r)
-    return pd.read_json(json.dumps(v))
+    if len(df) == 0:
+        return pd.DataFrame()
+    # All event payloads are decoded at once as JSON lines
+    out = pd.read_json(io.StringIO("\n".join(df["value"])), lines=True)
+    # Keep the column order of the row-by-row parsing: fields of the first event,
+    # the event metadata, then the fields only found in later events
+    first_columns = list(json.loads(df["value"].iloc[0]).keys())
+    out["timestamp"] = pd.to_datetime(df["timestamp"].reset_index(drop=True), utc=True)
+    out["node"] = df["meta.node"].values
+    out["vsn"] = df["meta.vsn"].values
+    out["event"] = df["name"].values
+    columns = first_columns + ["timestamp", "node", "vsn", "event"]
+    return out[columns + [c for c in out.columns if c not in columns]]
 
 
 def fill_completion_failure(df):
@@ -124,26 +433,51 @@ def fill_completion_failure(df):
     launched = df[df.event.str.contains("launched")]
     completed = df[df.event.str.contains("complete")]
     failed = df[df.event.str.contains("failed")]
-    # launched.loc[launched["k3s_pod_name"] == completed["k3s_pod_name"]]
-    for index, p in launched.iterrows():
-        found = completed[completed.k3s_pod_instance == p.k3s_pod_instance]
-        if len(found) > 0:
-            launched.loc[index, "completed_at"] = found.iloc[0].timestamp
-            launched.loc[index, "execution_time"] = (found.iloc[0].timestamp - p.timestamp).total_seconds()
-            launched.loc[index, "k3s_pod_node_name"] = found.iloc[0].k3s_pod_node_name
-            launched.loc[index, "end_state"] = "completed"
-        else:
-            found = failed[failed.k3s_pod_instance == p.k3s_pod_instance]
-            if len(found) > 0:
-                launched.loc[index, "failed_at"] = found.iloc[0].timestamp
-                launched.loc[index, "execution_time"] = (found.iloc[0].timestamp - p.timestamp).total_seconds()
-                launched.loc[index, "reason"] = found.iloc[0].reason
-                if "error_log" in found.iloc[0]:
-                    launched.loc[index, "error_log"] = found.iloc[0]["error_log"]
-                launched.loc[index, "k3s_pod_node_name"] = found.iloc[0].k3s_pod_node_name
-                launched.loc[index, "end_state"] = "failed"
-            else:
-                launched.loc[index, "end_state"] = "unknown"
+    if len(launched) == 0:
+        return launched
+    # Each launch is matched to the first completion of its instance, or the first failure if never completed
+    completed = completed.dropna(subset=["k3s_pod_instance"]).drop_duplicates(subset="k3s_pod_instance").set_index("k3s_pod_instance")
+    failed = failed.dropna(subset=["k3s_pod_instance"]).drop_duplicates(subset="k3s_pod_instance").set_index("k3s_pod_instance")
+    instance = launched["k3s_pod_instance"]
+    is_completed = instance.isin(completed.index)
+    is_failed = ~is_completed & instance.isin(failed.index)
+
+    def found(frame, column, mask):
+        if column not in frame.columns:
+            return pd.Series(np.nan, index=launched.index)
+        return instance.map(frame[column]).where(mask)
+
+    def overwrite(column, mask, value):
+        if column in launched.columns:
+            return value.where(mask, launched[column])
+        return value.where(mask)
+
+    values = {}
+    values["completed_at"] = found(completed, "timestamp", is_completed)
+    values["failed_at"] = found(failed, "timestamp", is_failed)
+    ended_at = values["completed_at"].where(is_completed, values["failed_at"])
+    values["execution_time"] = (ended_at - launched["timestamp"]).dt.total_seconds()
+    values["reason"] = overwrite("reason", is_failed, found(failed, "reason", is_failed))
+    if "error_log" in failed.columns:
+        values["error_log"] = overwrite("error_log", is_failed, found(failed, "error_log", is_failed))
+    values["k3s_pod_node_name"] = overwrite(
+        "k3s_pod_node_name",
+        is_completed | is_failed,
+        found(completed, "k3s_pod_node_name", is_completed).where(is_completed, found(failed, "k3s_pod_node_name", is_failed)))
+    values["end_state"] = pd.Series(
+        np.select([is_completed, is_failed], ["completed", "failed"], "unknown"),
+        index=launched.index)
+
+    # Columns are added in the order the end states first appear in the launches
+    state_columns = {
+        "completed": ["completed_at", "execution_time", "k3s_pod_node_name", "end_state"],
+        "failed": ["failed_at", "execution_time", "reason", "error_log", "k3s_pod_node_name", "end_state"],
+        "unknown": ["end_state"],
+    }
+    for state in values["end_state"].unique():
+        for column in state_columns[state]:
+            if column in values:
+                launched[column] = values[column]
     return launched
 
 
@@ -159,7 +493,7 @@ def calculate_cpu_utilization_from_cpuseconds(_df, new_t):
 
 
 def is_gpu_requested(plugin_instance_record: pd.Series):
-    if plugin_instance_record.plugin_selector is np.nan:
+    if pd.isna(plugin_instance_record.plugin_selector) or plugin_instance_record.plugin_selector == "":
         return False
 
     selector = json.loads(plugin_instance_record.plugin_selector)
@@ -169,7 +503,317 @@ def is_gpu_requested(plugin_instance_record: pd.Series):
     return False
 
 
-def generate_metrics_from_instance(t: tqdm, run: pd.Series):
+def get_run_window(run: pd.Series, padding=PERF_QUERY_PADDING):
+    """Returns the padded time window in which performance data of the run is queried."""
+    return pd.to_datetime(run.timestamp) - padding, pd.to_datetime(run.completed_at) + padding
+
+
+def plan_performance_queries(runs: pd.DataFrame, padding=PERF_QUERY_PADDING, gap=PERF_QUERY_MERGE_GAP, max_span=PERF_QUERY_MAX_SPAN):
+    """Merges the padded windows of the runs into a minimal set of query spans per VSN.
+
+    Windows that overlap or are apart less than gap are merged as long as the merged
+    span does not exceed max_span. Returns a data frame of the spans (vsn, start, end)
+    and a series mapping each k3s_pod_instance to the index of the span covering it.
+    """
+    runs = runs.reset_index(drop=True)
+    windows = pd.DataFrame({
+        "k3s_pod_instance": runs["k3s_pod_instance"],
+        "vsn": runs["vsn"].str.upper(),
+        "start": to_utc_datetime(runs["timestamp"]) - padding,
+        "end": to_utc_datetime(runs["completed_at"]) + padding,
+    }).sort_values(by=["vsn", "start"])
+
+    spans = []
+    assignment = {}
+    for vsn, vsn_windows in windows.groupby("vsn"):
+        span_start, span_end = None, None
+        for w in vsn_windows.itertuples(index=False):
+            if span_start is not None and w.start <= span_end + gap and max(span_end, w.end) - span_start <= max_span:
+                span_end = max(span_end, w.end)
+            else:
+                if span_start is not None:
+                    spans.append((vsn, span_start, span_end))
+                span_start, span_end = w.start, w.end
+            assignment[w.k3s_pod_instance] = len(spans)
+        if span_start is not None:
+            spans.append((vsn, span_start, span_end))
+    spans = pd.DataFrame(spans, columns=["vsn", "start", "end"])
+    return spans, pd.Series(assignment, dtype=int)
+
+
+def select_fetch_strategy(plugins, strategy="auto", narrow_max_plugins=PERF_QUERY_NARROW_MAX_PLUGINS) -> str:
+    """Returns narrow or wide for a query covering the windows of the plugins."""
+    if strategy == "auto":
+        return "narrow" if len(plugins) <= narrow_max_plugins else "wide"
+    if strategy not in PERF_FETCH_STRATEGIES:
+        raise Exception(f'The fetch strategy {strategy} should be in {PERF_FETCH_STRATEGIES}')
+    return strategy
+
+
+def fetch_performance_data(download_func, vsn, start, end, plugins, strategy="auto", memory_budget=None):
+    """Fetches the performance data of the plugins with the selected strategy.
+
+    If memory_budget is given, the data are downloaded in chunks taking about memory_budget
+    bytes, each compacted as it arrives, instead of parsing the whole response at once.
+    Returns the data, the strategy used, and the number of records discarded as they
+    belong to containers of no interest, which a narrow query would not have fetched.
+    """
+    strategy = select_fetch_strategy(plugins, strategy)
+    chunks = {} if memory_budget is None else {"memory_budget": memory_budget}
+    if strategy == "narrow":
+        df = download_func(vsn, start, end, containers=list(plugins), **chunks)
+    else:
+        df = download_func(vsn, start, end, **chunks)
+    if memory_budget is not None:
+        df = concat_frames(df)
+        if len(df) > 0:
+            if "meta.container" not in df.columns:
+                df["meta.container"] = pd.Categorical([None] * len(df))
+            df = df.sort_values(by="timestamp", kind="stable", ignore_index=True)
+    discarded = 0
+    if len(df) > 0 and "meta.container" in df.columns:
+        discarded = int((df["meta.container"].notna() & ~df["meta.container"].isin(plugins) & (df["name"] != TEGRA_METRICS)).sum())
+    logging.debug(f'{vsn}: {strategy} query for {len(plugins)} plugins from {start} to {end} fetched {len(df)} records, {discarded} not needed')
+    return df, strategy, discarded
+
+
+def get_fetch_budget(governor: MemoryGovernor, estimate: float):
+    """Returns the memory budget of the chunks to fetch a query in, or None to fetch it at once.
+
+    estimate is the expected memory of the compact records of the query. The query is
+    fetched in chunks if parsing it at once would not fit in the memory left.
+    """
+    headroom = governor.headroom()
+    if estimate * PERF_FETCH_OVERHEAD < headroom:
+        return None
+    memory_budget = int(min(CHUNK_MEMORY_BUDGET, max(PERF_FETCH_MIN_CHUNK, headroom // 4)))
+    governor.adapt("chunked", f'Fetching about {estimate / 2**20:.1f} MB of records in chunks of {memory_budget / 2**20:.0f} MB.')
+    return memory_budget
+
+
+class PerformanceQueryPlanner:
+    """Serves performance data of runs from a minimal set of merged queries.
+
+    Each merged span is downloaded once on the first request of a run it covers,
+    kept sorted by timestamp, and sliced locally for every run. A span is released
+    as soon as all the runs it covers have been served.
+
+    If governor is given and the memory is under pressure when a span is to be
+    downloaded, the spans held for later runs are spilled to spill_dir, and the spans
+    not downloaded yet are planned again shorter and narrow. Call close to remove the
+    spilled spans.
+    """
+    def __init__(self, runs: pd.DataFrame, download_func=download_performance_data, padding=PERF_QUERY_PADDING, gap=PERF_QUERY_MERGE_GAP, max_span=PERF_QUERY_MAX_SPAN, strategy="auto", governor=None, spill_dir=None):
+        self.download_func = download_func
+        self.padding = padding
+        self.gap = gap
+        self.max_span = max_span
+        self.strategy = strategy
+        self.governor = governor
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self.runs = runs
+        self.spans, self.assignment = plan_performance_queries(runs, padding, gap, max_span)
+        span_of_run = self.assignment[runs["k3s_pod_instance"]].values
+        self.plugins = runs.groupby(span_of_run)["plugin_name"].unique().to_dict() if len(runs) > 0 else {}
+        self.strategies = {"narrow": 0, "wide": 0}
+        self.fetched_rows = 0
+        self.discarded_rows = 0
+        self.remaining = self.assignment.value_counts().to_dict()
+        self.frames = {}
+        self.bytes_per_row = {}
+        self.queries = 0
+        self.fetched_bytes = 0
+        self.fetched_seconds = 0.
+        self.served_runs = 0
+        self.served_bytes = 0
+
+    def get(self, run: pd.Series) -> pd.DataFrame:
+        span_index = self.assignment[run.k3s_pod_instance]
+        if span_index not in self.frames:
+            if self.governor is not None and self.governor.under_pressure():
+                self.spill()
+                if self.governor.under_pressure():
+                    self.shrink()
+                    span_index = self.assignment[run.k3s_pod_instance]
+            span = self.spans.iloc[span_index]
+            memory_budget = None
+            if self.governor is not None:
+                seconds = (span.end - span.start).total_seconds()
+                memory_budget = get_fetch_budget(self.governor, self.fetched_bytes / self.fetched_seconds * seconds if self.fetched_seconds > 0 else 0)
+            with trace("fetch") as stage:
+                df, strategy, discarded = fetch_performance_data(self.download_func, span.vsn, span.start.isoformat(), span.end.isoformat(), self.plugins[span_index], self.strategy, memory_budget)
+                if len(df) > 0:
+                    df = df.sort_values(by="timestamp", kind="stable", ignore_index=True)
+                stage.rows_out = len(df)
+            self.strategies[strategy] += 1
+            self.fetched_rows += len(df)
+            self.discarded_rows += discarded
+            self.frames[span_index] = df
+            self.queries += 1
+            fetched_bytes = df.memory_usage(index=False, deep=True).sum()
+            self.fetched_bytes += fetched_bytes
+            # Slices share the categories of the span, so they are counted at its bytes per row
+            self.bytes_per_row[span_index] = fetched_bytes / len(df) if len(df) > 0 else 0
+            self.fetched_seconds += (span.end - span.start).total_seconds()
+
+        df = self.frames[span_index]
+        if isinstance(df, Path):
+            with trace("read_spilled") as stage:
+                path, df = df, pd.read_parquet(df)
+                os.remove(path)
+                stage.rows_out = len(df)
+            self.frames[span_index] = df
+        if len(df) > 0:
+            start, end = get_run_window(run, self.padding)
+            lo, hi = df["timestamp"].searchsorted([start, end], side="left")
+            df = df.iloc[lo:hi]
+        self.served_runs += 1
+        self.served_bytes += len(df) * self.bytes_per_row[span_index]
+
+        self.remaining[span_index] -= 1
+        if self.remaining[span_index] == 0:
+            del self.frames[span_index]
+            del self.bytes_per_row[span_index]
+        return df
+
+    def order(self, runs: pd.DataFrame) -> pd.DataFrame:
+        """Returns the runs in the order of the spans covering them, keeping their order within a span."""
+        return runs.iloc[np.argsort(self.assignment[runs["k3s_pod_instance"]].values, kind="stable")]
+
+    def spill(self):
+        """Writes the spans held for later runs to Parquet files in spill_dir and drops them from memory."""
+        spilled = [i for i, df in self.frames.items() if isinstance(df, pd.DataFrame) and len(df) > 0]
+        if len(spilled) == 0:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="perf-spill-"))
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with trace("spill") as stage:
+            for i in spilled:
+                path = self.spill_dir.joinpath(f'span-{i}.parquet')
+                stage.rows_in = (stage.rows_in or 0) + len(self.frames[i])
+                self.frames[i].to_parquet(path, index=False)
+                self.frames[i] = path
+        self.governor.adapt("spilled", f'Spilled the performance data of {len(spilled)} queries held for later runs to {self.spill_dir}.')
+
+    def shrink(self):
+        """Plans the spans not downloaded yet again with half the length, down to PERF_QUERY_MIN_SPAN, and narrow."""
+        unfetched = [i for i, n in self.remaining.items() if n > 0 and i not in self.frames]
+        if len(unfetched) == 0 or (self.max_span <= PERF_QUERY_MIN_SPAN and self.strategy == "narrow"):
+            return
+        self.max_span = max(self.max_span / 2, PERF_QUERY_MIN_SPAN)
+        self.strategy = "narrow"
+        runs = self.runs[self.runs["k3s_pod_instance"].map(self.assignment).isin(unfetched)]
+        spans, assignment = plan_performance_queries(runs, self.padding, self.gap, self.max_span)
+        spans.index += len(self.spans)
+        assignment += len(self.spans)
+        self.spans = pd.concat([self.spans, spans])
+        self.assignment.loc[assignment.index] = assignment.values
+        for i in unfetched:
+            del self.remaining[i]
+            del self.plugins[i]
+        self.remaining.update(assignment.value_counts().to_dict())
+        self.plugins.update(runs.groupby(assignment[runs["k3s_pod_instance"]].values)["plugin_name"].unique().to_dict())
+        self.governor.adapt("shrunk", f'Planned the {len(runs)} runs not fetched yet again in {len(spans)} narrow queries of up to {self.max_span}.')
+
+    def close(self):
+        if self.spill_dir is not None and self.spill_dir.exists():
+            shutil.rmtree(self.spill_dir)
+
+    def report(self) -> str:
+        return (f'{self.queries} queries made for {self.served_runs} runs '
+            f'({self.served_runs - self.queries} queries saved), '
+            f'{self.fetched_bytes / 1e6:.1f} MB fetched for {self.served_bytes / 1e6:.1f} MB served '
+            f'({(self.served_bytes - self.fetched_bytes) / 1e6:.1f} MB saved). '
+            f'{report_fetch_strategies(self.strategies, self.fetched_rows, self.discarded_rows)}')
+
+
+def report_fetch_strategies(strategies: dict, fetched_rows: int, discarded_rows: int) -> str:
+    return (f'{strategies["narrow"]} narrow and {strategies["wide"]} wide queries fetched {fetched_rows} records, '
+        f'{discarded_rows} of which were of other containers and could be saved by narrow queries')
+
+
+# Series of an instance taken from the performance data: (label, metric name, tegra sensor)
+INSTANCE_SERIES = [
+    ("rss", "container_memory_rss", None),
+    ("workingset", "container_memory_working_set_bytes", None),
+    ("sys_power", "tegra_wattage_current_milliwatts", "vdd_in"),
+    ("cpugpu_power", "tegra_wattage_current_milliwatts", "vdd_cpu_gpu_cv"),
+]
+
+
+def get_instance_series(perf_df: pd.DataFrame, plugin_name: str) -> pd.DataFrame:
+    """Returns the series of the plugin in the performance data as a long-format frame sorted by timestamp.
+
+    The frame has timestamp, series and value columns where series is one of the labels in INSTANCE_SERIES.
+    """
+    labels = pd.Series(None, index=perf_df.index, dtype=object)
+    for label, name, sensor in INSTANCE_SERIES:
+        if sensor is None:
+            mask = (perf_df["name"] == name) & (perf_df["meta.container"] == plugin_name)
+        elif "meta.sensor" in perf_df.columns:
+            mask = (perf_df["name"] == name) & (perf_df["meta.sensor"] == sensor)
+        else:
+            continue
+        labels[mask] = label
+    selected = labels.notna().values
+    series = pd.DataFrame({
+        "timestamp": perf_df["timestamp"].values[selected],
+        "series": labels.values[selected],
+        "value": perf_df["value"].values[selected],
+    })
+    series["timestamp"] = pd.to_datetime(series["timestamp"], utc=True)
+    return series.sort_values(by="timestamp", kind="stable", ignore_index=True)
+
+
+def align_series(df: pd.DataFrame, timeline, series: list, tolerance=None, direction="backward") -> pd.DataFrame:
+    """Pivots the series of a long-format frame onto a shared timeline.
+
+    df has timestamp, series and value columns and is sorted by timestamp. For each point of
+    the timeline, each series takes its last sample at or before the point (backward), its
+    first sample at or after the point (forward), or its closest sample (nearest). Samples
+    further than tolerance from the point are not taken. Returns a frame of the timeline
+    with one column per series.
+    """
+    timeline = pd.DatetimeIndex(pd.to_datetime(timeline, utc=True)).as_unit("ns")
+    points = timeline.asi8
+    tolerance = None if tolerance is None else pd.to_timedelta(tolerance).value
+    out = pd.DataFrame({"timestamp": timeline})
+
+    # A stable sort by series keeps the samples of each series in time order
+    codes = pd.Categorical(df["series"], categories=series).codes
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(series) + 1))
+    timestamps = pd.DatetimeIndex(df["timestamp"]).as_unit("ns").asi8[order]
+    values = df["value"].values[order]
+
+    for i, label in enumerate(series):
+        sample_timestamps = timestamps[bounds[i]:bounds[i + 1]]
+        sample_values = pd.Series(values[bounds[i]:bounds[i + 1]])
+        if len(sample_timestamps) == 0:
+            out[label] = np.nan
+            continue
+        backward = np.searchsorted(sample_timestamps, points, side="right") - 1
+        forward = np.searchsorted(sample_timestamps, points, side="left")
+        if direction == "backward":
+            position = backward
+        elif direction == "forward":
+            position = forward
+        elif direction == "nearest":
+            backward_distance = np.where(backward >= 0, points - sample_timestamps[np.clip(backward, 0, None)], np.iinfo(np.int64).max)
+            forward_distance = np.where(forward < len(sample_timestamps), sample_timestamps[np.clip(forward, None, len(sample_timestamps) - 1)] - points, np.iinfo(np.int64).max)
+            position = np.where(forward_distance < backward_distance, forward, backward)
+        else:
+            raise Exception(f'The direction {direction} should be in ["backward", "forward", "nearest"]')
+        found = (position >= 0) & (position < len(sample_timestamps))
+        position = np.clip(position, 0, len(sample_timestamps) - 1)
+        if tolerance is not None:
+            found &= np.abs(sample_timestamps[position] - points) <= tolerance
+        out[label] = sample_values.iloc[position].reset_index(drop=True).where(found)
+    return out
+
+
+def generate_metrics_from_instance(t: tqdm, run: pd.Series, perf_df=None):
     instance = run.k3s_pod_instance
     device = convert_nodename_to_devicename(run.k3s_pod_node_name)
     gpu_required = is_gpu_requested(run)
@@ -177,71 +821,629 @@ def generate_metrics_from_instance(t: tqdm, run: pd.Series):
     vsn = run.vsn
     started = pd.to_datetime(run.timestamp)
     completed = pd.to_datetime(run.completed_at)
-    extended_started = pd.to_datetime(run.timestamp) - pd.to_timedelta(1, unit='m')
-    extended_completed = pd.to_datetime(run.completed_at) + pd.to_timedelta(1, unit='m')
+    extended_started, extended_completed = get_run_window(run)
     extended_started = extended_started.isoformat()
     extended_completed = extended_completed.isoformat()
 
-    t.write(f'{instance}: Fetching data from cloud ranging from {extended_started} to {extended_completed}')
-    perf_df = download_performance_data(vsn, extended_started, extended_completed)
+    if perf_df is None:
+        t.write(f'{instance}: Fetching data from cloud ranging from {extended_started} to {extended_completed}')
+        perf_df = download_performance_data(vsn, extended_started, extended_completed)
     if len(perf_df) < 1:
         t.write(f'No record found for {instance}')
         return pd.DataFrame()
 
-    container_perf_df = perf_df[perf_df["meta.container"]==plugin_name]
-    container_cpu_perf_df = container_perf_df[container_perf_df["name"]=="container_cpu_usage_seconds_total"]
+    with trace("select_container", rows_in=len(perf_df)) as stage:
+        container_perf_df = perf_df[perf_df["meta.container"]==plugin_name]
+        container_cpu_perf_df = container_perf_df[container_perf_df["name"]=="container_cpu_usage_seconds_total"]
+        stage.rows_out = len(container_cpu_perf_df)
     t.write(f'{instance}: {len(container_cpu_perf_df)} CPU records found')
-    if len(container_cpu_perf_df) < 1:
-        cpu = pd.DataFrame([], columns=["timestamp", "cpu"])
-        cpu["timestamp"] = pd.to_datetime(cpu["timestamp"], utc=True)
-    else:
-        cpu = calculate_cpu_utilization_from_cpuseconds(container_cpu_perf_df.copy(), started)[["timestamp", "cpu"]]
-        cpu = cpu.sort_values(by="timestamp")
-
-    container_mem_rss_perf_df = container_perf_df[container_perf_df["name"]=="container_memory_rss"]
-    container_mem_workingset_perf_df = container_perf_df[container_perf_df["name"]=="container_memory_working_set_bytes"]
-    t.write(f'{instance}: {len(container_mem_workingset_perf_df)} Memory workingset records found')
-    if len(container_mem_workingset_perf_df) < 1:
-        mem = pd.DataFrame([], columns=["timestamp", "mem"])
-        mem["timestamp"] = pd.to_datetime(mem["timestamp"], utc=True)
-    else:
-        container_mem_workingset_perf_df["mem"] = container_mem_workingset_perf_df["value"].values + container_mem_rss_perf_df["value"].values
-        mem = container_mem_workingset_perf_df[["timestamp", "mem"]]
-    try:
-        mem = mem.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(cpu[["timestamp", "cpu"]], mem[["timestamp", "mem"]], on="timestamp")
-    except ValueError as ex:
-        t.write(f'{instance}: ERROR="{ex}" DATA={cpu}')
-        return pd.DataFrame()
+    with trace("cpu_utilization", rows_in=len(container_cpu_perf_df)) as stage:
+        if len(container_cpu_perf_df) < 1:
+            cpu = pd.DataFrame([], columns=["timestamp", "cpu"])
+            cpu["timestamp"] = pd.to_datetime(cpu["timestamp"], utc=True)
+        else:
+            cpu = calculate_cpu_utilization_from_cpuseconds(container_cpu_perf_df.copy(), started)[["timestamp", "cpu"]]
+            cpu = cpu.sort_values(by="timestamp")
+        stage.rows_out = len(cpu)
 
+    with trace("instance_series", rows_in=len(perf_df)) as stage:
+        series = get_instance_series(perf_df, plugin_name)
+        stage.rows_out = len(series)
+    counts = series["series"].value_counts()
+    t.write(f'{instance}: {counts.get("workingset", 0)} Memory workingset records found')
     if "meta.sensor" not in perf_df.columns:
         t.write(f'{instance}: meta.sensor field not found. Unable to retrive power measurements')
         t.write(f'{instance}: columns in the data are {perf_df.columns}')
-        pow = pd.DataFrame([], columns=["timestamp", "sys_power", "cpugpu_power"])
-        pow["timestamp"] = pd.to_datetime(pow["timestamp"], utc=True)
-        merged_instance = pd.merge_asof(merged_instance, pow, on="timestamp")
     else:
-        tegra_total_power = perf_df[(perf_df["name"] == "tegra_wattage_current_milliwatts") & (perf_df["meta.sensor"] == "vdd_in")]
-        t.write(f'{instance}: {len(tegra_total_power)} tegra power metric records found')
-        tegra_total_power = tegra_total_power.rename({"value": "sys_power"}, axis="columns")
-        tegra_total_power = tegra_total_power.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(merged_instance, tegra_total_power[["timestamp", "sys_power"]], on="timestamp")
-
-        tegra_cpugpu_power = perf_df[(perf_df["name"] == "tegra_wattage_current_milliwatts") & (perf_df["meta.sensor"] == "vdd_cpu_gpu_cv")]
-        t.write(f'{instance}: {len(tegra_total_power)} tegra cpugpu power metric records found')
-        tegra_cpugpu_power = tegra_cpugpu_power.rename({"value": "cpugpu_power"}, axis="columns")
-        tegra_cpugpu_power = tegra_cpugpu_power.sort_values(by="timestamp")
-        merged_instance = pd.merge_asof(merged_instance, tegra_cpugpu_power[["timestamp", "cpugpu_power"]], on="timestamp")
+        t.write(f'{instance}: {counts.get("sys_power", 0)} tegra power metric records found')
+        t.write(f'{instance}: {counts.get("cpugpu_power", 0)} tegra cpugpu power metric records found')
+
+    # All series are aligned onto the timeline of the CPU utilization. Memory is the sum
+    # of the RSS and workingset samples found at each point of the timeline
+    with trace("align_series", rows_in=len(series)) as stage:
+        merged_instance = align_series(series, cpu["timestamp"], ["rss", "workingset", "sys_power", "cpugpu_power"])
+        stage.rows_out = len(merged_instance)
+    merged_instance.insert(1, "cpu", cpu["cpu"].values)
+    merged_instance.insert(2, "mem", merged_instance.pop("workingset") + merged_instance.pop("rss"))
 
     # Merging all metrics
     merged_instance["plugin_instance"] = instance
     merged_instance["device"] = device
     merged_instance["gpu_requested"] = gpu_required
-    merged_instance['timestamp'] = merged_instance['timestamp'].map(lambda x: x.isoformat())
+    with trace("compact_instance_frame", rows_in=len(merged_instance)):
+        merged_instance = compact_instance_frame(merged_instance)
     t.write(f'{instance}: Generated {len(merged_instance)} records. Done.')
     return merged_instance
 
 
+# Container series taken from the performance data in addition to INSTANCE_SERIES
+CPU_SERIES = ("cpu", "container_cpu_usage_seconds_total", None)
+
+def generate_batch_metrics(runs: pd.DataFrame, perf_df: pd.DataFrame, padding=PERF_QUERY_PADDING) -> pd.DataFrame:
+    """Generates the metrics of all the runs from the performance data of their VSN in one pass.
+
+    Container samples are attributed to the runs of the plugin of the same name whose padded
+    window they fall in, and tegra power samples to all the runs whose window they fall in.
+    CPU utilization is computed with a single diff grouped by run, starting from zero at the
+    start of each run. The records are the same as generate_metrics_from_instance gives for
+    each run, ordered by run and then by timestamp.
+    """
+    columns = ["timestamp", "cpu", "mem", "sys_power", "cpugpu_power", "plugin_instance", "device", "gpu_requested"]
+    runs = runs.reset_index(drop=True)
+    if len(runs) == 0 or len(perf_df) == 0:
+        return compact_instance_frame(pd.DataFrame([], columns=columns))
+    started = pd.DatetimeIndex(to_utc_datetime(runs["timestamp"])).asi8
+    completed = pd.DatetimeIndex(to_utc_datetime(runs["completed_at"])).asi8
+    window_starts, window_ends = started - padding.value, completed + padding.value
+
+    # Samples are sorted by plugin and then by timestamp so that the samples of a plugin are
+    # a contiguous block in time order. Power samples are in a block of their own
+    with trace("join_samples", rows_in=len(perf_df)) as stage:
+        plugins = pd.Categorical(runs["plugin_name"])
+        samples = pd.DataFrame({
+            "timestamp": pd.DatetimeIndex(pd.to_datetime(perf_df["timestamp"], utc=True)).as_unit("ns").asi8,
+            "series": None,
+            "value": perf_df["value"].values,
+        })
+        block = np.full(len(perf_df), -1)
+        container = pd.Categorical(perf_df["meta.container"], categories=plugins.categories).codes
+        for label, name, sensor in [CPU_SERIES] + INSTANCE_SERIES:
+            if sensor is None:
+                mask = ((perf_df["name"] == name) & (container >= 0)).values
+                block[mask] = container[mask]
+            elif "meta.sensor" in perf_df.columns:
+                mask = ((perf_df["name"] == name) & (perf_df["meta.sensor"] == sensor)).values
+                block[mask] = len(plugins.categories)
+            else:
+                continue
+            samples.loc[mask, "series"] = label
+        samples["block"] = block
+        samples = samples[samples["block"] >= 0].sort_values(by=["block", "timestamp"], kind="stable", ignore_index=True)
+        bounds = np.searchsorted(samples["block"].values, np.arange(len(plugins.categories) + 2))
+
+        run_index, sample_index = [], []
+        for b in range(len(plugins.categories) + 1):
+            block_runs = np.flatnonzero(plugins.codes == b) if b < len(plugins.categories) else np.arange(len(runs))
+            i, j = join_intervals(window_starts[block_runs], window_ends[block_runs], samples["timestamp"].values[bounds[b]:bounds[b + 1]])
+            run_index.append(block_runs[i])
+            sample_index.append(bounds[b] + j)
+        run_index, sample_index = np.concatenate(run_index), np.concatenate(sample_index)
+        joined = samples.iloc[sample_index].reset_index(drop=True)
+        joined.insert(0, "run", run_index)
+        joined = joined.sort_values(by="run", kind="stable", ignore_index=True)
+        stage.rows_out = len(joined)
+
+    # The first sample of each run is compared to zero at the start of the run
+    with trace("cpu_utilization", rows_in=len(joined)) as stage:
+        cpu = joined[joined["series"] == "cpu"].reset_index(drop=True)
+        value = cpu["value"].astype(float).values
+        first = np.r_[True, cpu["run"].values[1:] != cpu["run"].values[:-1]] if len(cpu) > 0 else np.array([], dtype=bool)
+        previous_value = np.where(first, 0., np.roll(value, 1))
+        previous_timestamp = np.where(first, started[cpu["run"].values], np.roll(cpu["timestamp"].values, 1))
+        elapsed = pd.Series(cpu["timestamp"].values - previous_timestamp) / 1e9
+        merged = pd.DataFrame({
+            "run": cpu["run"].values,
+            "timestamp": pd.to_datetime(cpu["timestamp"].values, utc=True),
+            "cpu": (value - previous_value) / elapsed * 100.,
+        })
+        stage.rows_out = len(merged)
+
+    # Each series takes its last sample of the run at or before each CPU sample
+    with trace("merge_asof", rows_in=len(joined)) as stage:
+        merged = merged.sort_values(by="timestamp", kind="stable")
+        for label, _, _ in INSTANCE_SERIES:
+            series = joined.loc[joined["series"] == label, ["run", "timestamp", "value"]]
+            series = series.sort_values(by="timestamp", kind="stable").rename({"value": label}, axis="columns")
+            series["timestamp"] = pd.to_datetime(series["timestamp"].values, utc=True)
+            merged = pd.merge_asof(merged, series, on="timestamp", by="run")
+        merged = merged.sort_values(by=["run", "timestamp"], kind="stable", ignore_index=True)
+        merged["mem"] = merged["workingset"] + merged["rss"]
+        stage.rows_out = len(merged)
+
+    with trace("label_runs", rows_in=len(merged)):
+        run = merged["run"].values
+        merged["plugin_instance"] = runs["k3s_pod_instance"].values[run]
+        merged["device"] = runs["k3s_pod_node_name"].map(convert_nodename_to_devicename).values[run]
+        merged["gpu_requested"] = runs.apply(is_gpu_requested, axis=1).values[run]
+    with trace("compact_instance_frame", rows_in=len(merged)):
+        return compact_instance_frame(merged[columns])
+
+
+# Tegra sensors whose power is attributed to instances by attribute_energy
+ENERGY_SENSORS = ["vdd_in", "vdd_cpu_gpu_cv"]
+ENERGY_BASELINES = ["rolling", "min", "none"]
+# The idle power of the node is estimated by a low quantile of the power in a window centered at each sample
+ENERGY_BASELINE_WINDOW = pd.to_timedelta(10, unit='m')
+ENERGY_BASELINE_QUANTILE = 0.05
+
+
+def get_power_series(perf_df: pd.DataFrame, host=None, sensors=ENERGY_SENSORS) -> pd.DataFrame:
+    """Returns the tegra power of the node as a frame of timestamp and one column per sensor in milliwatts, sorted by timestamp.
+
+    If host is given, only the samples of the hosts containing it, e.g. nxcore, are taken.
+    """
+    if "meta.sensor" not in perf_df.columns:
+        return pd.DataFrame({"timestamp": pd.to_datetime([], utc=True)} | {sensor: [] for sensor in sensors})
+    mask = (perf_df["name"] == TEGRA_METRICS) & perf_df["meta.sensor"].isin(sensors)
+    if host is not None:
+        mask &= perf_df["meta.host"].astype(str).str.contains(host, regex=False)
+    series = pd.DataFrame({
+        "timestamp": to_utc_datetime(perf_df["timestamp"][mask]).values,
+        "series": perf_df["meta.sensor"][mask].astype(str).values,
+        "value": perf_df["value"][mask].astype(float).values,
+    }).sort_values(by="timestamp", kind="stable", ignore_index=True)
+    return align_series(series, series["timestamp"].unique(), sensors)
+
+
+def estimate_idle_power(power_df: pd.DataFrame, column: str, window=ENERGY_BASELINE_WINDOW, quantile=ENERGY_BASELINE_QUANTILE) -> np.ndarray:
+    """Returns the idle power at each sample as the given low quantile of the power within a window centered at the sample."""
+    power = pd.Series(power_df[column].values, index=pd.DatetimeIndex(power_df["timestamp"]))
+    return power.rolling(pd.to_timedelta(window), center=True, min_periods=1).quantile(quantile).values
+
+
+def attribute_energy(power_df: pd.DataFrame, intervals: pd.DataFrame, columns=ENERGY_SENSORS, baseline="rolling",
+                     window=ENERGY_BASELINE_WINDOW, quantile=ENERGY_BASELINE_QUANTILE,
+                     start_column="timestamp", end_column="completed_at") -> pd.DataFrame:
+    """Computes the energy in joules of the power above the baseline during each interval.
+
+    power_df has timestamp and power columns in milliwatts sorted by timestamp, e.g. from
+    get_power_series. The baseline is the rolling idle power from estimate_idle_power, the
+    minimum of the whole series (min), no baseline (none), or a constant in milliwatts.
+    Power below the baseline counts as zero so that no interval gets negative energy.
+
+    The power is integrated once into a cumulative trapezoidal integral and the energy of
+    each interval is the difference of the integral interpolated at its ends, so K intervals
+    take O(N + K log N) for N samples. Intervals not covered by the samples get NaN.
+    Returns a frame of the intervals' index with <column>_energy and samples columns.
+    """
+    starts = pd.DatetimeIndex(to_utc_datetime(intervals[start_column])).as_unit("ns").asi8
+    ends = pd.DatetimeIndex(to_utc_datetime(intervals[end_column])).as_unit("ns").asi8
+    timestamps = pd.DatetimeIndex(power_df["timestamp"]).as_unit("ns").asi8
+    out = pd.DataFrame(index=intervals.index)
+    for column in columns:
+        valid = power_df[column].notna().values
+        t = timestamps[valid]
+        y = power_df[column].values[valid].astype(float)
+        if baseline == "rolling":
+            y = y - estimate_idle_power(power_df[valid], column, window, quantile)
+        elif baseline == "min":
+            y = y - (y.min() if len(y) > 0 else 0.)
+        elif baseline != "none":
+            y = y - float(baseline)
+        y = np.clip(y, 0., None)
+        if len(t) < 2:
+            out[f'{column}_energy'] = np.nan
+            continue
+
+        seconds = (t - t[0]) / 1e9
+        dt = np.diff(seconds)
+        slope = np.divide(np.diff(y), dt, out=np.zeros_like(dt), where=dt > 0)
+        cumulative = np.r_[0., np.cumsum((y[1:] + y[:-1]) / 2. * dt)]
+
+        def integral_at(points):
+            x = (points - t[0]) / 1e9
+            i = np.clip(np.searchsorted(seconds, x, side="right") - 1, 0, len(seconds) - 2)
+            h = np.clip(x - seconds[i], 0., dt[i])
+            return cumulative[i] + y[i] * h + slope[i] * h ** 2 / 2.
+
+        covered = (starts >= t[0]) & (ends <= t[-1]) & (starts <= ends)
+        # Milliwatt seconds to joules
+        out[f'{column}_energy'] = np.where(covered, (integral_at(ends) - integral_at(starts)) / 1000., np.nan)
+    lo = np.searchsorted(timestamps, starts, side="left")
+    hi = np.searchsorted(timestamps, ends, side="right")
+    out["samples"] = np.clip(hi - lo, 0, None)
+    return out
+
+
+class MessageBuffer:
+    """Collects the progress messages of an instance processed in a worker process."""
+    def __init__(self):
+        self.messages = []
+
+    def write(self, message: str):
+        self.messages.append(message)
+
+
+def select_plugin_data(perf_df: pd.DataFrame, plugin_name: str) -> pd.DataFrame:
+    """Drops the records of other containers from the performance data, keeping the power metrics."""
+    if "meta.container" not in perf_df.columns:
+        return perf_df
+    return perf_df[(perf_df["meta.container"] == plugin_name) | (perf_df["name"] == "tegra_wattage_current_milliwatts")]
+
+
+def get_worker_context():
+    """Returns the multiprocessing context starting the worker processes of --jobs.
+
+    Forking a process running other threads, e.g. those of run_fleet, can deadlock the
+    child on a lock held by another thread, so workers are started by a fork server, or
+    spawned where it is not available.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def generate_metrics_from_instance_in_worker(run: pd.Series, perf_df: pd.DataFrame, traced=False):
+    """Returns the metrics of the instance, its progress messages, and the records of its stages if traced is True."""
+    buffer = MessageBuffer()
+    if not traced:
+        return generate_metrics_from_instance(buffer, run, perf_df), buffer.messages, []
+    tracer = Tracer()
+    set_tracer(tracer)
+    try:
+        with trace_labels(vsn=run.vsn, plugin=run.plugin_name, instance=run.k3s_pod_instance), trace("generate_metrics_from_instance", rows_in=len(perf_df)) as stage:
+            df = generate_metrics_from_instance(buffer, run, perf_df)
+            stage.rows_out = len(df)
+    finally:
+        set_tracer(NullTracer())
+    return df, buffer.messages, tracer.records
+
+
+def generate_plugin_metrics(runs: pd.DataFrame, planner: PerformanceQueryPlanner, sinks: dict, executor=None, max_pending=None, journal=None, governor=None):
+    """Generates the metrics of the runs and writes them to the sinks of their plugins.
+
+    Runs are processed in the order of the query spans covering them, so that each span
+    is released as soon as its runs are served rather than held until the last plugin,
+    and the metrics of a plugin are written in that order. Performance data are fetched
+    in this process. If executor is given, the instances are
+    processed by its workers with up to max_pending of them in flight, fewer under memory
+    pressure if governor is given, and their progress messages are printed here once they
+    are done. Each written instance is recorded in the journal if given.
+    """
+    runs = planner.order(runs)
+    t = tqdm(total=len(runs))
+    def write(run, run_df):
+        sink = sinks[run.plugin_name]
+        with trace_labels(plugin=run.plugin_name, instance=run.k3s_pod_instance), trace("write", rows_in=len(run_df)):
+            sink.write(run_df)
+        if journal is not None:
+            journal.record(run.plugin_name, run.k3s_pod_instance, len(run_df), sink.position)
+        t.update()
+
+    if executor is None:
+        for i in range(len(runs)):
+            run = runs.iloc[i]
+            with trace_labels(plugin=run.plugin_name, instance=run.k3s_pod_instance):
+                perf_df = planner.get(run)
+                with trace("generate_metrics_from_instance", rows_in=len(perf_df)) as stage:
+                    run_df = generate_metrics_from_instance(t, run, perf_df)
+                    stage.rows_out = len(run_df)
+            write(run, run_df)
+        t.close()
+        return
+
+    if max_pending is None:
+        max_pending = 2 * (os.cpu_count() or 1)
+    # Stages in the workers are traced there and their records are sent back with the metrics
+    tracer = get_tracer()
+    traced = isinstance(tracer, Tracer)
+    pending = deque()
+    def write_next():
+        run, future = pending.popleft()
+        run_df, messages, records = future.result()
+        for message in messages:
+            t.write(message)
+        if traced:
+            tracer.extend(records)
+        write(run, run_df)
+
+    for i in range(len(runs)):
+        run = runs.iloc[i]
+        with trace_labels(plugin=run.plugin_name, instance=run.k3s_pod_instance):
+            perf_df = select_plugin_data(planner.get(run), run.plugin_name)
+        pending.append((run, executor.submit(generate_metrics_from_instance_in_worker, run, perf_df, traced)))
+        while len(pending) >= (max_pending if governor is None else governor.allowed_pending(max_pending)):
+            write_next()
+    while len(pending) > 0:
+        write_next()
+    t.close()
+
+
+def split_runs(runs: pd.DataFrame, started: pd.Series, parts: int) -> list:
+    """Splits the runs into parts of consecutive start times."""
+    order = np.argsort(started[runs.index].values, kind="stable")
+    return [runs.iloc[i] for i in np.array_split(order, parts) if len(i) > 0]
+
+
+def generate_batch_plugin_metrics(runs: pd.DataFrame, sinks: dict, journal=None, download_func=download_performance_data, padding=PERF_QUERY_PADDING, strategy="auto", governor=None):
+    """Generates the metrics of the runs a day at a time per VSN and writes them to the sinks of their plugins.
+
+    Performance data of a VSN are fetched in one query per day covering the windows of all
+    the runs started on the day. If governor is given and the data of a day would not fit
+    in the memory left, the runs of the day are split into parts of consecutive start times
+    fetched one at a time. Each written instance is recorded in the journal if given.
+    Returns a summary of the queries made.
+    """
+    t = tqdm(total=len(runs))
+    started = to_utc_datetime(runs["timestamp"])
+    completed = to_utc_datetime(runs["completed_at"])
+    strategies = {"narrow": 0, "wide": 0}
+    fetched_rows, discarded_rows = 0, 0
+    fetched_bytes, fetched_seconds = 0, 0.
+    for (vsn, day), day_runs in runs.groupby([runs["vsn"].str.upper(), started.dt.floor("D")], sort=True):
+        parts = [day_runs]
+        if governor is not None and fetched_seconds > 0:
+            seconds = (completed[day_runs.index].max() - started[day_runs.index].min() + 2 * padding).total_seconds()
+            estimate = fetched_bytes / fetched_seconds * seconds * PERF_FETCH_OVERHEAD
+            headroom = governor.headroom()
+            if estimate > headroom:
+                n = int(min(len(day_runs), PERF_BATCH_MAX_PARTS, np.ceil(estimate / max(headroom, 1))))
+                parts = split_runs(day_runs, started, n)
+                governor.adapt("shrunk", f'{vsn}: Fetching the {len(day_runs)} runs started on {day.date()} in {len(parts)} queries.')
+        for part_runs in parts:
+            df, part_bytes, part_seconds = generate_batch_part(t, vsn, part_runs, started, completed, strategies, download_func, padding, strategy, governor, fetched_bytes / fetched_seconds if fetched_seconds > 0 else 0)
+            fetched_rows += df.attrs["fetched_rows"]
+            discarded_rows += df.attrs["discarded_rows"]
+            fetched_bytes += part_bytes
+            fetched_seconds += part_seconds
+            t.write(f'{vsn}: Generated {len(df)} records for {len(part_runs)} runs started on {day.date()}')
+            write_batch_part(t, vsn, part_runs, df, sinks, journal)
+    t.close()
+    return report_fetch_strategies(strategies, fetched_rows, discarded_rows)
+
+
+def generate_batch_part(t: tqdm, vsn: str, runs: pd.DataFrame, started: pd.Series, completed: pd.Series, strategies: dict, download_func, padding, strategy, governor, bytes_per_second):
+    """Fetches the performance data of the runs in one query and generates their metrics.
+
+    Returns the metrics, with the records fetched and discarded in their attrs, and the
+    bytes and seconds of performance data fetched.
+    """
+    start = started[runs.index].min() - padding
+    end = completed[runs.index].max() + padding
+    memory_budget = None
+    if governor is not None:
+        memory_budget = get_fetch_budget(governor, bytes_per_second * (end - start).total_seconds())
+    t.write(f'{vsn}: Fetching data from cloud ranging from {start.isoformat()} to {end.isoformat()} for {len(runs)} runs')
+    with trace_labels(vsn=vsn):
+        with trace("fetch") as stage:
+            perf_df, used_strategy, discarded = fetch_performance_data(download_func, vsn, start.isoformat(), end.isoformat(), runs["plugin_name"].unique(), strategy, memory_budget)
+            stage.rows_out = len(perf_df)
+        strategies[used_strategy] += 1
+        fetched_bytes = perf_df.memory_usage(index=False, deep=True).sum()
+        with trace("generate_batch_metrics", rows_in=len(perf_df)) as stage:
+            df = generate_batch_metrics(runs, perf_df, padding)
+            stage.rows_out = len(df)
+    df.attrs["fetched_rows"] = len(perf_df)
+    df.attrs["discarded_rows"] = discarded
+    return df, fetched_bytes, (end - start).total_seconds()
+
+
+def write_batch_part(t: tqdm, vsn: str, runs: pd.DataFrame, df: pd.DataFrame, sinks: dict, journal=None):
+    """Writes the metrics of each run to the sink of its plugin and records it in the journal if given."""
+    indices = df.groupby("plugin_instance").indices
+    for run in runs.itertuples(index=False):
+        run_df = df.iloc[indices.get(run.k3s_pod_instance, [])].reset_index(drop=True)
+        sink = sinks[run.plugin_name]
+        with trace_labels(vsn=vsn, plugin=run.plugin_name, instance=run.k3s_pod_instance), trace("write", rows_in=len(run_df)):
+            sink.write(run_df)
+        if journal is not None:
+            journal.record(run.plugin_name, run.k3s_pod_instance, len(run_df), sink.position)
+        t.update()
+
+
+def generate_perf_outputs(completed_runs: pd.DataFrame, output_dir: Path, output_format="csv", resume=False, jobs=1, batch=False, fetch_strategy="auto", governor=None):
+    """Generates the per-plugin outputs of the completed runs in output_dir.
+
+    With batch, metrics of all the runs are generated a day at a time per VSN by
+    generate_batch_metrics instead of one instance at a time, and jobs is ignored.
+
+    Written instances are recorded in a journal next to the outputs. With resume, only the
+    instances missing in the journal are fetched and appended to their plugin outputs.
+    Outputs created before the journal was introduced are skipped as a whole. fetch_strategy
+    is one of PERF_FETCH_STRATEGIES and selects how the performance data are queried.
+    If governor is given, the generation adapts to keep the memory within its budget.
+    Returns the number of records written.
+    """
+    journal = Journal(Path(output_dir).joinpath(JOURNAL_FILENAME), resume)
+    runs_by_plugin = dict(list(completed_runs.groupby("plugin_name")))
+    if resume:
+        for plugin_name, runs in runs_by_plugin.items():
+            output_path = get_output_path(output_dir, plugin_name, output_format)
+            finished = journal.finished(plugin_name)
+            if len(finished) == 0 and output_path.exists():
+                logging.info(f'{output_path} already exists. --resume is enabled. Skipping.')
+                runs_by_plugin[plugin_name] = runs.iloc[0:0]
+            elif len(finished) > 0:
+                runs_by_plugin[plugin_name] = runs[~runs["k3s_pod_instance"].isin(finished)]
+                logging.info(f'{plugin_name}: {len(runs) - len(runs_by_plugin[plugin_name])} instances found in the journal. --resume is enabled. {len(runs_by_plugin[plugin_name])} instances remain.')
+    remaining_runs = pd.concat(runs_by_plugin.values()) if len(runs_by_plugin) > 0 else completed_runs
+
+    def is_skipped(plugin_name, runs, position):
+        output_path = get_output_path(output_dir, plugin_name, output_format)
+        if len(runs) == 0 and (position is None or output_path.exists()):
+            if position is not None:
+                logging.info(f'{output_path} is complete. --resume is enabled. Skipping.')
+            return True
+        return False
+
+    if batch:
+        with journal, ExitStack() as stack:
+            sinks = {}
+            for plugin_name, runs in runs_by_plugin.items():
+                position = journal.position(plugin_name) if resume else None
+                if not is_skipped(plugin_name, runs, position):
+                    sinks[plugin_name] = stack.enter_context(open_sink(output_dir, plugin_name, output_format, position))
+            logging.info(f'Generating metrics for {len(remaining_runs)} runs of {len(sinks)} plugins in batch')
+            report = generate_batch_plugin_metrics(remaining_runs, sinks, journal, strategy=fetch_strategy, governor=governor)
+        for sink in sinks.values():
+            logging.info(f'Created {sink.path} with {sink.rows} new records.')
+        logging.info(report)
+        return sum(sink.rows for sink in sinks.values())
+
+    spill_dir = Path(output_dir).joinpath(PERF_SPILL_DIRNAME) if governor is not None else None
+    planner = PerformanceQueryPlanner(remaining_runs, strategy=fetch_strategy, governor=governor, spill_dir=spill_dir)
+    logging.info(f'{len(planner.spans)} queries planned for {len(remaining_runs)} runs.')
+
+    try:
+        with journal, ExitStack() as stack, ProcessPoolExecutor(jobs, mp_context=get_worker_context()) if jobs > 1 else nullcontext() as executor:
+            sinks = {}
+            for plugin_name, runs in runs_by_plugin.items():
+                position = journal.position(plugin_name) if resume else None
+                if not is_skipped(plugin_name, runs, position):
+                    sinks[plugin_name] = stack.enter_context(open_sink(output_dir, plugin_name, output_format, position))
+            logging.info(f'Generating metrics for {len(remaining_runs)} runs of {len(sinks)} plugins')
+            runs = remaining_runs[remaining_runs["plugin_name"].isin(sinks.keys())]
+            generate_plugin_metrics(runs, planner, sinks, executor, max_pending=2 * jobs, journal=journal, governor=governor)
+    finally:
+        planner.close()
+    for sink in sinks.values():
+        logging.info(f'Created {sink.path} with {sink.rows} new records.')
+    logging.info(planner.report())
+    return sum(sink.rows for sink in sinks.values())
+
+
+PROFILE_CHUNK_ROWS = 100000
+
+
+def find_perf_outputs(paths) -> list:
+    """Returns the perf outputs given as files or found in the directories, in CSV or Parquet.
+
+    Files without the columns of the outputs, e.g. the job lists, are left out.
+    """
+    outputs = []
+    for path in map(Path, paths):
+        if path.is_dir() and path.suffix != ".parquet":
+            candidates = sorted(p for p in path.rglob("*") if p.suffix in [".csv", ".parquet"] and not p.parent.name.endswith(".parquet"))
+        else:
+            candidates = [path]
+        for p in candidates:
+            if p.suffix == ".csv" and "plugin_instance" not in pd.read_csv(p, nrows=0).columns:
+                logging.info(f'Skipping {p} as it is not a perf output.')
+                continue
+            outputs.append(p)
+    return outputs
+
+
+def read_perf_output(path: Path, chunk_rows=PROFILE_CHUNK_ROWS):
+    """Yields the rows of a perf output in chunks of up to chunk_rows."""
+    if path.suffix == ".parquet":
+        parts = sorted(path.glob("part-*.parquet")) if path.is_dir() else [path]
+        for part in parts:
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_rows):
+            yield compact_instance_frame(chunk)
+
+
+def profile_perf_output(profile, path: Path, chunk_rows=PROFILE_CHUNK_ROWS) -> int:
+    """Adds the perf output of a plugin to the ResourceProfile in one pass. Returns the number of rows read."""
+    plugin_name = path.name.removesuffix(path.suffix)
+    rows = 0
+    spans = []
+    for chunk in read_perf_output(path, chunk_rows):
+        profile.update(plugin_name, chunk)
+        # Rows of an instance may span chunks, e.g. when written by --batch a day at a time
+        spans.append(chunk.groupby("plugin_instance", observed=True).agg(
+            device=("device", "first"),
+            gpu_requested=("gpu_requested", "first"),
+            start=("timestamp", "min"),
+            end=("timestamp", "max")))
+        rows += len(chunk)
+    if len(spans) > 0:
+        instances = pd.concat(spans).groupby(level=0, observed=True).agg(
+            device=("device", "first"),
+            gpu_requested=("gpu_requested", "first"),
+            start=("start", "min"),
+            end=("end", "max"))
+        instances["execution_time"] = (instances["end"] - instances["start"]).dt.total_seconds()
+        profile.update_instances(plugin_name, instances)
+    profile.sources.append(str(path))
+    return rows
+
+
+def start_trace() -> Tracer:
+    """Starts tracing the stages of the pipeline."""
+    tracer = Tracer()
+    set_tracer(tracer)
+    return tracer
+
+
+def finish_trace(tracer: Tracer, path: Path):
+    """Stops tracing, saves the trace to path, and prints the stages taking the most time."""
+    set_tracer(NullTracer())
+    tracer.save(path)
+    logging.info(f'Saved the trace of {len(tracer.records)} stages to {path}.')
+    print(tracer.report())
+
+
+def report_profile(profile) -> str:
+    table = profile.table()
+    if len(table) == 0:
+        return "No plugin instances profiled."
+    columns = ["plugin_name", "device", "gpu_requested", "instances"]
+    for metric in ["cpu", "mem", "sys_power", "cpugpu_power", "execution_time"]:
+        columns += [c for c in table.columns if c.startswith(f'{metric}_p')]
+    return table[columns].to_string(index=False, float_format=lambda x: f"{x:.1f}")
+
+
+def read_vsns(vsns, vsn_file=None) -> list:
+    """Returns the VSNs given as a list and in a file, one per line, without duplicates.
+
+    Empty lines and lines starting with # in the file are ignored.
+    """
+    vsns = list(vsns)
+    if vsn_file is not None:
+        with open(vsn_file, "r") as f:
+            vsns += [line.strip() for line in f if line.strip() != "" and not line.strip().startswith("#")]
+    return list(dict.fromkeys(vsn.upper() for vsn in vsns))
+
+
+def run_fleet(vsns: list, func, concurrency=4, governor=None) -> pd.DataFrame:
+    """Runs func for each VSN in up to concurrency threads.
+
+    func takes a VSN and returns the number of records it made. A failure of a VSN does
+    not stop the others. If governor is given, a VSN is not started while the memory is
+    under pressure and other VSNs are running. Returns a summary of the VSNs with their
+    records, status, error, and elapsed time.
+    """
+    def run(vsn):
+        started = time.monotonic()
+        logging.info(f'{vsn}: Started.')
+        try:
+            with governor.admit(vsn) if governor is not None else nullcontext(), trace_labels(vsn=vsn):
+                records, status, error = func(vsn), "done", ""
+        except Exception as ex:
+            logging.exception(f'{vsn}: Failed.')
+            records, status, error = 0, "failed", str(ex)
+        return {"vsn": vsn, "records": records, "status": status, "error": error, "elapsed": time.monotonic() - started}
+
+    summary = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run, vsn): vsn for vsn in vsns}
+        for f in as_completed(futures):
+            result = f.result()
+            summary.append(result)
+            logging.info(f'{result["vsn"]}: {result["status"]} with {result["records"]} records in {result["elapsed"]:.1f} seconds. {len(summary)}/{len(vsns)} VSNs processed.')
+    order = {vsn: i for i, vsn in enumerate(vsns)}
+    return pd.DataFrame(sorted(summary, key=lambda x: order[x["vsn"]]), columns=["vsn", "records", "status", "error", "elapsed"])
+
+
+def report_fleet(summary: pd.DataFrame):
+    failed = summary[summary["status"] == "failed"]
+    logging.info(f'Fleet summary:\n{summary.to_string(index=False, float_format=lambda x: f"{x:.1f}")}')
+    logging.info(f'{len(summary)} VSNs processed. {summary["records"].sum()} records in total. {len(failed)} VSNs failed{": " + ", ".join(failed["vsn"]) if len(failed) > 0 else ""}.')
+
+
 def convert_nodename_to_devicename(node_name: str) -> str:
     if "nx" in node_name:
         return "Jetson"